@@ -1,40 +1,107 @@
 import os
 import re
-import json
 import psutil
+import asyncio
 import argparse
-import subprocess
+import itertools
+import contextlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import time, datetime as dt
 import numpy as np
 from astropy.io import fits
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
 from libcamera import controls, Transform
+from pipeline import FITSWriterQueue
+from housekeeping import HousekeepingSampler
+from fits_writer import write_uint16_image, write_hdu, write_hdu_stream, FITSSequenceWriter, COMPRESSION_TYPES, CHECKSUM_MODES
+from integrity import ChecksumFiller
+from timing import StageTimer, FrameTiming, NoTiming, NO_TIMING
+from stacking import FrameStacker
+from calibration import CalibrationLibrary
+from lucky import LuckySelector, LUCKY_METRICS
+from csi2 import packed_bits, packed_columns, unpack_csi2
+from streaming import FrameServer
+from preview import PreviewQueue, PREVIEW_FORMATS
+from catalog import FrameCatalog
 
 BOOT_TIME = dt.datetime.utcfromtimestamp(psutil.boot_time())
 sensortime_to_datetime = lambda sensortime_ns: BOOT_TIME+dt.timedelta(microseconds=sensortime_ns/1e3)
+EXPOSURE_KEYWORDS = ("DATAMIN", "GAIN", "FRAMELUX", "COLORTMP", "FOCUSFOM", "CPU-TEMP", "CCD-TEMP",
+                     "EXPTIME", "DATE-END", "DATE") # header cards that change from frame to frame
+EXPOSURE_TOLERANCE = (0.005, 100) # relative, absolute [us]: the sensor rounds exposures to whole lines
+GAIN_TOLERANCE = 0.02 # relative: analog gain codes get coarse at high gain
+DPC_PARAMETER = os.environ.get("IMX477_DPC_PARAMETER", "/sys/module/imx477/parameters/dpc_enable")
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--exposure", metavar="<seconds>", type=float, default=1., help="exposure time in seconds")
 parser.add_argument("-o", "--out-file", metavar="<path>", type=str, default="test.fits", help="file name/path to save output FITS image")
 parser.add_argument("-n", "--number", metavar="<#>", type=int, default=1, help="number of frames to capture in sequence")
 parser.add_argument("-g", "--gain", metavar="<setting>", type=float, default=1., help="analog gain setting (default=1.0)")
+parser.add_argument("-w", "--writers", metavar="<#>", type=int, default=0, help="write sequence frames from this many background threads (default=0, i.e. serially)")
+parser.add_argument("--queue-frames", metavar="<#>", type=int, default=8, help="max. frames waiting to be written in pipelined mode")
+parser.add_argument("--queue-mb", metavar="<MiB>", type=float, default=256., help="max. memory held by frames waiting to be written in pipelined mode")
+parser.add_argument("--direct", action="store_true", help="write frames straight from the request buffer into memory-mapped FITS files")
+parser.add_argument("--sequence", choices=["cube", "mef"], default=None, help="write all frames into one file, as a NAXIS3 cube or one extension per frame")
+parser.add_argument("--stack", choices=["mean", "sigmaclip", "median"], default=None, help="combine all frames into one master frame instead of saving them")
+parser.add_argument("--frame-type", choices=["bias", "dark", "flat"], default=None, help="frame type, recorded as IMAGETYP in every frame (default LIGHT) and in the --stack master")
+parser.add_argument("--calibration", metavar="<dir>", type=str, default=None, help="apply master bias/dark/flat frames from this directory before saving")
+parser.add_argument("--compress", choices=COMPRESSION_TYPES, default=None, help="write tile-compressed FITS (requires -w/--writers)")
+parser.add_argument("--checksum", choices=CHECKSUM_MODES, default="inline", help="FITS checksums: computed before writing (inline), "
+                    "while writing (stream), by a background thread after writing (deferred), or not at all (off); compressed files are summed as they are written unless off")
+parser.add_argument("--timing", metavar="<path>", type=str, default=None, help="record per-stage capture latencies to this JSON lines file")
+parser.add_argument("--drop", action="store_true", help="drop frames instead of stalling capture when the writer queue is full")
+parser.add_argument("--lucky", metavar="<#>", type=int, default=None, help="lucky imaging: capture -n frames, keep this many of the sharpest as a cube")
+parser.add_argument("--roi", metavar=("<x>", "<y>", "<w>", "<h>"), type=int, nargs=4, default=None, help="region of interest in full-resolution sensor pixels, set as the ScalerCrop control")
+parser.add_argument("--binning", type=int, choices=[1, 2], default=1, help="use the sensor's 2x2 binned mode (2028x1520) instead of full resolution")
+parser.add_argument("--packed", action="store_true", help="capture CSI-2 packed raw (less memory bandwidth) and unpack it after releasing each request")
+parser.add_argument("--superpixel", metavar="<n>", type=int, default=1, help="additionally bin n x n same-colour pixels in software, keeping the Bayer pattern")
+parser.add_argument("--metric", choices=LUCKY_METRICS, default="gradient", help="sharpness metric for --lucky")
+parser.add_argument("--serve", metavar="<address>", type=str, default=None, help="publish frames for quick-look (see streaming.py) on host:port or a Unix socket path")
+parser.add_argument("--preview", choices=PREVIEW_FORMATS, default=None, help="also make a stretched colour preview of every file written, in background processes (see preview.py)")
+parser.add_argument("--catalog", metavar="<path>", type=str, default=None, help="add every file written to this SQLite frame index (see catalog.py)")
+parser.add_argument("--housekeeping", metavar="<path>", type=str, default=None, help="save CPU/sensor temperature history to this CSV file")
 
-def get_cpu_temp() -> float:
-    proc = subprocess.run(["sensors", "-j"], text=True, capture_output=True)
-    sensors = json.loads(proc.stdout)
-    return sensors["cpu_thermal-virtual-0"]["temp1"]["temp1_input"]
+def bin_bayer(frame: np.ndarray, factor: int) -> np.ndarray:
+    # same-colour software binning: each 2x2 Bayer cell of the output averages factor x factor cells of
+    # the input, so the result is still a mosaic with the same pattern (as from the sensor's binned
+    # modes). Averaging keeps the range; with 12-bit data left-aligned in 16 bits the low bits keep
+    # the extra precision. Rows/columns that don't fill a whole block are dropped.
+    height, width = (size - size % (2*factor) for size in frame.shape)
+    cells = frame[:height, :width].reshape(height//(2*factor), factor, 2, width//(2*factor), factor, 2)
+    binned = cells.sum(axis=(1, 4), dtype=np.uint32)
+    binned += factor**2//2
+    binned //= factor**2
+    return binned.astype(np.uint16).reshape(height//factor, width//factor)
 
 class PiHQCamera(Picamera2):
 
-    def __init__(self, gain=1.0, dpc=False) -> None:
+    def __init__(self, gain=1.0, dpc=False, housekeeping_interval=1.0, binning=1, superpixel=1,
+                 packed=False) -> None:
+        self._header_template = None
+        self._superpixel = superpixel
+        self.timer: "StageTimer|None" = None # set to instrument the capture path
+        self._camera_executor = None
+        self._checksum_filler = None
+        self.checksum_mode = "inline" # see CHECKSUM_MODES and write_fits
+        self.frame_server: "FrameServer|None" = None # see serve_frames
+        self._frame_type = "light" # recorded as IMAGETYP
+        self.previews: "PreviewQueue|None" = None # see file_written
+        self.catalog: "FrameCatalog|None" = None # see file_written
+        self.housekeeping = HousekeepingSampler(interval=housekeeping_interval)
+        self.housekeeping.start()
         self.tuning_dict = self.load_tuning_file("imx477_scientific.json")
         tuning_algorithms = list(map(lambda algo: list(algo.keys()).pop(), self.tuning_dict["algorithms"]))
         self.tuning_dict["algorithms"][tuning_algorithms.index("rpi.dpc")]["rpi.dpc"] = {"strength": int(dpc)}
         super().__init__(tuning=self.tuning_dict)
         self.configuration = self.create_still_configuration(transform=Transform(), #hflip=False, vflip=True),
                                                              main={},
-                                                             raw={"size": self.sensor_resolution,
-                                                                  "format": self.sensor_format.replace("_CSI2P", "")},
+                                                             raw={"size": (self.sensor_resolution[0]//binning,
+                                                                           self.sensor_resolution[1]//binning),
+                                                                  "format": self.sensor_format if packed
+                                                                            else self.sensor_format.replace("_CSI2P", "")},
+                                                             sensor={"output_size": (self.sensor_resolution[0]//binning,
+                                                                                     self.sensor_resolution[1]//binning)},
                                                              controls={"AnalogueGain": gain, "ColourGains": (1., 1.),
                                                                        "AwbEnable": False, "AeEnable": False, "Sharpness": 0.,
                                                                        "NoiseReductionMode": controls.draft.NoiseReductionModeEnum.Off})
@@ -42,10 +109,66 @@ class PiHQCamera(Picamera2):
         print(f"Initial metadata:\n{self.capture_metadata()}")
         self.stop()
     
+    @property
+    def header_template(self) -> fits.Header:
+        # static instrument/detector cards, built once per configuration; per-exposure cards are
+        # placeholders here (to fix the card order) and get filled in by build_hdu
+        if self._header_template is None:
+            self._header_template = self.build_header_template()
+        return self._header_template
+
+    def build_header_template(self) -> fits.Header:
+        raw_format = re.match(r"(S)(?P<bayer>[RGB]{4})(?P<bits>\d+)(_CSI2P)?", self.raw_format)
+        bpp = int(raw_format.group("bits"))
+        bayer_order = raw_format.group("bayer")[2:] + raw_format.group("bayer")[:2] # flip vertically to match FITS
+        header = fits.Header()
+        header.set("BUNIT", "DN", "units of array values")
+        header.set("INST-SEP", "-"*19+" INSTRUMENT/OBSERVATORY INFO "+"-"*20)
+        # header.set("FORMAT", raw_format, "configured camera format")
+        header.set("INSTRUME", "Raspberry Pi HQ Camera Module", "camera name")
+        header.set("TELESCOP", None, "telescope model/name")
+        header.set("FOCALLEN", None, "[mm] telescope/lens focal length")
+        header.set("PROGRAM", "AstroHQ by cgobat", "instrument software that generated this HDU")
+        header.set("PLATFORM", self.platform.name, "platform architecture (VC4/PISP)")
+        header.set("DET-SEP", "-"*22 + " DETECTOR CONFIGURATION " + "-"*22)
+        header.set("DETECTOR", self.camera_properties["Model"].upper(), "camera sensor model")
+        binning = self.sensor_binning*self.superpixel
+        header.set("XBINNING", binning, "binning factor along x (sensor x software)")
+        header.set("YBINNING", binning, "binning factor along y (sensor x software)")
+        header.set("XPIXSIZE", binning*self.camera_properties["UnitCellSize"][0]/1000, "[um] binned pixel width")
+        header.set("YPIXSIZE", binning*self.camera_properties["UnitCellSize"][1]/1000, "[um] binned pixel height")
+        header.set("XORGSUBF", None, "[px] subframe origin on x axis (binned pixels)")
+        header.set("YORGSUBF", None, "[px] subframe origin on y axis (binned pixels)")
+        header.set("BAYERPAT", bayer_order, "Bayer filter order/layout")
+        header.set("BITDEPTH", bpp, "number of bits per pixel value")
+        header.set("DATAMIN", None, "[DN] sensor black point")
+        header.set("DATAMAX", 2**bpp-1, f"[DN] maximum representable value with {bpp} bits")
+        header.set("GAIN", None, "analog gain setting")
+        header.set("SONY_DPC", self.onboard_dpc_enabled(), "on-sensor defective pixel correction status")
+        header.set("RPI_DPC", self.pipeline_dpc_enabled(), "libcamera defective pixel correction status")
+        header.set("META-SEP", "-"*23+" OBSERVATION METADATA "+"-"*23)
+        header.set("FRAMELUX", None, "[lx] estimated scene brightness/illuminance")
+        header.set("COLORTMP", None, "[K] estimated average color temperature")
+        header.set("FOCUSFOM", None, "image focus figure of merit")
+        # header.set("UPTIME", None, "[s] system uptime since boot")
+        header.set("CPU-TEMP", None, "[degC] processor/CPU temperature")
+        header.set("CCD-TEMP", None, "[degC] sensor/detector temperature")
+        header.set("IMAGETYP", self._frame_type.upper(), "type of frame")
+        header.set("EXPTIME", None, "[s] image exposure time")
+        header.set("DATE-END", None, "[ISO UTC] time of first pixel readout")
+        header.set("FILE-SEP", "-"*27 + " FILE METADATA " + "-"*26)
+        header.set("DATE", None, "[ISO UTC] time of HDU creation")
+        return header
+
     @property
     def raw_format(self) -> str:
         return self.configuration["raw"]["format"]
 
+    @property
+    def packed_bits(self) -> "int|None":
+        # bit depth if the raw stream is CSI-2 packed, else None
+        return packed_bits(self.raw_format)
+
     @property
     def configuration(self) -> dict:
         return self.camera_configuration()
@@ -54,7 +177,54 @@ class PiHQCamera(Picamera2):
     def configuration(self, new_config: dict) -> None:
         # print("Configuring camera:", new_config)
         self.configure(new_config)
+        self._header_template = None
     
+    @property
+    def sensor_binning(self) -> int:
+        # from the configured sensor mode: full-resolution pixels per raw pixel
+        return round(self.camera_properties["ScalerCropMaximum"][2]/self.configuration["raw"]["size"][0])
+
+    @property
+    def superpixel(self) -> int:
+        return self._superpixel
+
+    @superpixel.setter
+    def superpixel(self, factor: int) -> None:
+        self._superpixel = factor
+        self._header_template = None
+
+    @property
+    def frame_type(self) -> str:
+        return self._frame_type
+
+    @frame_type.setter
+    def frame_type(self, frame_type: str) -> None:
+        self._frame_type = frame_type
+        self._header_template = None
+
+    def set_roi(self, roi: "tuple|None") -> None:
+        # (x, y, width, height) in full-resolution sensor pixels, or None for the whole sensor mode;
+        # takes effect a few frames later if the camera is running. Frames are cropped to the ScalerCrop
+        # reported with each frame (see raw_crop), so the ISP statistics cover the same region.
+        self.set_controls({"ScalerCrop": tuple(roi) if roi is not None else self.camera_properties["ScalerCropMaximum"]})
+
+    def raw_crop(self, meta: dict) -> "tuple[int, int, int, int]":
+        # the frame's ScalerCrop (full-resolution sensor coordinates) as (x, y, width, height) in pixels
+        # of the raw stream, whose sensor mode may be binned and/or cropped; widened to whole Bayer cells
+        x, y, width, height = meta["ScalerCrop"]
+        mode_x, mode_y, mode_width, mode_height = self.camera_properties["ScalerCropMaximum"]
+        raw_width, raw_height = self.configuration["raw"]["size"]
+        x0, x1 = (round((value-mode_x)*raw_width/mode_width) for value in (x, x+width))
+        y0, y1 = (round((value-mode_y)*raw_height/mode_height) for value in (y, y+height))
+        x0, y0 = max(x0 - x0 % 2, 0), max(y0 - y0 % 2, 0)
+        x1, y1 = min(x1 + x1 % 2, raw_width), min(y1 + y1 % 2, raw_height)
+        return x0, y0, x1-x0, y1-y0
+
+    def output_frame(self, array: np.ndarray) -> np.ndarray:
+        # flipped to match FITS, then software-binned if configured (a view unless binned)
+        array = array[::-1, :]
+        return array if self.superpixel == 1 else bin_bayer(array, self.superpixel)
+
     @property
     def exposure(self) -> float:
         if hasattr(self.controls, "ExposureTime"):
@@ -68,7 +238,7 @@ class PiHQCamera(Picamera2):
     
     @staticmethod
     def onboard_dpc_enabled() -> bool:
-        with open("/sys/module/imx477/parameters/dpc_enable", "r") as dpc_file:
+        with open(DPC_PARAMETER, "r") as dpc_file:
             status = dpc_file.read().strip()
         if status == "1":
             return True
@@ -88,103 +258,492 @@ class PiHQCamera(Picamera2):
         rpi_dpc_algo: dict = self.find_tuning_algo(tuning, "rpi.dpc")
         return bool(rpi_dpc_algo.get("strength", 1)) # TODO: verify that default strength is indeed 1 if not set
     
-    def capture_raw_array(self, metadata=False) -> "np.ndarray|tuple[np.ndarray, dict]":
+    def frame_timing(self, label: str) -> "FrameTiming|NoTiming":
+        return NO_TIMING if self.timer is None else self.timer.frame(label)
+
+    def settings_applied(self, meta: dict, exposure_us: int, gain: float) -> bool:
+        # whether a frame was taken with these settings, allowing for the sensor's quantization and
+        # clamping to the limits of the sensor mode
+        low, high = self.camera_controls["ExposureTime"][:2]
+        expected = min(max(exposure_us, low), high)
+        return (np.isclose(meta["ExposureTime"], expected, rtol=EXPOSURE_TOLERANCE[0], atol=EXPOSURE_TOLERANCE[1])
+                and np.isclose(meta["AnalogueGain"], gain, rtol=GAIN_TOLERANCE))
+
+    def settled_request(self, exposure_us: int, gain: float, max_frames=10):
+        # first request taken with the given settings; frames still in flight with the old ones are
+        # released as they arrive
+        for discarded in range(max_frames+1):
+            request = self.capture_request()
+            meta = request.get_metadata()
+            if self.settings_applied(meta, exposure_us, gain):
+                if discarded:
+                    print(f"Discarded {discarded} frame(s) before settings took effect")
+                return request
+            request.release()
+        raise TimeoutError(f"ExposureTime={exposure_us} us, AnalogueGain={gain} not applied after {max_frames} frames "
+                           f"(last frame: {meta['ExposureTime']} us, {meta['AnalogueGain']})")
+
+    def capture_raw_array(self, metadata=False, timing=NO_TIMING, request=None, crop=False) -> "np.ndarray|tuple[np.ndarray, dict]":
+        # with crop=True only the ScalerCrop region is copied out of the request buffer (see raw_crop),
+        # so the result must not be cropped again by build_hdu
         print(f"Capture starting at  {dt.datetime.utcnow().isoformat()}")
-        request = self.capture_request()
-        array: np.ndarray = request.make_array("raw")
-        if metadata:
-            capture_meta = request.get_metadata()
-        print(f"Releasing request at {dt.datetime.utcnow().isoformat()}")
-        request.release()
-        array_rebuilt = array.view("<u2")
+        if request is None:
+            with timing.stage("request_wait"):
+                request = self.capture_request()
+        try:
+            with timing.stage("extract"):
+                capture_meta = request.get_metadata()
+                self.housekeeping.record_metadata(capture_meta)
+                if self.packed_bits is not None: # only the packed bytes are copied; unpacked after release
+                    with MappedArray(request, "raw", reshape=False) as mapped:
+                        packed, offset, width = self.packed_raw(self.mapped_rows(mapped), capture_meta, crop)
+                        packed = packed.copy()
+                elif crop:
+                    with MappedArray(request, "raw", reshape=False) as mapped:
+                        array = self.mapped_raw(mapped, capture_meta).copy()
+                else:
+                    array: np.ndarray = request.make_array("raw").view("<u2")
+        finally: # the buffer must go back to libcamera even if the copy fails
+            print(f"Releasing request at {dt.datetime.utcnow().isoformat()}")
+            with timing.stage("release"):
+                request.release()
+        if self.packed_bits is not None:
+            with timing.stage("unpack"):
+                array = self.unpack_raw(packed, offset, width)
         if metadata:
-            return array_rebuilt, capture_meta
+            return array, capture_meta
         else:
-            return array_rebuilt
+            return array
     
-    def capture_hdu(self, crop=True) -> fits.PrimaryHDU:
-        array, meta = self.capture_raw_array(metadata=True)
-        meta.pop("ColourCorrectionMatrix") # omit from further use
-        print(f"\nCapture metadata:\n{meta}\n")
-        raw_format = re.match(r"(S)(?P<bayer>[RGB]{4})(?P<bits>\d+)(_CSI2P)?", self.raw_format)
-        bpp = int(raw_format.group("bits"))
-        black_pt = np.unique(meta["SensorBlackLevels"]).item()//(2**(16-bpp)) # 2**16 / 2**12 = 16
-        bayer_order = raw_format.group("bayer")[2:] + raw_format.group("bayer")[:2] # flip vertically to match FITS
-        if crop:
-            hcrop, vcrop, width, height = meta["ScalerCrop"]
-            array = array[vcrop:vcrop+height, hcrop:hcrop+width]
-        print(f"Orig. array min/max: {array.min(), array.max()}")
-        hdu = fits.PrimaryHDU(data=array[::-1, :].astype(np.uint16))
-        hdu.header.set("BUNIT", "DN", "units of array values")
-        hdu.header.set("INST-SEP", "-"*19+" INSTRUMENT/OBSERVATORY INFO "+"-"*20)
-        # hdu.header.set("FORMAT", raw_format, "configured camera format")
-        hdu.header.set("INSTRUME", "Raspberry Pi HQ Camera Module", "camera name")
-        hdu.header.set("TELESCOP", None, "telescope model/name")
-        hdu.header.set("FOCALLEN", None, "[mm] telescope/lens focal length")
-        hdu.header.set("PROGRAM", "AstroHQ by cgobat", "instrument software that generated this HDU")
-        hdu.header.set("PLATFORM", self.platform.name, "platform architecture (VC4/PISP)")
-        hdu.header.set("DET-SEP", "-"*22 + " DETECTOR CONFIGURATION " + "-"*22)
-        hdu.header.set("DETECTOR", self.camera_properties["Model"].upper(), "camera sensor model")
-        hdu.header.set("XPIXSIZE", self.camera_properties["UnitCellSize"][0]/1000, "[um] pixel width")
-        hdu.header.set("YPIXSIZE", self.camera_properties["UnitCellSize"][1]/1000, "[um] pixel height")
-        hdu.header.set("BAYERPAT", bayer_order, "Bayer filter order/layout")
-        hdu.header.set("BITDEPTH", bpp, "number of bits per pixel value")
-        hdu.header.set("DATAMIN", black_pt, "[DN] sensor black point")
-        hdu.header.set("DATAMAX", 2**bpp-1, f"[DN] maximum representable value with {bpp} bits")
-        hdu.header.set("GAIN", meta["AnalogueGain"], "analog gain setting")
-        hdu.header.set("SONY_DPC", self.onboard_dpc_enabled(), "on-sensor defective pixel correction status")
-        hdu.header.set("RPI_DPC", self.pipeline_dpc_enabled(), "libcamera defective pixel correction status")
-        hdu.header.set("META-SEP", "-"*23+" OBSERVATION METADATA "+"-"*23)
-        hdu.header.set("FRAMELUX", meta["Lux"], "[lx] estimated scene brightness/illuminance")
-        hdu.header.set("COLORTMP", meta["ColourTemperature"], "[K] estimated average color temperature")
-        hdu.header.set("FOCUSFOM", meta["FocusFoM"], "image focus figure of merit")
-        # hdu.header.set("UPTIME", meta["SensorTimestamp"]/1e9, "[s] system uptime since boot")
-        hdu.header.set("CPU-TEMP", get_cpu_temp(), "[degC] processor/CPU temperature")
-        hdu.header.set("CCD-TEMP", meta["SensorTemperature"], "[degC] sensor/detector temperature")
-        hdu.header.set("EXPTIME", meta["ExposureTime"]/1e6, "[s] image exposure time")
-        hdu.header.set("DATE-END", sensortime_to_datetime(meta["SensorTimestamp"]).isoformat(),
-                       "[ISO UTC] time of first pixel readout")
-        hdu.header.set("FILE-SEP", "-"*27 + " FILE METADATA " + "-"*26)
-        hdu.header.set("DATE", dt.datetime.utcnow().isoformat(), "[ISO UTC] time of HDU creation")
-         
-        hdu.add_checksum()
+    def capture_hdu(self, crop=True, timing=NO_TIMING) -> fits.PrimaryHDU:
+        array, meta = self.capture_raw_array(metadata=True, timing=timing, crop=crop)
+        return self.build_hdu(array, meta, crop=False, checksum=self.checksum_mode == "inline", timing=timing)
+
+    @property
+    def checksum_filler(self) -> ChecksumFiller:
+        if self._checksum_filler is None:
+            self._checksum_filler = ChecksumFiller()
+        return self._checksum_filler
+
+    def write_fits(self, hdu: fits.PrimaryHDU, filename: str, timing=NO_TIMING) -> int:
+        # write_hdu with the checksum handled according to checksum_mode: "inline" HDUs already carry
+        # theirs (build_hdu), "stream" sums the data as it is written, "deferred" leaves it to the
+        # background checksum_filler
+        if self.checksum_mode in ("stream", "deferred") and hdu.header.get("BITPIX") == 16:
+            deferred = self.checksum_mode == "deferred"
+            written = write_hdu_stream(hdu, filename, timing, checksum=not deferred, pending=deferred)
+            if deferred:
+                self.checksum_filler.submit(filename)
+        else:
+            written = write_hdu(hdu, filename, timing)
+        self.file_written(filename)
+        return written
+
+    def file_written(self, filename: str) -> None:
+        # hands a finished FITS file to the preview workers and the frame catalog, if enabled
+        if self.previews is not None:
+            self.previews.submit(filename)
+        if self.catalog is not None:
+            self.catalog.add(filename)
+
+    def frame_header(self, meta: dict) -> fits.Header:
+        meta.pop("ColourCorrectionMatrix", None) # omit from further use
+        header = self.header_template.copy()
+        bpp: int = header["BITDEPTH"]
+        header["DATAMIN"] = np.unique(meta["SensorBlackLevels"]).item()//(2**(16-bpp)) # 2**16 / 2**12 = 16
+        header["GAIN"] = meta["AnalogueGain"]
+        header["FRAMELUX"] = meta["Lux"]
+        header["COLORTMP"] = meta["ColourTemperature"]
+        header["FOCUSFOM"] = meta["FocusFoM"]
+        x, y, width, height = self.raw_crop(meta)
+        header["XORGSUBF"] = x//self.superpixel
+        header["YORGSUBF"] = (self.configuration["raw"]["size"][1]-y-height)//self.superpixel # from the bottom, as flipped
+        exposure_mid = meta["SensorTimestamp"] - meta["ExposureTime"]*1000//2 # ns since boot
+        header["CPU-TEMP"] = self.housekeeping.cpu_temp_at(exposure_mid)
+        header["CCD-TEMP"] = meta["SensorTemperature"]
+        header["EXPTIME"] = meta["ExposureTime"]/1e6
+        header["DATE-END"] = sensortime_to_datetime(meta["SensorTimestamp"]).isoformat()
+        header["DATE"] = dt.datetime.utcnow().isoformat()
+        return header
+
+    def build_hdu(self, array: np.ndarray, meta: dict, crop=True, checksum=True, timing=NO_TIMING) -> fits.PrimaryHDU:
+        with timing.stage("header"):
+            header = self.frame_header(meta)
+            print(f"\nCapture metadata:\n{meta}\n")
+            if crop:
+                x, y, width, height = self.raw_crop(meta)
+                array = array[y:y+height, x:x+width]
+            print(f"Orig. array min/max: {array.min(), array.max()}")
+            hdu = fits.PrimaryHDU(data=np.ascontiguousarray(self.output_frame(array), dtype=np.uint16))
+            hdu.header.extend(header)
+        self.publish_frame(hdu.data, hdu.header, timing)
+        if checksum:
+            with timing.stage("checksum"):
+                hdu.add_checksum()
         return hdu
     
-    def capture_fits(self, filename: str) -> None:
-        hdu = self.capture_hdu()
-        hdu.writeto(filename, overwrite=True)
+    def capture_fits(self, filename: str, calibration: "CalibrationLibrary|None" = None) -> None:
+        timing = self.frame_timing(filename)
+        hdu = self.capture_hdu(timing=timing)
+        if calibration is not None:
+            with timing.stage("calibrate"):
+                hdu = calibration.calibrate_hdu(hdu)
+        self.write_fits(hdu, filename, timing)
+        timing.finish()
         return
     
-    def start_and_capture_fits(self, filename: str) -> None:
+    def mapped_rows(self, mapped: MappedArray) -> np.ndarray:
+        # (height, stride) bytes of the raw stream
+        raw_config = self.configuration["raw"]
+        height, stride = raw_config["size"][1], raw_config["stride"]
+        return mapped.array[:height*stride].reshape(height, stride)
+
+    def packed_raw(self, rows: np.ndarray, meta: dict, crop=True) -> "tuple[np.ndarray, int, int]":
+        # for packed formats: the bytes holding the crop (whole pixel groups, a view of `rows`), the
+        # offset of its first pixel within them, and its width; see unpack_raw
+        x, y, width, height = self.raw_crop(meta) if crop else (0, 0, *self.configuration["raw"]["size"])
+        columns, offset = packed_columns(x, width, self.packed_bits)
+        return rows[y:y+height, columns], offset, width
+
+    def unpack_raw(self, packed: np.ndarray, offset: int, width: int, out: "np.ndarray|None" = None) -> np.ndarray:
+        # same layout and values as the unpacked format would give (12-bit data left-aligned in 16 bits)
+        bits = self.packed_bits
+        return unpack_csi2(packed, packed.shape[1]*8//bits, bits, out)[:, offset:offset+width]
+
+    def mapped_raw(self, mapped: MappedArray, meta: dict, crop=True) -> np.ndarray:
+        # the raw stream as a view of the request buffer, cropped like build_hdu but not yet flipped;
+        # packed formats are unpacked into a new array instead
+        if self.packed_bits is not None:
+            return self.unpack_raw(*self.packed_raw(self.mapped_rows(mapped), meta, crop))
+        array = self.mapped_rows(mapped).view("<u2")
+        if crop:
+            x, y, width, height = self.raw_crop(meta)
+            array = array[y:y+height, x:x+width]
+        return array
+
+    def mapped_frame(self, mapped: MappedArray, meta: dict, crop=True) -> np.ndarray:
+        # same layout as build_hdu (cropped, flipped to match FITS, binned), but as a view of the
+        # request buffer rather than a copy unless software binning is on
+        return self.output_frame(self.mapped_raw(mapped, meta, crop))
+
+    @contextlib.contextmanager
+    def captured_frame(self, crop=True, timing=NO_TIMING):
+        # yields (frame, header) where frame is a view of the request buffer (see mapped_frame),
+        # only valid until the request is released on exit
+        with timing.stage("request_wait"):
+            request = self.capture_request()
+        try:
+            with timing.stage("header"):
+                meta = request.get_metadata()
+                self.housekeeping.record_metadata(meta)
+                header = self.frame_header(meta)
+            with MappedArray(request, "raw", reshape=False) as mapped:
+                frame = self.mapped_frame(mapped, meta, crop)
+                self.publish_frame(frame, header, timing)
+                yield frame, header
+        finally:
+            with timing.stage("release"):
+                request.release()
+
+    def serve_frames(self, address: str) -> FrameServer:
+        # publish every frame built by build_hdu or captured_frame to subscribers on `address`
+        self.frame_server = FrameServer(address)
+        print(f"Serving frames on {self.frame_server.address}")
+        return self.frame_server
+
+    def publish_frame(self, frame: np.ndarray, header: fits.Header, timing=NO_TIMING) -> None:
+        # copies what subscribers want before returning, so `frame` may be a request buffer view
+        if self.frame_server is not None:
+            with timing.stage("publish"):
+                self.frame_server.publish(frame, header)
+
+    def capture_fits_direct(self, filename: str, crop=True) -> int:
+        # the only copy goes straight into the memory-mapped FITS data section (byteswap and BZERO
+        # offset included), made before the request is released
+        timing = self.frame_timing(filename)
+        with self.captured_frame(crop, timing) as (frame, header):
+            with timing.stage("write"): # includes the checksum
+                deferred = self.checksum_mode == "deferred"
+                copied = write_uint16_image(filename, frame, header, checksum=self.checksum_mode in ("inline", "stream"),
+                                            pending=deferred)
+            if deferred:
+                self.checksum_filler.submit(filename)
+            self.file_written(filename)
+        timing.finish()
+        return copied
+
+    def capture_fits_cube(self, filename: str, number: int, mode="cube", crop=True) -> None:
+        # whole sequence in one preallocated file; see FITSSequenceWriter
+        writer = None
+        try:
+            for i in range(number):
+                timing = self.frame_timing(f"{filename}[{i}]")
+                with self.captured_frame(crop, timing) as (frame, header):
+                    if writer is None:
+                        writer = FITSSequenceWriter(filename, number, frame.shape, header,
+                                                    frame_keywords=EXPOSURE_KEYWORDS, mode=mode)
+                    with timing.stage("write"):
+                        writer.write(frame, header)
+                timing.finish()
+                print(f"Captured frame {i+1}/{number} into {filename}")
+        finally:
+            if writer is not None:
+                writer.close()
+                self.file_written(filename)
+        return
+
+    def capture_stack(self, number: int, stacker: FrameStacker, crop=True) -> FrameStacker:
+        # frames are accumulated straight from the request buffer and never kept in memory
+        for i in range(number):
+            with self.captured_frame(crop) as (frame, header):
+                stacker.add(frame, header)
+            print(f"Stacked frame {i+1}/{number}")
+        return stacker
+
+    def capture_lucky(self, filename: str, number: int, keep: int, metric="gradient") -> LuckySelector:
+        # score `number` frames and write the `keep` sharpest as a cube; per-frame headers are only
+        # built for the frames that are kept. Use set_roi to restrict frames to the target.
+        selector = LuckySelector(keep, metric)
+        for i in range(number):
+            request = self.capture_request()
+            try:
+                meta = request.get_metadata()
+                with MappedArray(request, "raw", reshape=False) as mapped:
+                    selector.offer(self.mapped_frame(mapped, meta), meta)
+            finally:
+                request.release()
+            if (i+1) % 100 == 0:
+                print(f"Scored {i+1}/{number} frames")
+        selector.write(filename, self.frame_header, frame_keywords=EXPOSURE_KEYWORDS)
+        return selector
+
+    def capture_fits_sequence(self, filename_fmt: str, number: int, writer: FITSWriterQueue) -> None:
+        # capture thread only grabs and releases requests; HDUs are built and written by `writer`
+        for i in range(number):
+            timing = self.frame_timing(filename_fmt.format(i))
+            array, meta = self.capture_raw_array(metadata=True, timing=timing, crop=True)
+            if writer.submit(filename_fmt.format(i), array, meta, timing):
+                print(f"Queued {filename_fmt.format(i)} ({writer.pending} pending)")
+        writer.join()
+        print(writer.report())
+        return
+
+    def capture_bracket(self, steps: "list[tuple[float, float]]", filename_fmt: str, max_frames=10,
+                        calibration: "CalibrationLibrary|None" = None) -> None:
+        # (exposure [s], gain) steps on a running camera: each step's controls are sent as soon as the
+        # previous step's frame arrives, so the sensor settles while that frame is being written
+        controls_for = lambda step: {"ExposureTime": round(step[0]*1e6), "AnalogueGain": step[1]}
+        self.set_controls(controls_for(steps[0]))
+        self.start()
+        for i, (exposure, gain) in enumerate(steps):
+            filename = filename_fmt.format(exposure=exposure, gain=gain, index=i)
+            timing = self.frame_timing(filename)
+            with timing.stage("settle"):
+                request = self.settled_request(round(exposure*1e6), gain, max_frames)
+            if i+1 < len(steps):
+                self.set_controls(controls_for(steps[i+1]))
+            array, meta = self.capture_raw_array(metadata=True, timing=timing, request=request, crop=True)
+            hdu = self.build_hdu(array, meta, crop=False, checksum=self.checksum_mode == "inline", timing=timing)
+            if calibration is not None:
+                with timing.stage("calibrate"):
+                    hdu = calibration.calibrate_hdu(hdu)
+            self.write_fits(hdu, filename, timing)
+            timing.finish()
+            print(f"Captured {filename} ({i+1}/{len(steps)})")
+        return
+
+    @property
+    def camera_executor(self) -> ThreadPoolExecutor:
+        # the async API runs all blocking libcamera calls on this one thread, in submission order
+        if self._camera_executor is None:
+            self._camera_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camera")
+        return self._camera_executor
+
+    async def capture_request_async(self, timing=NO_TIMING):
+        # starts the camera if needed; if the awaiting task is cancelled, the request is released
+        # as soon as it completes (the blocking wait itself can't be interrupted)
+        loop = asyncio.get_running_loop()
+        if not self.started:
+            await loop.run_in_executor(self.camera_executor, self.start)
+        future = loop.run_in_executor(self.camera_executor, self.capture_request)
+        try:
+            with timing.stage("request_wait"):
+                return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: done.cancelled() or done.exception() or done.result().release())
+            raise
+
+    async def capture_hdu_async(self, crop=True, timing=NO_TIMING) -> fits.PrimaryHDU:
+        loop = asyncio.get_running_loop()
+        if not self.started:
+            await loop.run_in_executor(self.camera_executor, self.start)
+        # acquire, copy and release as one job: with buffer_count=1, another task's capture_request
+        # queued in between would block the camera thread waiting for the buffer this one holds.
+        # A job already running when the task is cancelled still releases its request; a queued one
+        # never acquires one.
+        array, meta = await loop.run_in_executor(self.camera_executor, partial(self.capture_raw_array, metadata=True,
+                                                                               timing=timing, crop=crop))
+        return await loop.run_in_executor(None, partial(self.build_hdu, array, meta, crop=False,
+                                                        checksum=self.checksum_mode == "inline", timing=timing))
+
+    async def capture_fits_async(self, filename: str, calibration: "CalibrationLibrary|None" = None) -> None:
+        timing = self.frame_timing(filename)
+        hdu = await self.capture_hdu_async(timing=timing)
+        loop = asyncio.get_running_loop()
+        if calibration is not None:
+            with timing.stage("calibrate"):
+                hdu = await loop.run_in_executor(None, calibration.calibrate_hdu, hdu)
+        await loop.run_in_executor(None, self.write_fits, hdu, filename, timing)
+        timing.finish()
+        return
+
+    async def capture_sequence_async(self, number: "int|None" = None, crop=True):
+        # async iterator over HDUs (indefinitely if `number` is None); the next frame is already being
+        # captured while the caller handles the current one. Use contextlib.aclosing (or aclose) when
+        # leaving the loop early, so the frame in flight is released straight away.
+        async def capture(timing: "FrameTiming|NoTiming") -> fits.PrimaryHDU:
+            hdu = await self.capture_hdu_async(crop, timing)
+            timing.finish()
+            return hdu
+        def next_frame(i: int) -> "asyncio.Task|None":
+            if number is not None and i >= number:
+                return None
+            return asyncio.ensure_future(capture(self.frame_timing(f"sequence[{i}]")))
+        pending = next_frame(0)
+        try:
+            for i in itertools.count(1):
+                if pending is None:
+                    return
+                hdu = await pending
+                pending = next_frame(i)
+                yield hdu
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def close(self) -> None:
+        if self.frame_server is not None:
+            self.frame_server.close()
+        if self.previews is not None:
+            self.previews.close()
+            print(self.previews.report())
+        if self.catalog is not None:
+            self.catalog.close()
+        if self._checksum_filler is not None:
+            self._checksum_filler.stop()
+            print(f"Filled in checksums of {self._checksum_filler.filled} file(s)")
+        if self._camera_executor is not None:
+            self._camera_executor.shutdown()
+        self.housekeeping.stop()
+        super().close()
+
+    def start_and_capture_fits(self, filename: str, calibration: "CalibrationLibrary|None" = None) -> None:
         self.start()
         # throwaway = self.capture_metadata()
         # throwaway.pop("ColourCorrectionMatrix")
         # throwaway["SensorTimestamp"] = sensortime_to_datetime(throwaway["SensorTimestamp"])
         # print("Initial metadata:", throwaway)
-        self.capture_fits(filename)
+        self.capture_fits(filename, calibration)
         return
 
 
-if __name__ == "__main__":
-    print(f"Execution start: {dt.datetime.utcnow()} UTC")
-    args = parser.parse_args()
-
-    hqcam = PiHQCamera(gain=args.gain)
-    print("LIBCAMERA_RPI_TUNING_FILE:", os.environ.get("LIBCAMERA_RPI_TUNING_FILE", "<not found>"))
+def apply_args(hqcam: PiHQCamera, args: argparse.Namespace) -> None:
+    # per-run settings from the command line; sets everything, so a camera kept open between runs
+    # (see capture_daemon.py) doesn't carry settings over
+    if args.lucky is not None and args.lucky < 1:
+        parser.error("--lucky must keep at least 1 frame")
+    if args.calibration:
+        # these modes keep raw uint16 frames (cube/sequence files, straight request buffer copies,
+        # lucky-imaging slots) or build masters, which must not be calibrated themselves
+        raw_modes = [option for option, value in (("--lucky", args.lucky is not None), ("--stack", args.stack),
+                                                  ("--sequence", args.sequence), ("--direct", args.direct)) if value]
+        if raw_modes:
+            parser.error(f"--calibration is not supported with {raw_modes[0]}")
     hqcam.exposure = args.exposure
-    print("Configuration:")
-    for kw, val in hqcam.configuration.items():
-        print(f"  - {kw}: {val}")
+    hqcam.controls.AnalogueGain = args.gain
+    hqcam.set_roi(args.roi)
+    hqcam.superpixel = args.superpixel
+    hqcam.checksum_mode = args.checksum
+    hqcam.frame_type = args.frame_type or "light"
+    if args.preview:
+        hqcam.previews = PreviewQueue(fmt=args.preview)
+    if args.catalog:
+        hqcam.catalog = FrameCatalog(args.catalog)
+    if args.timing:
+        hqcam.timer = StageTimer(args.timing, platform=hqcam.platform.name)
 
-    if args.number==1:
-        hqcam.start_and_capture_fits(args.out_file)
+def run_capture(hqcam: PiHQCamera, args: argparse.Namespace, calibration: "CalibrationLibrary|None" = None) -> None:
+    # starts the camera and captures what `args` asks for; the caller stops it
+    hqcam.start()
+    if args.lucky is not None:
+        selector = hqcam.capture_lucky(args.out_file, args.number, args.lucky, metric=args.metric)
+        print(f"Kept {len(selector.selected)} of {selector.count} frames in {args.out_file}")
+    elif args.stack:
+        stacker = hqcam.capture_stack(args.number, FrameStacker(method=args.stack, frame_type=args.frame_type))
+        stacker.master_hdu().writeto(args.out_file, overwrite=True)
+        stacker.close()
+    elif args.sequence:
+        hqcam.capture_fits_cube(args.out_file, args.number, mode=args.sequence)
+    elif args.direct:
+        for i in range(args.number):
+            hqcam.capture_fits_direct(args.out_file.format(i))
+            print(f"Captured {args.out_file.format(i)}")
+    elif args.writers > 0:
+        # frames are cropped on capture; compressed and calibrated HDUs get their own checksums
+        def build_hdu(array: np.ndarray, meta: dict, timing=NO_TIMING) -> fits.PrimaryHDU:
+            hdu = hqcam.build_hdu(array, meta, crop=False, timing=timing,
+                                  checksum=args.checksum == "inline" and not args.compress and calibration is None)
+            if calibration is not None:
+                with timing.stage("calibrate"):
+                    hdu = calibration.calibrate_hdu(hdu)
+            return hdu
+        with FITSWriterQueue(build_hdu, workers=args.writers, max_frames=args.queue_frames, max_mbytes=args.queue_mb,
+                             block=not args.drop, compression=args.compress, write_hdu=hqcam.write_fits,
+                             file_written=hqcam.file_written, checksum=args.checksum != "off") as writer:
+            hqcam.capture_fits_sequence(args.out_file, args.number, writer)
+    elif args.number==1:
+        hqcam.capture_fits(args.out_file, calibration)
     else:
-        hqcam.start()
         # throwaway = hqcam.capture_metadata()
         # throwaway.pop("ColourCorrectionMatrix")
         # print(f"\nInitial metadata:\n{throwaway}\n")
         for i in range(args.number):
-            hqcam.capture_fits(args.out_file.format(i))
+            hqcam.capture_fits(args.out_file.format(i), calibration)
             print(f"Captured {args.out_file.format(i)}")
+
+def end_run(hqcam: PiHQCamera, args: argparse.Namespace) -> None:
+    # reports on and releases what apply_args set up
+    if hqcam.previews is not None:
+        hqcam.previews.close()
+        print(hqcam.previews.report())
+        hqcam.previews = None
+    if hqcam.catalog is not None:
+        hqcam.catalog.close()
+        hqcam.catalog = None
+    if hqcam.timer is not None:
+        print(hqcam.timer.report())
+        hqcam.timer.close()
+        hqcam.timer = None
+    if args.housekeeping:
+        hqcam.housekeeping.save(args.housekeeping)
+
+
+if __name__ == "__main__":
+    print(f"Execution start: {dt.datetime.utcnow()} UTC")
+    args = parser.parse_args()
+
+    if args.compress and args.writers < 1:
+        parser.error("--compress requires -w/--writers")
+    hqcam = PiHQCamera(gain=args.gain, binning=args.binning, superpixel=args.superpixel, packed=args.packed)
+    calibration = CalibrationLibrary(args.calibration) if args.calibration else None
+    print("LIBCAMERA_RPI_TUNING_FILE:", os.environ.get("LIBCAMERA_RPI_TUNING_FILE", "<not found>"))
+    apply_args(hqcam, args)
+    print("Configuration:")
+    for kw, val in hqcam.configuration.items():
+        print(f"  - {kw}: {val}")
+    if args.serve:
+        hqcam.serve_frames(args.serve)
+    run_capture(hqcam, args, calibration)
     hqcam.stop()
+    end_run(hqcam, args)
     hqcam.close()
@@ -0,0 +1,89 @@
+import os
+import csv
+import glob
+import time
+import argparse
+import warnings
+import functools
+import numpy as np
+from astropy.table import Table
+from concurrent.futures import ProcessPoolExecutor
+from catalog import COLUMNS, frame_row
+from scipy.optimize import OptimizeWarning
+from image_stats import file_statistics
+
+TABLE_FORMATS = {".csv": "csv", ".fits": "fits", ".fit": "fits", ".parquet": "parquet"}
+
+parser = argparse.ArgumentParser(description="headless image_stats.py over many FITS files in parallel, "
+                                             "summarised in one table with a row per file")
+parser.add_argument("paths", nargs="+", type=str, help="FITS files, directories (searched recursively for *.fits) or glob patterns")
+parser.add_argument("-o", "--output", metavar="<file>", type=str, default="stats.csv", help="summary table; the extension picks the format: .csv, .fits or .parquet (requires pyarrow)")
+parser.add_argument("-w", "--workers", metavar="<#>", type=int, default=os.cpu_count(), help="worker processes")
+parser.add_argument("--hdu", metavar="<#>", type=int, default=None, help="HDU to analyse (default: the first one with an image)")
+parser.add_argument("--chunk-rows", metavar="<#>", type=int, default=256, help="rows read from the memory map at a time")
+parser.add_argument("--no-fit", action="store_true", help="skip the bimodal noise fit")
+
+def find_files(paths: "list[str]") -> "list[str]":
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, "**", "*.fits"), recursive=True)))
+        elif glob.has_magic(path):
+            filenames.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            filenames.append(path)
+    return list(dict.fromkeys(os.path.abspath(filename) for filename in filenames))
+
+def stats_row(filename: str, hdu: "int|None" = None, chunk_rows: int = 256, fit: bool = True) -> "dict|str":
+    # header columns as in catalog.py followed by file_statistics, or why the file could not be read
+    # (for worker processes)
+    warnings.simplefilter("ignore", OptimizeWarning) # one per poorly constrained fit, on every worker's stderr
+    try:
+        row = dict(zip(COLUMNS, frame_row(filename)))
+        row.update(file_statistics(filename, hdu, chunk_rows, fit))
+        return row
+    except (OSError, ValueError, KeyError, IndexError, EOFError, UnicodeDecodeError) as err:
+        return f"{type(err).__name__}: {err}"
+
+def table_column(values: list) -> np.ndarray:
+    # missing header values become "" in text columns and NaN in numeric ones
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, str) for value in present):
+        return np.array(["" if value is None else value for value in values])
+    if len(present) < len(values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return np.array(values)
+
+def write_table(rows: "list[dict]", filename: str) -> None:
+    fmt = TABLE_FORMATS[os.path.splitext(filename)[1].lower()]
+    columns = list(dict.fromkeys(column for row in rows for column in row)) # fit columns may be missing
+    if fmt == "csv": # plain csv module: no astropy metadata header lines
+        with open(filename, "w", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+    table = Table([table_column([row.get(column) for row in rows]) for column in columns], names=columns)
+    table.write(filename, format=fmt, overwrite=True)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if os.path.splitext(args.output)[1].lower() not in TABLE_FORMATS:
+        parser.error(f"unknown table format {args.output!r}: use one of {', '.join(TABLE_FORMATS)}")
+    filenames = find_files(args.paths)
+    start, rows = time.monotonic(), []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        task = functools.partial(stats_row, hdu=args.hdu, chunk_rows=args.chunk_rows, fit=not args.no_fit)
+        results = pool.map(task, filenames, chunksize=4)
+        for filename, row in zip(filenames, results):
+            if isinstance(row, str):
+                print(f"Skipping {filename}: {row}")
+            else:
+                rows.append(row)
+    rows.sort(key=lambda row: (row["date_end"] or "", row["path"]))
+    if rows:
+        write_table(rows, args.output)
+    elapsed = time.monotonic()-start
+    print(f"{len(rows)}/{len(filenames)} file(s) -> {args.output} in {elapsed:.1f} s "
+          f"({elapsed/max(len(rows), 1):.3f} s per file with {args.workers} workers)")
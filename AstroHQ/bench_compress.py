@@ -0,0 +1,75 @@
+import os
+import time
+import argparse
+import resource
+from functools import partial
+import numpy as np
+from astropy.io import fits
+from pipeline import FITSWriterQueue
+from fits_writer import COMPRESSION_TYPES, open_unscaled, read_image
+
+parser = argparse.ArgumentParser(description="compare uncompressed and tile-compressed FITS writing")
+parser.add_argument("files", nargs="*", type=str, help="AstroHQ FITS frames to use instead of synthetic dark/sky frames")
+parser.add_argument("-n", "--frames", metavar="<#>", type=int, default=8, help="frames to write per mode and frame kind")
+parser.add_argument("-w", "--writers", metavar="<#>", type=int, default=os.cpu_count(), help="writer threads/processes")
+parser.add_argument("-d", "--out-dir", metavar="<path>", type=str, default=".", help="directory to write test files to")
+parser.add_argument("-c", "--compression", nargs="+", choices=COMPRESSION_TYPES, default=["RICE_1"],
+                    help="compression types to compare with plain writeto")
+
+def synthetic_frame(kind: str, shape=(3040, 4056), seed=0) -> np.ndarray:
+    # 12-bit values left-aligned in 16 bits, like capture_raw_array: black level 256 DN, ~3 DN read
+    # noise and a sprinkling of hot pixels; "sky" adds a gradient, Poisson noise and some stars
+    rng = np.random.default_rng(seed)
+    frame = rng.normal(256, 3, size=shape).astype(np.float32)
+    hot = rng.integers(0, frame.size, size=frame.size//5000)
+    frame.flat[hot] += rng.exponential(200, size=hot.size)
+    if kind == "sky":
+        rows, cols = np.ogrid[:shape[0], :shape[1]]
+        background = 150 + 50*cols/shape[1] + 20*rows/shape[0]
+        frame += rng.poisson(background).astype(np.float32)
+        for y, x, flux in zip(rng.integers(8, shape[0]-8, 300), rng.integers(8, shape[1]-8, 300), rng.pareto(1.5, 300)*2000):
+            yy, xx = np.ogrid[y-7:y+8, x-7:x+8]
+            frame[y-7:y+8, x-7:x+8] += flux*np.exp(-((yy-y)**2+(xx-x)**2)/(2*1.5**2))/(2*np.pi*1.5**2)
+    return (np.clip(frame, 0, 4095).astype(np.uint16) << 4)
+
+def build_hdu(array: np.ndarray, meta: dict, checksum=True, timing=None) -> fits.PrimaryHDU:
+    hdu = fits.PrimaryHDU(data=array)
+    if checksum: # as in capture_hdu; compressed files get their checksums on write
+        hdu.add_checksum()
+    return hdu
+
+def run_mode(frames: "list[np.ndarray]", compression: "str|None", args: argparse.Namespace) -> dict:
+    usage_before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    t0 = time.perf_counter()
+    with FITSWriterQueue(partial(build_hdu, checksum=compression is None), workers=args.writers,
+                         max_frames=2*args.writers, max_mbytes=1024, compression=compression) as writer:
+        for i in range(args.frames):
+            writer.submit(os.path.join(args.out_dir, f"bench_compress_{i}.fits"), frames[i % len(frames)], {})
+        writer.join()
+    wall = time.perf_counter()-t0 # includes pool shutdown, so child CPU time has been collected
+    usage_after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    cpu = sum((after.ru_utime+after.ru_stime)-(before.ru_utime+before.ru_stime)
+              for before, after in zip(usage_before, usage_after))
+    bytes_in = sum(frames[i % len(frames)].nbytes for i in range(args.frames))
+    bytes_out = sum(os.path.getsize(os.path.join(args.out_dir, f"bench_compress_{i}.fits")) for i in range(args.frames))
+    for i in range(args.frames):
+        os.remove(os.path.join(args.out_dir, f"bench_compress_{i}.fits"))
+    return {"fps": args.frames/wall, "MBps": bytes_in/wall/1e6, "cores": cpu/wall, "ratio": bytes_in/bytes_out}
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.files:
+        loaded = []
+        for filename in args.files:
+            with open_unscaled(filename) as hdul:
+                loaded.append(read_image(hdul[0]))
+        frame_sets = {"files": loaded}
+    else:
+        frame_sets = {kind: [synthetic_frame(kind, seed=seed) for seed in range(2)] for kind in ("dark", "sky")}
+    print(f"{args.frames} frames per mode, {args.writers} writers")
+    print(f"{'frames':>6} {'mode':>8} {'frames/s':>9} {'MB/s':>7} {'CPU cores':>10} {'ratio':>6}")
+    for kind, frames in frame_sets.items():
+        for compression in [None]+args.compression:
+            result = run_mode(frames, compression, args)
+            print(f"{kind:>6} {compression or 'writeto':>8} {result['fps']:9.2f} {result['MBps']:7.1f} "
+                  f"{result['cores']:10.2f} {result['ratio']:6.2f}")
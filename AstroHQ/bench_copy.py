@@ -0,0 +1,66 @@
+import os
+import time
+import argparse
+import resource
+import tracemalloc
+import multiprocessing as mp
+import numpy as np
+from astropy.io import fits
+from fits_writer import write_uint16_image
+
+parser = argparse.ArgumentParser(description="compare the legacy and direct raw-to-FITS write paths")
+parser.add_argument("-n", "--frames", metavar="<#>", type=int, default=5, help="frames to write per path")
+parser.add_argument("-d", "--out-dir", metavar="<path>", type=str, default=".", help="directory to write test files to")
+parser.add_argument("--size", metavar=("<width>", "<height>"), type=int, nargs=2, default=(4056, 3040), help="raw frame size")
+parser.add_argument("--stride", metavar="<bytes>", type=int, default=8128, help="raw buffer row stride")
+
+def fake_request_buffer(width: int, height: int, stride: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    rows = np.zeros((height, stride//2), dtype="<u2")
+    for i in range(0, height, 64): # in blocks, so generating the frame doesn't set the peak RSS
+        rows[i:i+64, :width] = rng.integers(3840, 4352, size=rows[i:i+64, :width].shape, dtype="<u2") # 12 bits, left-aligned
+    return rows.view(np.uint8).reshape(-1)
+
+def legacy_write(buffer: np.ndarray, filename: str, width: int, height: int, stride: int) -> int:
+    # both paths return the bytes copied into the file (i.e. the page cache)
+    array = np.array(buffer).reshape(height, stride).view("<u2") # request.make_array("raw")
+    hdu = fits.PrimaryHDU(data=array[:height, :width][::-1, :].astype(np.uint16))
+    hdu.add_checksum()
+    hdu.writeto(filename, overwrite=True)
+    return hdu.data.nbytes
+
+def direct_write(buffer: np.ndarray, filename: str, width: int, height: int, stride: int) -> int:
+    array = buffer[:height*stride].reshape(height, stride).view("<u2")
+    return write_uint16_image(filename, array[:height, :width][::-1, :])
+
+def run_path(path: str, args: argparse.Namespace, results: mp.Queue) -> None:
+    width, height = args.size
+    buffer = fake_request_buffer(width, height, args.stride)
+    write = {"legacy": legacy_write, "direct": direct_write}[path]
+    filename = os.path.join(args.out_dir, f"bench_copy_{path}.fits")
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB on Linux
+    durations, peaks, written = [], [], []
+    for _ in range(args.frames):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        written.append(write(buffer, filename, width, height, args.stride))
+        durations.append(time.perf_counter()-t0)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.remove(filename)
+    results.put((path, width*height*2, np.median(durations), np.median(peaks), np.median(written), (peak_rss-baseline_rss)*1024))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    ctx = mp.get_context("spawn") # fresh interpreter per path so peak RSS isn't shared
+    results = ctx.Queue()
+    print(f"{'path':>8} {'frame MB':>9} {'s/frame':>8} {'allocated MB':>13} {'copies':>7} {'peak RSS +MB':>13}")
+    for path in ["legacy", "direct"]:
+        proc = ctx.Process(target=run_path, args=(path, args, results))
+        proc.start()
+        name, frame_bytes, duration, allocated, written, rss = results.get()
+        proc.join()
+        # frame copies: traced heap allocations (intermediate arrays) plus the copy into the file itself
+        copies = (allocated+written)/frame_bytes
+        print(f"{name:>8} {frame_bytes/1e6:9.1f} {duration:8.3f} {allocated/1e6:13.1f} {copies:7.1f} {rss/1e6:13.1f}")
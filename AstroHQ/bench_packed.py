@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from bench_sim import SIM_DIR
+
+parser = argparse.ArgumentParser(description="compare request hold time and peak memory of unpacked and CSI-2 packed raw capture "
+                                             "(on the simulated camera in sim/ unless --hardware is given)")
+parser.add_argument("-n", "--frames", metavar="<#>", type=int, default=10, help="frames to capture per mode")
+parser.add_argument("-b", "--binning", type=int, choices=[1, 2], default=1, help="sensor binning")
+parser.add_argument("--roi", metavar=("<x>", "<y>", "<w>", "<h>"), type=int, nargs=4, default=None, help="ScalerCrop region of interest")
+parser.add_argument("--hardware", action="store_true", help="use the installed picamera2 and a real camera")
+
+def run_mode(packed: bool, args: argparse.Namespace) -> dict:
+    from astro_hq import PiHQCamera
+    from timing import StageTimer
+    camera = PiHQCamera(binning=args.binning, packed=packed)
+    if args.roi:
+        camera.set_roi(args.roi)
+    camera.exposure = 0.001
+    camera.timer = StageTimer()
+    camera.start()
+    camera.capture_raw_array(crop=True) # settle, and warm up any lazy allocations
+    peaks = []
+    for i in range(args.frames):
+        timing = camera.frame_timing(f"{'packed' if packed else 'unpacked'}[{i}]")
+        tracemalloc.start()
+        array = camera.capture_raw_array(timing=timing, crop=True)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        timing.finish()
+        del array
+    camera.stop()
+    camera.close()
+    summary = camera.timer.summary()
+    stage = lambda name, key="p50": summary[name][key]*1e3 if name in summary else 0.
+    return {"hold": stage("extract") + stage("release"), "hold_max": stage("extract", "max"), "unpack": stage("unpack"),
+            "peak_mb": max(peaks)/1e6, "format": camera.raw_format, "stride": camera.configuration["raw"]["stride"]}
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not args.hardware:
+        workdir = tempfile.mkdtemp(prefix="bench_packed_")
+        with open(os.path.join(workdir, "dpc_enable"), "w") as dpc:
+            dpc.write("0\n")
+        os.environ.update({"IMX477_DPC_PARAMETER": os.path.join(workdir, "dpc_enable"), "PICAMERA2_SIM_FPS": "100",
+                           "PICAMERA2_SIM_READOUT_MS": "5",
+                           "LIBCAMERA_RPI_TUNING_FILE": os.path.join(workdir, "imx477_scientific.json")})
+        sys.path.insert(0, SIM_DIR)
+    results = {packed: run_mode(packed, args) for packed in (False, True)}
+    print(f"\n{args.frames} frames per mode, binning {args.binning}, ROI {args.roi or 'full frame'}")
+    print(f"{'format':>14} {'stride':>7} {'hold p50':>9} {'hold max':>9} {'unpack p50':>11} {'peak MB':>8}  [ms]")
+    for result in results.values():
+        print(f"{result['format']:>14} {result['stride']:7d} {result['hold']:9.2f} {result['hold_max']:9.2f} "
+              f"{result['unpack']:11.2f} {result['peak_mb']:8.1f}")
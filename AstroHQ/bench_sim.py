@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import runpy
+import argparse
+import resource
+import tempfile
+
+SCRIPTS = ("astro_hq.py", "bracket.py")
+SIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim")
+
+parser = argparse.ArgumentParser(description="run AstroHQ scripts against the simulated camera in sim/ and time them",
+                                 epilog="arguments after the script name are passed to it, e.g. "
+                                        "bench_sim.py astro_hq.py -n 8 -t 0.1 -w 2 -o frame_{}.fits")
+parser.add_argument("--fps", metavar="<Hz>", type=float, default=10., help="max. simulated frame rate")
+parser.add_argument("--readout-ms", metavar="<ms>", type=float, default=50., help="simulated readout latency")
+parser.add_argument("--time-scale", metavar="<x>", type=float, default=1., help="real seconds per simulated second")
+parser.add_argument("--platform", choices=["VC4", "PISP"], default="VC4", help="simulated platform")
+parser.add_argument("--dpc", choices=["0", "1"], default="0", help="simulated on-sensor DPC parameter")
+parser.add_argument("-C", "--directory", metavar="<dir>", type=str, default=None, help="run in this directory (default: a temporary one)")
+parser.add_argument("script", choices=SCRIPTS, help="script to run")
+parser.add_argument("script_args", nargs=argparse.REMAINDER, help="arguments for the script")
+
+def simulated_environment(args: argparse.Namespace, workdir: str) -> dict:
+    dpc_file = os.path.join(workdir, "dpc_enable")
+    with open(dpc_file, "w") as dpc:
+        dpc.write(args.dpc+"\n")
+    return {"PICAMERA2_SIM_FPS": str(args.fps), "PICAMERA2_SIM_READOUT_MS": str(args.readout_ms),
+            "PICAMERA2_SIM_TIME_SCALE": str(args.time_scale), "PICAMERA2_SIM_PLATFORM": args.platform,
+            "IMX477_DPC_PARAMETER": dpc_file,
+            "LIBCAMERA_RPI_TUNING_FILE": os.path.join(workdir, "imx477_scientific.json")} # falls back to built-in
+
+def count_frames(directory: str) -> "tuple[int, int]":
+    files = [entry for entry in os.scandir(directory) if entry.name.endswith((".fits", ".fits.fz"))]
+    return len(files), sum(entry.stat().st_size for entry in files)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    workdir = args.directory or tempfile.mkdtemp(prefix="bench_sim_")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.update(simulated_environment(args, workdir))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.script)
+    sys.path[:0] = [SIM_DIR, os.path.dirname(script)] # simulated picamera2/libcamera shadow any installed ones
+    sys.argv = [script] + args.script_args
+    os.chdir(workdir)
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    runpy.run_path(script, run_name="__main__")
+    wall = time.perf_counter()-t0
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_after.ru_utime+usage_after.ru_stime)-(usage_before.ru_utime+usage_before.ru_stime)
+    frames, nbytes = count_frames(workdir)
+    print(f"\n{args.script} {' '.join(args.script_args)} on simulated {args.platform} "
+          f"({args.fps:g} fps, {args.readout_ms:g} ms readout, time scale {args.time_scale:g})")
+    print(f"  wall {wall:.2f} s, CPU {cpu:.2f} s ({cpu/wall:.2f} cores), peak RSS {usage_after.ru_maxrss/1024:.0f} MiB")
+    print(f"  {frames} FITS files ({nbytes/1e6:.1f} MB) in {workdir}, {nbytes/1e6/wall:.1f} MB/s")
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import numpy as np
 from astro_hq import PiHQCamera
 
@@ -6,15 +7,32 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--start", type=float, default=1.0)
 parser.add_argument("--stop", type=float, default=31.0)
 parser.add_argument("-N", type=int, default=16)
-parser.add_argument("--gain", type=float, default=1.0)
+parser.add_argument("--gain", type=float, nargs="+", default=[1.0], help="analog gain setting(s); each exposure is taken at every gain")
+parser.add_argument("--max-discard", metavar="<#>", type=int, default=10, help="max. frames to wait for new settings to take effect")
+parser.add_argument("--pairs", action="store_true", help="take two frames per step, e.g. for photon_transfer.py")
+parser.add_argument("--restart", action="store_true", help="stop and restart the camera for every step instead of changing settings in flight")
+
+def bracket_steps(args: argparse.Namespace) -> "tuple[list[tuple[float, float]], str]":
+    # (exposure, gain) steps and the file name format for capture_bracket; pairs get consecutive
+    # steps and the step index in their file names
+    steps = list(itertools.product(np.linspace(args.start, args.stop, args.N, endpoint=True), args.gain))
+    if args.pairs:
+        return [step for step in steps for _ in range(2)], "bracket_{exposure:05.2f}s_gain{gain}_{index:03d}.fits"
+    return steps, "bracket_{exposure:05.2f}s_gain{gain}.fits"
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    camera = PiHQCamera(gain=args.gain)
+    camera = PiHQCamera(gain=args.gain[0])
+    steps, filename_fmt = bracket_steps(args)
 
-    for exp_time in np.linspace(args.start, args.stop, args.N, endpoint=True):
-        camera.exposure = exp_time
-        camera.start_and_capture_fits(f"bracket_{exp_time:05.2f}s_gain{args.gain}.fits")
+    if args.restart:
+        for i, (exp_time, gain) in enumerate(steps):
+            camera.exposure = exp_time
+            camera.controls.AnalogueGain = gain
+            camera.start_and_capture_fits(filename_fmt.format(exposure=exp_time, gain=gain, index=i))
+            camera.stop()
+    else:
+        camera.capture_bracket(steps, filename_fmt, max_frames=args.max_discard)
         camera.stop()
 
     camera.close()
@@ -0,0 +1,157 @@
+import os
+import glob
+import argparse
+import functools
+import numpy as np
+from astropy.io import fits
+from fits_writer import open_unscaled, read_image
+
+parser = argparse.ArgumentParser(description="apply master bias/dark/flat frames to AstroHQ frames")
+parser.add_argument("files", nargs="+", type=str, help="FITS frames to calibrate")
+parser.add_argument("-l", "--library", metavar="<dir>", type=str, required=True, help="directory of master frames")
+parser.add_argument("-o", "--out-dir", metavar="<dir>", type=str, default=".", help="directory for calibrated frames")
+parser.add_argument("--suffix", metavar="<str>", type=str, default="_cal", help="appended to calibrated file names")
+parser.add_argument("--cache", metavar="<#>", type=int, default=4, help="number of master frames to keep in memory")
+
+MASTER_TYPES = ("bias", "dark", "flat")
+
+def master_type(header: fits.Header, filename: str = "") -> "str|None":
+    # from IMAGETYP (as written by stacking.py), falling back on the file name; "darkmodel" for
+    # per-pixel dark models from dark_model.py
+    if header.get("DARKMODL"):
+        return "darkmodel"
+    for text in (str(header.get("IMAGETYP", "")), os.path.basename(filename)):
+        for kind in MASTER_TYPES:
+            if kind in text.lower():
+                return kind
+    return None
+
+class CalibrationLibrary:
+    # Index of master frames by GAIN/EXPTIME/CCD-TEMP/BAYERPAT (read from headers only). Masters are
+    # loaded lazily into an LRU cache, as are the derived dark-current and normalized flat frames.
+    # A dark model (dark_model.py) stands in for darks that don't match the exposure time.
+
+    def __init__(self, directory: "str|None" = None, cache_size: int = 4) -> None:
+        self.masters = []
+        self.load = functools.lru_cache(maxsize=cache_size)(self._load)
+        if directory is not None:
+            self.scan(directory)
+
+    def add(self, filename: str) -> dict:
+        header = fits.getheader(filename)
+        kind = master_type(header, filename)
+        if kind is None:
+            raise ValueError(f"Cannot tell what kind of master frame {filename} is (no IMAGETYP)")
+        entry = {"path": filename, "type": kind, "shape": (header["NAXIS2"], header["NAXIS1"]),
+                 "GAIN": header.get("GAIN"), "EXPTIME": header.get("EXPTIME"),
+                 "CCD-TEMP": header.get("CCD-TEMP"), "BAYERPAT": header.get("BAYERPAT"), "DARKMODL": header.get("DARKMODL")}
+        self.masters.append(entry)
+        return entry
+
+    def scan(self, directory: str, pattern: str = "*.fits") -> None:
+        for filename in sorted(glob.glob(os.path.join(directory, pattern))):
+            try:
+                self.add(filename)
+            except (ValueError, KeyError, OSError) as err:
+                print(f"Skipping {filename}: {err}")
+
+    def _load(self, path: str, minus: "str|None" = None, normalize: bool = False, ext=0) -> np.ndarray:
+        with open_unscaled(path) as hdul:
+            master = read_image(hdul[ext]).astype(np.float32, copy=False)
+        if minus is not None:
+            master -= self.load(minus)
+        if normalize:
+            master /= np.median(master[::4, ::4]) # decimated median is plenty for normalization
+        master.flags.writeable = False # shared through the cache
+        return master
+
+    def select(self, kind: str, header: fits.Header, shape: tuple) -> "dict|None":
+        exptime, temp = header.get("EXPTIME"), header.get("CCD-TEMP")
+        candidates = [entry for entry in self.masters if entry["type"] == kind and entry["shape"] == tuple(shape)
+                      and entry["BAYERPAT"] == header.get("BAYERPAT")
+                      and (kind == "flat" or entry["GAIN"] is None or header.get("GAIN") is None
+                           or np.isclose(entry["GAIN"], header["GAIN"]))]
+        if not candidates:
+            return None
+        def distance(entry: dict) -> tuple:
+            exptime_mismatch = kind == "dark" and not (entry["EXPTIME"] is not None and exptime is not None
+                                                       and np.isclose(entry["EXPTIME"], exptime))
+            temp_diff = abs(entry["CCD-TEMP"]-temp) if None not in (entry["CCD-TEMP"], temp) else np.inf
+            exptime_diff = abs(entry["EXPTIME"]-exptime) if None not in (entry["EXPTIME"], exptime) else np.inf
+            return (exptime_mismatch, temp_diff, exptime_diff)
+        return min(candidates, key=distance)
+
+    def apply(self, frame: np.ndarray, header: fits.Header, out: "np.ndarray|None" = None,
+              chunk_rows: int = 256) -> "tuple[np.ndarray, fits.Header]":
+        # (frame - bias - dark*t/t_dark) / flat into `out` (float32, may be `frame` itself);
+        # returns the calibrated array and the cards describing what was applied
+        if out is None:
+            out = np.empty(frame.shape, dtype=np.float32)
+        if out is not frame:
+            np.copyto(out, frame, casting="unsafe")
+        cards = fits.Header()
+        bias, dark, flat = (self.select(kind, header, frame.shape) for kind in MASTER_TYPES)
+        scaled = dark is not None and dark["EXPTIME"] is not None and header.get("EXPTIME") is not None \
+                 and not np.isclose(dark["EXPTIME"], header["EXPTIME"])
+        model = None
+        if (dark is None or scaled) and header.get("EXPTIME") is not None:
+            model = self.select("darkmodel", header, frame.shape)
+        if model is not None: # offset + rate*t (+ quad*t^2) per pixel, bias included
+            exptime = header["EXPTIME"]
+            terms = [self.load(model["path"]), self.load(model["path"], ext="RATE")]
+            if model["DARKMODL"] == "QUADRATIC":
+                terms.append(self.load(model["path"], ext="QUAD"))
+            for start in range(0, out.shape[0], chunk_rows):
+                rows = slice(start, start+chunk_rows)
+                for power, term in enumerate(terms):
+                    out[rows] -= term[rows] if power == 0 else np.float32(exptime**power)*term[rows]
+            cards.set("CALDARK", os.path.basename(model["path"]), "dark synthesized from per-pixel dark model")
+        elif scaled:
+            if bias is None:
+                raise LookupError(f"No bias master to scale {dark['path']} to {header['EXPTIME']} s")
+            out -= self.load(bias["path"])
+            thermal, scale = self.load(dark["path"], minus=bias["path"]), header["EXPTIME"]/dark["EXPTIME"]
+            for start in range(0, out.shape[0], chunk_rows): # keeps the scaled-dark temporary small
+                rows = slice(start, start+chunk_rows)
+                out[rows] -= scale*thermal[rows]
+            cards.set("CALBIAS", os.path.basename(bias["path"]), "master bias subtracted")
+            cards.set("CALDARK", os.path.basename(dark["path"]), "master dark subtracted")
+            cards.set("DARKSCL", scale, "dark current scaled by exposure time ratio")
+        elif dark is not None: # matched dark already includes the bias level
+            out -= self.load(dark["path"])
+            cards.set("CALDARK", os.path.basename(dark["path"]), "master dark subtracted")
+        elif bias is not None:
+            out -= self.load(bias["path"])
+            cards.set("CALBIAS", os.path.basename(bias["path"]), "master bias subtracted")
+        if flat is not None:
+            out /= self.load(flat["path"], minus=None if bias is None else bias["path"], normalize=True)
+            cards.set("CALFLAT", os.path.basename(flat["path"]), "divided by normalized master flat")
+        return out, cards
+
+    def calibrate_hdu(self, hdu: "fits.PrimaryHDU|fits.ImageHDU") -> fits.PrimaryHDU:
+        data, cards = self.apply(hdu.data, hdu.header)
+        calibrated = fits.PrimaryHDU(data=data)
+        for card in hdu.header.cards:
+            if card.keyword not in calibrated.header and card.keyword not in ("BSCALE", "BZERO", "CHECKSUM", "DATASUM"):
+                calibrated.header.append(card)
+        calibrated.header.set("CAL-SEP", "-"*27 + " CALIBRATION " + "-"*28)
+        calibrated.header.extend(cards)
+        calibrated.header["BUNIT"] = "DN"
+        calibrated.add_checksum()
+        return calibrated
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    library = CalibrationLibrary(args.library, cache_size=args.cache)
+    print(f"Indexed {len(library.masters)} master frames in {args.library}")
+    for filename in args.files:
+        with open_unscaled(filename) as hdul:
+            hdu = fits.PrimaryHDU(data=read_image(hdul[0]), header=hdul[0].header)
+        calibrated = library.calibrate_hdu(hdu)
+        stem, ext = os.path.splitext(os.path.basename(filename))
+        out_file = os.path.join(args.out_dir, stem+args.suffix+ext)
+        calibrated.writeto(out_file, overwrite=True)
+        applied = [calibrated.header.get(keyword) for keyword in ("CALBIAS", "CALDARK", "CALFLAT")]
+        print(f"{filename} -> {out_file} ({', '.join(filter(None, applied)) or 'no masters matched'})")
+    print(library.load.cache_info())
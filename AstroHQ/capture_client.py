@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import socket
+import argparse
+
+# Thin client for capture_daemon.py: only the standard library, so it starts in milliseconds. Jobs
+# are one JSON line {"command", "args", "cwd"}; the daemon answers with {"output": text} lines while
+# the job runs and a final {"exit": status}.
+DEFAULT_SOCKET = os.environ.get("ASTROHQ_SOCKET", "/tmp/astrohq.sock")
+COMMANDS = ("astro_hq.py", "bracket.py", "status", "shutdown")
+
+parser = argparse.ArgumentParser(description="run astro_hq.py/bracket.py captures on a running capture_daemon.py, "
+                                             "e.g. capture_client.py astro_hq.py -t 30 -n 10 -o dark_{:03d}.fits")
+parser.add_argument("--socket", metavar="<path>", type=str, default=DEFAULT_SOCKET, help="daemon socket (default $ASTROHQ_SOCKET or /tmp/astrohq.sock)")
+parser.add_argument("command", choices=COMMANDS, help="script to run on the daemon's camera, or a daemon command")
+parser.add_argument("args", nargs=argparse.REMAINDER, help="arguments for the script, as on its own command line")
+
+def send_message(stream, message: dict) -> None:
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+def run_job(command: str, args: "list[str]" = (), socket_path: str = DEFAULT_SOCKET, output=sys.stdout) -> int:
+    # submits a job, relays its output as it arrives and returns its exit status
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        stream = connection.makefile("rwb")
+        send_message(stream, {"command": command, "args": list(args), "cwd": os.getcwd()})
+        for line in stream:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            output.write(message["output"])
+            output.flush()
+    raise ConnectionError("Capture daemon closed the connection before the job finished")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    try:
+        sys.exit(run_job(args.command, args.args, args.socket))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(f"No capture daemon listening on {args.socket} (start capture_daemon.py first)")
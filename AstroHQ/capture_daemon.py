@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import contextlib
+import traceback
+import astro_hq
+import bracket
+from astro_hq import PiHQCamera, apply_args, run_capture, end_run
+from calibration import CalibrationLibrary
+from capture_client import DEFAULT_SOCKET, send_message
+
+parser = argparse.ArgumentParser(description="keep the camera open and run capture jobs from capture_client.py, "
+                                             "so each job starts capturing without re-initialising everything")
+parser.add_argument("--socket", metavar="<path>", type=str, default=DEFAULT_SOCKET, help="Unix socket to listen on (default $ASTROHQ_SOCKET or /tmp/astrohq.sock)")
+parser.add_argument("-g", "--gain", metavar="<setting>", type=float, default=1., help="initial analog gain setting")
+parser.add_argument("--binning", type=int, choices=[1, 2], default=1, help="sensor mode for all jobs, as for astro_hq.py")
+parser.add_argument("--packed", action="store_true", help="capture CSI-2 packed raw for all jobs, as for astro_hq.py")
+parser.add_argument("--serve", metavar="<address>", type=str, default=None, help="publish frames of all jobs for quick-look (see streaming.py)")
+
+class JobOutput:
+    # file-like stand-in for stdout/stderr during a job, relaying everything (from any thread) to the
+    # client; output is dropped once the client has gone away, but the job carries on
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.connected = True
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            if self.connected and text:
+                try:
+                    send_message(self.stream, {"output": text})
+                except OSError:
+                    self.connected = False
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+class CaptureDaemon:
+    # Owns one PiHQCamera (constructed once, i.e. imports, tuning file and initial metadata only once)
+    # and runs jobs one at a time; the camera is only started while a job runs.
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.camera = PiHQCamera(gain=args.gain, binning=args.binning, packed=args.packed)
+        astro_hq.parser.prog, bracket.parser.prog = "astro_hq.py", "bracket.py" # for job error messages
+        self.binning, self.packed = args.binning, args.packed
+        if args.serve:
+            self.camera.serve_frames(args.serve)
+        self.started = time.time()
+        self.jobs = 0
+        self.running = True
+        self._calibration = {} # CalibrationLibrary by directory, kept between jobs
+
+    def calibration(self, directory: "str|None") -> "CalibrationLibrary|None":
+        if directory is None:
+            return None
+        directory = os.path.abspath(directory)
+        if directory not in self._calibration:
+            self._calibration[directory] = CalibrationLibrary(directory)
+        return self._calibration[directory]
+
+    def capture(self, argv: "list[str]") -> None:
+        args = astro_hq.parser.parse_args(argv)
+        if args.compress and args.writers < 1:
+            astro_hq.parser.error("--compress requires -w/--writers")
+        if (args.binning, args.packed) != (self.binning, self.packed):
+            astro_hq.parser.error(f"the daemon's camera uses --binning {self.binning}{' --packed' if self.packed else ''}; "
+                                  "restart capture_daemon.py to change the sensor mode")
+        if args.serve:
+            astro_hq.parser.error("--serve is set for all jobs on capture_daemon.py")
+        apply_args(self.camera, args)
+        try:
+            run_capture(self.camera, args, self.calibration(args.calibration))
+        finally:
+            self.camera.stop()
+            end_run(self.camera, args)
+
+    def bracket(self, argv: "list[str]") -> None:
+        args = bracket.parser.parse_args(argv)
+        if args.restart:
+            bracket.parser.error("--restart is not supported on the daemon")
+        apply_args(self.camera, astro_hq.parser.parse_args([])) # back to the defaults
+        steps, filename_fmt = bracket.bracket_steps(args)
+        try:
+            self.camera.capture_bracket(steps, filename_fmt, max_frames=args.max_discard)
+        finally:
+            self.camera.stop()
+
+    def status(self) -> None:
+        print(f"Capture daemon up {time.time()-self.started:.0f} s, {self.jobs} job(s) run, "
+              f"camera {self.camera.camera_properties['Model']} ({self.camera.raw_format} "
+              f"{self.camera.configuration['raw']['size'][0]}x{self.camera.configuration['raw']['size'][1]})")
+
+    def run_job(self, request: dict) -> int:
+        # returns the job's exit status, as the script would have exited with
+        command, argv = request["command"], request.get("args", [])
+        if command == "shutdown":
+            self.running = False
+            print("Capture daemon shutting down")
+            return 0
+        if command == "status":
+            self.status()
+            return 0
+        os.chdir(request.get("cwd", os.getcwd())) # relative paths as the client sees them
+        self.jobs += 1
+        try:
+            if command == "astro_hq.py":
+                self.capture(argv)
+            elif command == "bracket.py":
+                self.bracket(argv)
+            else:
+                raise ValueError(f"Unknown command {command!r}")
+        except SystemExit as exit: # argparse errors and --help
+            return exit.code if isinstance(exit.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
+
+    def handle(self, connection: socket.socket) -> None:
+        stream = connection.makefile("rwb")
+        try:
+            request = json.loads(stream.readline())
+        except ValueError as err:
+            print(f"Ignoring malformed job: {err}")
+            return
+        print(f"Job: {request.get('command')} {' '.join(request.get('args', []))}")
+        output = JobOutput(stream)
+        t0 = time.monotonic()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            status = self.run_job(request)
+        print(f"Job finished with status {status} in {time.monotonic()-t0:.2f} s")
+        if output.connected:
+            try:
+                send_message(stream, {"exit": status})
+            except OSError:
+                pass
+
+    def serve(self, path: str) -> None:
+        if os.path.exists(path):
+            os.unlink(path) # left over from an earlier run
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(path)
+            listener.listen()
+            print(f"Capture daemon listening on {path}")
+            try:
+                while self.running:
+                    connection, _ = listener.accept()
+                    with connection:
+                        self.handle(connection)
+            finally:
+                os.unlink(path)
+
+    def close(self) -> None:
+        self.camera.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    daemon = CaptureDaemon(args)
+    try:
+        daemon.serve(args.socket)
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        daemon.close()
@@ -0,0 +1,217 @@
+import os
+import re
+import glob
+import sqlite3
+import argparse
+import threading
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+from fits_writer import BLOCK_SIZE
+from calibration import master_type, MASTER_TYPES
+
+# FITS keyword -> catalog column; these get their own (indexed) columns
+INDEXED_KEYWORDS = {"IMAGETYP": "imagetyp", "EXPTIME": "exptime", "GAIN": "gain", "DATE-END": "date_end",
+                    "CCD-TEMP": "ccd_temp", "CPU-TEMP": "cpu_temp", "BAYERPAT": "bayerpat", "SONY_DPC": "sony_dpc",
+                    "RPI_DPC": "rpi_dpc", "XBINNING": "binning", "DETECTOR": "detector"}
+COLUMNS = ("path", "mtime", "size", "width", "height", "nframes", "frame_type") + tuple(INDEXED_KEYWORDS.values())
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS frames (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, width INTEGER, height INTEGER,
+    nframes INTEGER, frame_type TEXT, {", ".join(INDEXED_KEYWORDS.values())});
+CREATE INDEX IF NOT EXISTS frames_setting ON frames (frame_type, gain, exptime);
+CREATE INDEX IF NOT EXISTS frames_exptime ON frames (exptime);
+CREATE INDEX IF NOT EXISTS frames_ccd_temp ON frames (ccd_temp);
+CREATE INDEX IF NOT EXISTS frames_date_end ON frames (date_end);
+"""
+FRAME_TYPES = ("bias", "dark", "flat", "light") + tuple(f"master_{kind}" for kind in MASTER_TYPES + ("darkmodel",))
+MASTER_KEYWORDS = ("NCOMBINE", "DARKMODL", "DARKSRC") # provenance of stacking.py and dark_model.py masters
+CARD_STRING = re.compile(r"'((?:[^']|'')*)'")
+MATCH_TOLERANCE = 0.01 # relative, for --gain/--exptime: the sensor rounds both
+
+parser = argparse.ArgumentParser(description="SQLite index of AstroHQ frame headers: build it from capture directories, and query it")
+parser.add_argument("database", type=str, help="catalog file (created if missing)")
+parser.add_argument("--scan", metavar="<dir>", type=str, nargs="+", default=[], help="(re)index the FITS files under these directories; unchanged files are skipped")
+parser.add_argument("--rebuild", action="store_true", help="with --scan: drop the scanned directories' entries and read every header again")
+parser.add_argument("-w", "--workers", metavar="<#>", type=int, default=os.cpu_count(), help="worker processes for --scan")
+parser.add_argument("--type", choices=FRAME_TYPES, default=None, help="frame type: raw frames by IMAGETYP (the file name if there is none), master frames as master_<type>")
+parser.add_argument("--gain", type=float, default=None, help="analog gain")
+parser.add_argument("--exptime", metavar="<seconds>", type=float, default=None, help="exposure time")
+parser.add_argument("--min-ccd-temp", metavar="<degC>", type=float, default=None, help="lowest sensor temperature")
+parser.add_argument("--max-ccd-temp", metavar="<degC>", type=float, default=None, help="highest sensor temperature")
+parser.add_argument("--since", metavar="<ISO UTC>", type=str, default=None, help="earliest DATE-END")
+parser.add_argument("--until", metavar="<ISO UTC>", type=str, default=None, help="latest DATE-END")
+parser.add_argument("--where", metavar="<SQL>", type=str, default=None, help=f"extra SQL condition on the columns {', '.join(COLUMNS)}")
+parser.add_argument("--count", action="store_true", help="only print the number of matching frames")
+
+def card_value(text: str) -> "str|bool|int|float|None":
+    # value of a card from its value/comment field (after "= ")
+    text = text.strip()
+    if text.startswith("'"):
+        return CARD_STRING.match(text).group(1).replace("''", "'").rstrip()
+    value = text.split("/", 1)[0].strip()
+    if value in ("T", "F"):
+        return value == "T"
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace("D", "E"))
+    except ValueError:
+        return value
+
+def header_cards(fits_file, offset: int) -> "tuple[dict, int]":
+    # {keyword: value} of the header at `offset`, and its size in bytes. A minimal parser (no
+    # CONTINUE or HIERARCH cards, which AstroHQ doesn't write) that is far faster than fits.Header.
+    cards, size = {}, 0
+    fits_file.seek(offset)
+    while True:
+        block = fits_file.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise EOFError(f"Truncated header at byte {offset}")
+        size += BLOCK_SIZE
+        for i in range(0, BLOCK_SIZE, 80):
+            keyword = block[i:i+8].rstrip()
+            if keyword == b"END":
+                return cards, size
+            if block[i+8:i+10] == b"= ":
+                cards[keyword.decode("ascii")] = card_value(block[i+10:i+80].decode("ascii"))
+
+def read_cards(filename: str) -> dict:
+    # primary header cards from the header blocks alone, merged with the first extension's when the
+    # primary holds no data (MEF sequences, tile-compressed files)
+    with open(filename, "rb") as fits_file:
+        cards, header_size = header_cards(fits_file, 0)
+        if cards.get("NAXIS", 0) == 0 and os.path.getsize(filename) > header_size:
+            extension = header_cards(fits_file, header_size)[0]
+            for keyword in ("XTENSION", "PCOUNT", "GCOUNT", "EXTNAME", "EXTVER", "CHECKSUM", "DATASUM"):
+                extension.pop(keyword, None)
+            cards.update(extension)
+    return cards
+
+def frame_type(cards: dict, filename: str) -> "str|None":
+    # "master_<type>" for masters (MASTER in IMAGETYP, or their provenance cards), else the raw frame
+    # type from IMAGETYP; the file name only stands in for a missing IMAGETYP
+    imagetyp = str(cards.get("IMAGETYP", ""))
+    if "MASTER" in imagetyp.upper() or any(keyword in cards for keyword in MASTER_KEYWORDS) \
+            or (not imagetyp and "master" in os.path.basename(filename).lower()):
+        kind = master_type(cards, filename)
+        return None if kind is None else f"master_{kind}"
+    if not imagetyp:
+        return master_type(cards, filename) or "light"
+    return master_type(cards) or ("light" if "LIGHT" in imagetyp.upper() else None)
+
+def frame_row(filename: str) -> tuple:
+    # catalog row of `filename`, in COLUMNS order
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    cards = read_cards(filename)
+    axis = "ZNAXIS" if cards.get("ZIMAGE") else "NAXIS"
+    values = [int(value) if isinstance(value, bool) else value
+              for value in (cards.get(keyword) for keyword in INDEXED_KEYWORDS)]
+    return (filename, stat.st_mtime, stat.st_size, cards.get(f"{axis}1"), cards.get(f"{axis}2"),
+            cards.get("NFRAMES", cards.get(f"{axis}3", 1)), frame_type(cards, filename), *values)
+
+def scan_row(filename: str) -> "tuple|str":
+    # frame_row, or why it could not be read (for worker processes)
+    try:
+        return frame_row(filename)
+    except (OSError, ValueError, KeyError, EOFError, UnicodeDecodeError) as err:
+        return f"{type(err).__name__}: {err}"
+
+class FrameCatalog:
+    # SQLite index of frame headers; add() is called as frames are written (from any thread), scan()
+    # (re)builds it from capture directories, reading only header blocks in worker processes.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=30., check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL") # readers don't block the camera's inserts
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    def insert(self, rows: "list[tuple]") -> None:
+        with self._lock, self._db:
+            self._db.executemany(f"INSERT OR REPLACE INTO frames ({', '.join(COLUMNS)}) "
+                                 f"VALUES ({', '.join('?'*len(COLUMNS))})", rows)
+
+    def add(self, filename: str) -> None:
+        self.insert([frame_row(filename)])
+
+    def scan(self, directories: "list[str]", workers: int = os.cpu_count(), rebuild: bool = False) -> "tuple[int, int, int]":
+        # returns the number of files read, skipped as unchanged and unreadable; entries of files that
+        # no longer exist under `directories` are dropped
+        filenames = []
+        for directory in directories:
+            filenames.extend(os.path.abspath(filename) for filename in
+                             sorted(glob.glob(os.path.join(directory, "**", "*.fits"), recursive=True)))
+        prefixes = [os.path.join(os.path.abspath(directory), "") for directory in directories]
+        with self._lock, self._db:
+            known = {}
+            for prefix in prefixes:
+                known.update((path, (mtime, size)) for path, mtime, size in
+                             self._db.execute("SELECT path, mtime, size FROM frames WHERE substr(path, 1, ?) = ?",
+                                              (len(prefix), prefix)))
+            present = set(filenames)
+            self._db.executemany("DELETE FROM frames WHERE path = ?",
+                                 [(path,) for path in known if rebuild or path not in present])
+        changed = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            if rebuild or known.get(filename) != (stat.st_mtime, stat.st_size):
+                changed.append(filename)
+        rows, failed = [], 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for filename, row in zip(changed, pool.map(scan_row, changed, chunksize=64)):
+                if isinstance(row, str):
+                    print(f"Skipping {filename}: {row}")
+                    failed += 1
+                else:
+                    rows.append(row)
+        self.insert(rows)
+        return len(rows), len(filenames)-len(changed), failed
+
+    def query(self, where: str = "1", params: tuple = (), columns: str = "path") -> "list[tuple]":
+        return self._db.execute(f"SELECT {columns} FROM frames WHERE {where} ORDER BY date_end", params).fetchall()
+
+    def close(self) -> None:
+        self._db.close()
+
+def match_conditions(args: argparse.Namespace) -> "tuple[str, tuple]":
+    # SQL WHERE clause and parameters for the query options of the command line
+    conditions, params = [], []
+    if args.type is not None:
+        conditions.append("frame_type = ?")
+        params.append(args.type)
+    for column, value in (("gain", args.gain), ("exptime", args.exptime)):
+        if value is not None:
+            conditions.append(f"{column} BETWEEN ? AND ?")
+            params.extend((value*(1-MATCH_TOLERANCE), value*(1+MATCH_TOLERANCE)))
+    for condition, value in (("ccd_temp >= ?", args.min_ccd_temp), ("ccd_temp <= ?", args.max_ccd_temp),
+                             ("date_end >= ?", args.since), ("date_end <= ?", args.until)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    if args.where:
+        conditions.append(f"({args.where})")
+    return " AND ".join(conditions) or "1", tuple(params)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    catalog = FrameCatalog(args.database)
+    if args.scan:
+        read, unchanged, failed = catalog.scan(args.scan, args.workers, args.rebuild)
+        print(f"Indexed {read} file(s), {unchanged} unchanged, {failed} unreadable; {len(catalog)} in catalog")
+    where, params = match_conditions(args)
+    if args.count:
+        print(catalog.query(where, params, columns="COUNT(*)")[0][0])
+    elif not args.scan or where != "1":
+        for path, exptime, gain, ccd_temp, date_end in catalog.query(where, params, "path, exptime, gain, ccd_temp, date_end"):
+            print(f"{path}  EXPTIME={exptime}  GAIN={gain}  CCD-TEMP={ccd_temp}  DATE-END={date_end}")
+    catalog.close()
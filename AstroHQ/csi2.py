@@ -0,0 +1,43 @@
+import re
+import numpy as np
+
+# MIPI CSI-2 packed raw: 10-bit packs 4 pixels into 5 bytes, 12-bit packs 2 pixels into 3 bytes. The
+# first bytes of a group hold each pixel's high 8 bits, the last byte their low bits, first pixel in
+# the least significant bits. Rows are padded to the stride.
+GROUP_PIXELS = {10: 4, 12: 2}
+
+def packed_bits(raw_format: str) -> "int|None":
+    # bit depth of a packed format such as "SRGGB12_CSI2P", None for unpacked formats
+    match = re.fullmatch(r"S[RGB]{4}(\d+)_CSI2P", raw_format)
+    return int(match.group(1)) if match else None
+
+def packed_columns(x: int, width: int, bits: int) -> "tuple[slice, int]":
+    # byte columns holding pixels x..x+width, widened to whole groups, and the offset of pixel x in
+    # the unpacked result
+    group = GROUP_PIXELS[bits]
+    start, stop = x - x % group, -(-(x+width)//group)*group
+    return slice(start*bits//8, stop*bits//8), x-start
+
+def unpack_csi2(packed: np.ndarray, width: int, bits: int, out: "np.ndarray|None" = None,
+                left_aligned=True, chunk_rows=64) -> np.ndarray:
+    # (height, >= width*bits/8) uint8 rows -> (height, width) uint16, written straight into `out`;
+    # left-aligned values match the unpacked raw formats (12-bit data << 4). Works in row chunks so
+    # the only temporaries are a few chunk-sized byte planes.
+    group = GROUP_PIXELS[bits]
+    height = packed.shape[0]
+    if width % group:
+        raise ValueError(f"Width {width} is not a whole number of {bits}-bit groups ({group} pixels)")
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint16)
+    shift = 16-bits if left_aligned else 0
+    for start in range(0, height, chunk_rows):
+        rows = slice(start, min(start+chunk_rows, height))
+        groups = packed[rows, :width*bits//8].reshape(rows.stop-rows.start, width//group, group+1)
+        low_bits = groups[..., group]
+        for i in range(group):
+            pixels = out[rows, i::group]
+            np.left_shift(groups[..., i], bits-8+shift, out=pixels, dtype=np.uint16)
+            low = np.right_shift(low_bits, (bits-8)*i, dtype=np.uint8) if i else low_bits.copy()
+            low &= (1 << (bits-8)) - 1
+            np.bitwise_or(pixels, np.left_shift(low, shift, dtype=np.uint16), out=pixels)
+    return out
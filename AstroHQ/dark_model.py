@@ -0,0 +1,185 @@
+import os
+import argparse
+import contextlib
+import datetime as dt
+import numpy as np
+from astropy.io import fits
+from fits_writer import open_unscaled, read_image
+from batch_stats import find_files
+
+# HOTPIX mask bits
+HOT = 1 # dark current far above that of the pixel's Bayer channel
+BIAS = 2 # offset far from that of the pixel's Bayer channel, either way
+NOISY = 4 # large residuals around the fit (telegraph noise, non-linear dark current)
+
+parser = argparse.ArgumentParser(description="fit a per-pixel dark model (offset + dark current rate, optionally quadratic) "
+                                             "to a dark exposure sweep, to synthesize darks for any exposure time")
+parser.add_argument("paths", nargs="*", type=str, help="dark frames of the sweep: FITS files, directories (searched recursively for *.fits) or glob patterns")
+parser.add_argument("-o", "--out-file", metavar="<path>", type=str, default="dark_model.fits", help="model file (offset, RATE and HOTPIX extensions)")
+parser.add_argument("-q", "--quadratic", action="store_true", help="add a t^2 term per pixel (QUAD extension)")
+parser.add_argument("-s", "--sigma", metavar="<n>", type=float, default=5., help="hot/bias/noisy pixel threshold, in robust standard deviations of the pixel's Bayer channel")
+parser.add_argument("--memory-mb", metavar="<MiB>", type=float, default=64., help="memory budget for the row chunks of the frame stack")
+parser.add_argument("-m", "--model", metavar="<path>", type=str, default=None, help="use this model file instead of fitting one")
+parser.add_argument("--synthesize", metavar="<seconds>", type=float, nargs="+", default=[], help="write master darks for these exposure times from the model")
+
+def robust_outliers(values: np.ndarray, sigma: float, two_sided: bool = False) -> np.ndarray:
+    # pixels more than `sigma` robust (MAD) standard deviations above (or either side of) the median
+    # of their 2x2 Bayer cell position; medians from every 4th row and column of each channel
+    mask = np.zeros(values.shape, dtype=bool)
+    for row, column in np.ndindex(2, 2):
+        channel = values[row::2, column::2]
+        sample = channel[::4, ::4]
+        center = np.median(sample)
+        spread = 1.4826*np.median(np.abs(sample-center))
+        deviation = channel - center
+        if two_sided:
+            deviation = np.abs(deviation)
+        mask[row::2, column::2] = deviation > sigma*max(spread, np.finfo(np.float32).eps)
+    return mask
+
+class DarkModel:
+    # Per-pixel dark frame model offset + rate*t (+ quad*t^2), in stored data units, least-squares
+    # fitted to a dark exposure sweep. The design matrix is the same for every pixel, so the whole
+    # fit is its pseudo-inverse times the frame stack, done as one matrix product per row chunk
+    # (and one more for the residuals) instead of a solve per pixel.
+
+    def __init__(self, coefficients: "list[np.ndarray]", header: fits.Header, rms: "np.ndarray|None" = None) -> None:
+        self.coefficients = coefficients # offset, rate[, quad] maps (float32)
+        self.header = header
+        self.rms = rms # residual RMS map; only known for a model fitted here
+
+    @property
+    def quadratic(self) -> bool:
+        return len(self.coefficients) == 3
+
+    @classmethod
+    def fit(cls, filenames: "list[str]", quadratic: bool = False, memory_mb: float = 64.) -> "DarkModel":
+        terms = 3 if quadratic else 2
+        with contextlib.ExitStack() as stack:
+            hdus = []
+            for filename in filenames:
+                hdul = stack.enter_context(open_unscaled(filename))
+                hdus.append(next(hdu for hdu in hdul if hdu.is_image and hdu.header.get("NAXIS", 0) == 2))
+            headers = [hdu.header for hdu in hdus]
+            for keyword in ("GAIN", "BAYERPAT", "NAXIS1", "NAXIS2"):
+                if len({header.get(keyword) for header in headers}) > 1:
+                    raise ValueError(f"Frames of a dark sweep must share {keyword} (got {sorted({str(header.get(keyword)) for header in headers})})")
+            exptimes = np.array([header["EXPTIME"] for header in headers], dtype=np.float64)
+            if len(np.unique(exptimes)) < terms:
+                raise ValueError(f"A {'quadratic' if quadratic else 'linear'} model needs at least {terms} different exposure times")
+            design = np.vander(exptimes, terms, increasing=True) # columns 1, t[, t^2]
+            pseudo_inverse = np.linalg.pinv(design).astype(np.float32)
+            design = design.astype(np.float32)
+            height, width = hdus[0].shape
+            coefficients = [np.empty((height, width), dtype=np.float32) for _ in range(terms)]
+            rms = np.empty((height, width), dtype=np.float32)
+            # the chunk plus the residual temporary take about 2x the float32 chunk itself
+            rows_per_chunk = max(1, int(memory_mb*1024**2)//(2*4*len(hdus)*width))
+            for start in range(0, height, rows_per_chunk):
+                rows = slice(start, min(start+rows_per_chunk, height))
+                chunk = np.empty((len(hdus), rows.stop-rows.start, width), dtype=np.float32)
+                for i, hdu in enumerate(hdus):
+                    chunk[i] = read_image(hdu, rows)
+                pixels = chunk.reshape(len(hdus), -1)
+                solution = pseudo_inverse @ pixels
+                for coefficient, values in zip(coefficients, solution):
+                    coefficient[rows] = values.reshape(-1, width)
+                pixels -= design @ solution # residuals, in place
+                rms[rows] = np.sqrt(np.einsum("ij,ij->j", pixels, pixels)/max(len(hdus)-terms, 1)).reshape(-1, width)
+            header = fits.Header([card for card in headers[np.argmax(exptimes)].cards
+                                  if card.keyword not in ("SIMPLE", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "EXTEND", "BSCALE",
+                                                          "BZERO", "CHECKSUM", "DATASUM", "EXPTIME", "DATE-END", "DATE")])
+            temps = [header["CCD-TEMP"] for header in headers if header.get("CCD-TEMP") is not None]
+            if temps:
+                header["CCD-TEMP"] = (float(np.mean(temps)), "[degC] mean sensor temperature of the sweep")
+                header.set("TEMPMIN", min(temps), "[degC] lowest sensor temperature of the sweep")
+                header.set("TEMPMAX", max(temps), "[degC] highest sensor temperature of the sweep")
+            header.set("IMAGETYP", "MASTER DARK MODEL", "type of calibration frame")
+            header.set("PROV-SEP", "-"*26 + " MODEL PROVENANCE " + "-"*26)
+            header.set("DARKMODL", "QUADRATIC" if quadratic else "LINEAR", "offset + rate*t [+ quad*t^2] per pixel")
+            header.set("NCOMBINE", len(hdus), "number of frames fitted")
+            header.set("EXPMIN", exptimes.min(), "[s] shortest exposure fitted")
+            header.set("EXPMAX", exptimes.max(), "[s] longest exposure fitted")
+            header.set("FITDATE", dt.datetime.utcnow().isoformat(), "[ISO UTC] time of fitting")
+        return cls(coefficients, header, rms)
+
+    @classmethod
+    def from_file(cls, filename: str) -> "DarkModel":
+        with open_unscaled(filename) as hdul:
+            if "DARKMODL" not in hdul[0].header:
+                raise ValueError(f"{filename} is not a dark model (no DARKMODL)")
+            names = ["PRIMARY", "RATE"] + (["QUAD"] if hdul[0].header["DARKMODL"] == "QUADRATIC" else [])
+            return cls([read_image(hdul[name]).astype(np.float32) for name in names], hdul[0].header.copy())
+
+    def dark(self, exptime: float, rows=slice(None)) -> np.ndarray:
+        # synthetic dark (bias included) for an exposure of `exptime` seconds
+        offset, rate = self.coefficients[:2]
+        frame = rate[rows]*np.float32(exptime)
+        frame += offset[rows]
+        if self.quadratic:
+            frame += self.coefficients[2][rows]*np.float32(exptime**2)
+        return frame
+
+    def hot_pixel_mask(self, sigma: float = 5.) -> np.ndarray:
+        mask = np.where(robust_outliers(self.coefficients[1], sigma), HOT, 0).astype(np.uint8)
+        mask[robust_outliers(self.coefficients[0], sigma, two_sided=True)] |= BIAS
+        if self.rms is not None:
+            mask[robust_outliers(self.rms, sigma)] |= NOISY
+        return mask
+
+    def hdulist(self, sigma: float = 5.) -> fits.HDUList:
+        primary = fits.PrimaryHDU(data=self.coefficients[0], header=self.header)
+        primary.header.set("BUNIT", "DN", "offset: dark level at zero exposure")
+        rate = fits.ImageHDU(data=self.coefficients[1], name="RATE")
+        rate.header.set("BUNIT", "DN/s", "dark current rate")
+        hdul = fits.HDUList([primary, rate])
+        if self.quadratic:
+            quad = fits.ImageHDU(data=self.coefficients[2], name="QUAD")
+            quad.header.set("BUNIT", "DN/s2", "dark current curvature")
+            hdul.append(quad)
+        mask = fits.ImageHDU(data=self.hot_pixel_mask(sigma), name="HOTPIX")
+        mask.header.set("MASKBITS", f"{HOT}=hot {BIAS}=bias {NOISY}=noisy", "flag bits")
+        mask.header.set("CLIPSIG", sigma, "flag threshold [robust sigma per Bayer channel]")
+        hdul.append(mask)
+        for hdu in hdul:
+            hdu.add_checksum()
+        return hdul
+
+    def master_dark_hdu(self, exptime: float, source: str = "") -> fits.PrimaryHDU:
+        # master dark for CalibrationLibrary or other software, synthesized from the model
+        primary = fits.PrimaryHDU(data=self.dark(exptime))
+        for card in self.header.cards:
+            if card.keyword not in primary.header and card.keyword not in ("DARKMODL", "EXPMIN", "EXPMAX", "NCOMBINE",
+                                                                           "BSCALE", "BZERO", "CHECKSUM", "DATASUM"):
+                primary.header.append(card)
+        primary.header.set("IMAGETYP", "MASTER DARK", "type of calibration frame")
+        primary.header.set("EXPTIME", exptime, "[s] image exposure time")
+        primary.header.set("BUNIT", "DN")
+        primary.header.set("DARKSRC", os.path.basename(source), "synthesized from this dark model")
+        primary.add_checksum()
+        return primary
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.model is not None:
+        model = DarkModel.from_file(args.model)
+        out_dir = os.path.dirname(args.model)
+        print(f"Loaded {model.header['DARKMODL'].lower()} dark model {args.model}")
+    else:
+        filenames = find_files(args.paths)
+        if not filenames:
+            parser.error("no dark frames given")
+        model = DarkModel.fit(filenames, args.quadratic, args.memory_mb)
+        hdul = model.hdulist(args.sigma)
+        hdul.writeto(args.out_file, overwrite=True)
+        out_dir = os.path.dirname(args.out_file)
+        mask = hdul["HOTPIX"].data
+        print(f"Fitted {model.header['DARKMODL'].lower()} dark model to {len(filenames)} frames "
+              f"({model.header['EXPMIN']:g}-{model.header['EXPMAX']:g} s) -> {args.out_file}")
+        print(f"  median rate {np.median(model.coefficients[1][::4, ::4]):.3f} DN/s, offset {np.median(model.coefficients[0][::4, ::4]):.1f} DN; "
+              f"{np.count_nonzero(mask & HOT)} hot, {np.count_nonzero(mask & BIAS)} bias, {np.count_nonzero(mask & NOISY)} noisy pixels")
+    for exptime in args.synthesize:
+        out_file = os.path.join(out_dir, f"master_dark_{exptime:g}s_model.fits")
+        model.master_dark_hdu(exptime, args.model or args.out_file).writeto(out_file, overwrite=True)
+        print(f"Synthesized {exptime:g} s dark -> {out_file}")
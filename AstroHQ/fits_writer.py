@@ -0,0 +1,352 @@
+import os
+import datetime as dt
+import numpy as np
+from astropy.io import fits
+from timing import NO_TIMING
+
+BLOCK_SIZE = 2880 # FITS logical record length
+COMPRESSION_TYPES = ("RICE_1", "GZIP_1", "GZIP_2") # lossless for integer data
+CHECKSUM_MODES = ("inline", "stream", "deferred", "off")
+PENDING_CHECKSUM = "PENDING" # CHECKSUM placeholder until integrity.py/ChecksumFiller fills it in
+STRUCTURAL_KEYWORDS = ("SIMPLE", "XTENSION", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "NAXIS3", "EXTEND", "PCOUNT",
+                       "GCOUNT", "BSCALE", "BZERO", "CHECKSUM", "DATASUM")
+_CHECKSUM_EXCLUDE = (0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40, 0x5b, 0x5c, 0x5d, 0x5e, 0x5f, 0x60)
+
+padded_size = lambda nbytes: -(-nbytes//BLOCK_SIZE)*BLOCK_SIZE
+
+def ones_complement_add(a: int, b: int) -> int:
+    total = a + b
+    while total >> 32:
+        total = (total & 0xFFFFFFFF) + (total >> 32)
+    return total
+
+def ones_complement_sum(buf: "np.ndarray|bytes", sum32: int = 0, chunk_words: int = 1<<20) -> int:
+    # 32-bit 1's complement sum of big-endian words, as used for FITS DATASUM/CHECKSUM;
+    # a trailing partial word is treated as zero-padded, like the padding of a FITS data unit
+    octets = np.frombuffer(buf, dtype=np.uint8) if isinstance(buf, (bytes, bytearray)) else buf.reshape(-1).view(np.uint8)
+    whole = octets.size - octets.size % 4
+    words = octets[:whole].view(">u4")
+    for i in range(0, words.size, chunk_words): # chunks keep the uint64 accumulator from overflowing
+        sum32 = ones_complement_add(sum32, int(np.add.reduce(words[i:i+chunk_words], dtype=np.uint64)))
+    if whole < octets.size:
+        sum32 = ones_complement_add(sum32, int.from_bytes(octets[whole:].tobytes().ljust(4, b"\0"), "big"))
+    return sum32
+
+def encode_checksum(value: int, complement: bool = True) -> str:
+    if complement:
+        value = ~value & 0xFFFFFFFF
+    ascii_codes = [0]*16
+    for i in range(4):
+        byte = (value >> (24-8*i)) & 0xFF
+        chars = [byte//4 + 0x30]*4
+        chars[0] += byte % 4
+        adjusted = True
+        while adjusted: # keep clear of the punctuation between digits and letters
+            adjusted = False
+            for j in (0, 2):
+                if chars[j] in _CHECKSUM_EXCLUDE or chars[j+1] in _CHECKSUM_EXCLUDE:
+                    chars[j] += 1
+                    chars[j+1] -= 1
+                    adjusted = True
+        for j in range(4):
+            ascii_codes[4*j+i] = chars[j]
+    return "".join(map(chr, ascii_codes[-1:] + ascii_codes[:-1]))
+
+def reserve_checksum(header: fits.Header, pending: bool = False) -> None:
+    # fixes the header size; with pending=True the cards say so until they are filled in later
+    header.set("CHECKSUM", PENDING_CHECKSUM if pending else "0"*16, "HDU checksum")
+    header.set("DATASUM", PENDING_CHECKSUM if pending else "0", "data unit checksum")
+
+def fill_checksum(header: fits.Header, datasum: int) -> bytes:
+    # header must already contain CHECKSUM/DATASUM cards (see reserve_checksum) so its size is fixed
+    now = dt.datetime.utcnow().isoformat(timespec="seconds")
+    header.set("CHECKSUM", "0"*16, f"HDU checksum updated {now}")
+    header.set("DATASUM", str(datasum), f"data unit checksum updated {now}")
+    header_sum = ones_complement_sum(header.tostring().encode("ascii"))
+    header["CHECKSUM"] = encode_checksum(ones_complement_add(header_sum, datasum))
+    return header.tostring().encode("ascii")
+
+def uint16_image_header(shape: tuple, cards: "fits.Header|None" = None, primary: bool = True) -> fits.Header:
+    # same structural cards astropy writes for uint16 data (stored as int16 with BZERO=32768)
+    header = fits.Header()
+    if primary:
+        header.set("SIMPLE", True, "conforms to FITS standard")
+    else:
+        header.set("XTENSION", "IMAGE", "Image extension")
+    header.set("BITPIX", 16, "array data type")
+    header.set("NAXIS", len(shape), "number of array dimensions")
+    for axis, length in enumerate(shape[::-1], start=1):
+        header.set(f"NAXIS{axis}", length)
+    if primary:
+        header.set("EXTEND", True)
+    else:
+        header.set("PCOUNT", 0, "number of parameters")
+        header.set("GCOUNT", 1, "number of groups")
+    header.set("BSCALE", 1)
+    header.set("BZERO", 32768)
+    if cards is not None:
+        header.extend(cards)
+    return header
+
+def store_uint16(frame: np.ndarray, out: np.ndarray) -> int:
+    # uint16 -> big-endian int16 with BZERO=32768 is just a byteswap plus flipping the top bit;
+    # numpy fuses both into the one pass that copies `frame` (which may be a strided view) into `out`
+    np.bitwise_xor(frame, np.uint16(0x8000), out=out)
+    return frame.nbytes
+
+def store_uint16_summed(frame: np.ndarray, out: np.ndarray, chunk_rows: int = 64) -> int:
+    # store_uint16 in row chunks, adding each chunk to the data checksum while it is still in cache;
+    # returns the DATASUM. Chunks of an even number of rows always end on a 32-bit word boundary.
+    datasum = 0
+    for start in range(0, frame.shape[0], chunk_rows - chunk_rows % 2):
+        rows = slice(start, start + chunk_rows - chunk_rows % 2)
+        store_uint16(frame[rows], out[rows])
+        datasum = ones_complement_sum(out[rows], datasum)
+    return datasum
+
+def write_hdu_stream(hdu: fits.PrimaryHDU, filename: str, timing=NO_TIMING, checksum: bool = True,
+                     pending: bool = False, chunk_rows: int = 64) -> int:
+    # write_hdu for uint16 image HDUs (as from build_hdu), converting the data through a small buffer
+    # chunk by chunk and summing each chunk as it goes out, instead of add_checksum walking the whole
+    # array first; pending=True reserves the checksum cards for ChecksumFiller instead
+    frame = hdu.data
+    checksum = checksum and not pending
+    with timing.stage("write"):
+        cards = fits.Header([card for card in hdu.header.cards if card.keyword not in STRUCTURAL_KEYWORDS])
+        header = uint16_image_header(frame.shape, cards)
+        if checksum or pending:
+            reserve_checksum(header, pending=pending)
+        header_bytes = header.tostring().encode("ascii")
+        buffer = np.empty((min(chunk_rows, frame.shape[0]),)+frame.shape[1:], dtype=">u2")
+        datasum = 0
+        fits_file = open(filename, "wb")
+        try:
+            fits_file.write(header_bytes)
+            step = len(buffer) - len(buffer) % 2 or 1
+            for start in range(0, frame.shape[0], step):
+                chunk = buffer[:len(frame[start:start+step])]
+                store_uint16(frame[start:start+step], chunk)
+                if checksum:
+                    datasum = ones_complement_sum(chunk, datasum)
+                fits_file.write(chunk)
+            fits_file.write(b"\0"*(padded_size(frame.nbytes)-frame.nbytes))
+            if checksum:
+                fits_file.seek(0)
+                fits_file.write(fill_checksum(header, datasum))
+        except BaseException:
+            fits_file.close()
+            raise
+    with timing.stage("close"):
+        fits_file.close()
+    return len(header_bytes) + padded_size(frame.nbytes)
+
+def write_hdu(hdu: fits.PrimaryHDU, filename: str, timing=NO_TIMING) -> int:
+    # hdu.writeto, with writing and closing (i.e. flushing) the file timed separately
+    with timing.stage("write"):
+        fits_file = open(filename, "wb")
+        try:
+            hdu.writeto(fits_file)
+        except BaseException:
+            fits_file.close()
+            raise
+    with timing.stage("close"):
+        fits_file.close()
+    return hdu.filebytes()
+
+def open_unscaled(filename: str, **kwargs) -> fits.HDUList:
+    # memory-mapped and left in its stored form; decode the parts you need with read_image
+    return fits.open(filename, memmap=True, do_not_scale_image_data=True, **kwargs)
+
+def read_image(hdu: "fits.ImageHDU|fits.PrimaryHDU", index=Ellipsis) -> np.ndarray:
+    # Native-endian values of hdu.data[index] for an HDU from open_unscaled. Only the indexed part
+    # is read from the memory map; uint16 data comes back as uint16 instead of float.
+    stored = hdu.data[index]
+    bzero, bscale = hdu.header.get("BZERO", 0), hdu.header.get("BSCALE", 1)
+    if hdu.header["BITPIX"] == 16 and bzero == 32768 and bscale == 1: # big-endian, or native once decompressed
+        return np.bitwise_xor(stored.view(stored.dtype.str.replace("i", "u")), np.uint16(0x8000), dtype=np.uint16)
+    if bzero == 0 and bscale == 1:
+        return stored.astype(stored.dtype.newbyteorder("="))
+    return stored*np.float32(bscale) + np.float32(bzero)
+
+def write_uint16_image(filename: str, frame: np.ndarray, cards: "fits.Header|None" = None,
+                       checksum: bool = True, pending: bool = False) -> int:
+    # Writes `frame` into a memory-mapped FITS data section with a single copy and returns the
+    # number of bytes copied. `frame` can be any (cropped/flipped) view of the request buffer.
+    # The checksum is summed chunk by chunk during the copy; see write_hdu_stream for `pending`.
+    checksum = checksum and not pending
+    header = uint16_image_header(frame.shape, cards)
+    if checksum or pending:
+        reserve_checksum(header, pending=pending)
+    header_bytes = header.tostring().encode("ascii")
+    with open(filename, "wb") as fits_file:
+        fits_file.write(header_bytes)
+        fits_file.truncate(len(header_bytes)+padded_size(frame.nbytes)) # zero padding comes for free
+    data = np.memmap(filename, dtype=">u2", mode="r+", offset=len(header_bytes), shape=frame.shape)
+    if checksum:
+        header_bytes = fill_checksum(header, store_uint16_summed(frame, data))
+        copied = frame.nbytes
+        del data # no flush (msync): the header write below shares the page cache with the mapping
+        with open(filename, "r+b") as fits_file:
+            fits_file.write(header_bytes)
+    else:
+        copied = store_uint16(frame, data)
+        del data
+    return copied
+
+def write_compressed(filename: str, data: np.ndarray, header: fits.Header, compression: str = "RICE_1",
+                     tile_rows: int = 16, checksum: bool = True) -> int:
+    # tile-compressed image extension (full-width row tiles) behind an empty primary HDU;
+    # module-level so it can run in a process pool. Returns the size of the written file.
+    header = header.copy()
+    for keyword in ("SIMPLE", "EXTEND", "CHECKSUM", "DATASUM"):
+        header.remove(keyword, ignore_missing=True)
+    hdu = fits.CompImageHDU(data=data, header=header, compression_type=compression,
+                            tile_shape=(tile_rows, data.shape[-1]))
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True, checksum=checksum)
+    return os.path.getsize(filename)
+
+class FITSSequenceWriter:
+    # Writes a whole sequence into one preallocated file, either as a NAXIS3 cube ("cube") or as one
+    # IMAGE extension with a compact header per frame ("mef"). Frames are copied straight into
+    # memory-mapped data sections; the per-frame values of `frame_keywords` are also collected into
+    # a FRAMES binary table appended on close.
+
+    def __init__(self, filename: str, number: int, shape: tuple, header: fits.Header,
+                 frame_keywords: "tuple[str, ...]" = (), mode: str = "cube", checksum: bool = True) -> None:
+        if mode not in ("cube", "mef"):
+            raise ValueError(f"Unrecognized sequence mode {mode!r}")
+        self.filename = filename
+        self.number = number
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.checksum = checksum
+        self.frame_keywords = tuple(frame_keywords)
+        self.frame_bytes = int(np.prod(self.shape))*2
+        self.rows = []
+        static_cards = header.copy()
+        if mode == "mef": # per-exposure cards only go in the extension headers
+            for keyword in self.frame_keywords:
+                static_cards.remove(keyword, ignore_missing=True)
+        if mode == "cube":
+            self.primary = uint16_image_header((number,)+self.shape, static_cards)
+            self.primary.set("NFRAMES", 0, "number of frames written", after="NAXIS3")
+            self._datasum = 0
+        else:
+            self.primary = fits.Header()
+            self.primary.set("SIMPLE", True, "conforms to FITS standard")
+            self.primary.set("BITPIX", 8, "array data type")
+            self.primary.set("NAXIS", 0, "number of array dimensions")
+            self.primary.set("EXTEND", True)
+            self.primary.set("NFRAMES", 0, "number of frame extensions")
+            self.primary.extend(static_cards)
+        if checksum:
+            reserve_checksum(self.primary)
+        self.primary_size = len(self.primary.tostring())
+        if mode == "cube":
+            self.data_offset = self.primary_size
+            file_size = self.primary_size + padded_size(number*self.frame_bytes)
+        else:
+            self.extension_size = len(self._extension_header(0, header).tostring())
+            self.stride = self.extension_size + padded_size(self.frame_bytes)
+            file_size = self.primary_size + number*self.stride
+        with open(filename, "wb") as fits_file:
+            fits_file.write(self.primary.tostring().encode("ascii"))
+            fits_file.truncate(file_size)
+
+    def __enter__(self) -> "FITSSequenceWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _extension_header(self, index: int, cards: fits.Header) -> fits.Header:
+        header = uint16_image_header(self.shape, primary=False)
+        header.set("EXTNAME", "RAW", "extension name")
+        header.set("EXTVER", index+1, "frame number in sequence")
+        for keyword in self.frame_keywords:
+            header.append(cards.cards[keyword] if keyword in cards else (keyword, None))
+        if self.checksum:
+            reserve_checksum(header)
+        return header
+
+    def write(self, frame: np.ndarray, cards: fits.Header) -> int:
+        # `frame` can be any view of the request buffer; `cards` is that frame's full header
+        index = len(self.rows)
+        if index >= self.number:
+            raise IndexError(f"{self.filename} was allocated for {self.number} frames")
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match sequence shape {self.shape}")
+        if self.mode == "cube":
+            offset = self.data_offset + index*self.frame_bytes
+        else:
+            offset = self.primary_size + index*self.stride + self.extension_size
+        data = np.memmap(self.filename, dtype=">u2", mode="r+", offset=offset, shape=self.shape)
+        if self.checksum:
+            frame_sum, copied = store_uint16_summed(frame, data), frame.nbytes
+        else:
+            copied = store_uint16(frame, data)
+        if self.mode == "mef":
+            header = self._extension_header(index, cards)
+            header_bytes = fill_checksum(header, frame_sum) if self.checksum else header.tostring().encode("ascii")
+            if len(header_bytes) != self.extension_size:
+                raise ValueError(f"Header of frame {index} does not fit the {self.extension_size} bytes reserved for it")
+        elif self.checksum and self._datasum is not None:
+            if self.frame_bytes % 4 == 0: # frames stay word-aligned, so the cube sum can be built up per frame
+                self._datasum = ones_complement_add(self._datasum, frame_sum)
+            else:
+                self._datasum = None
+        # no flush (msync) per frame while the request buffer is held: the header writes and reads
+        # that follow share the page cache with the mapping
+        del data
+        if self.mode == "mef":
+            with open(self.filename, "r+b") as fits_file:
+                fits_file.seek(offset-self.extension_size)
+                fits_file.write(header_bytes)
+        elif index == 0: # cube primary carries the first frame's per-exposure cards; see FRAMES for the rest
+            for keyword in self.frame_keywords:
+                if keyword in cards and keyword in self.primary:
+                    self.primary[keyword] = cards[keyword]
+        self.rows.append({keyword: cards.get(keyword) for keyword in self.frame_keywords})
+        return copied
+
+    def frame_table(self) -> fits.BinTableHDU:
+        columns = [fits.Column(name="FRAME", format="J", array=np.arange(len(self.rows)))]
+        for keyword in self.frame_keywords:
+            values = [row[keyword] for row in self.rows]
+            if all(isinstance(value, str) for value in values):
+                column = fits.Column(name=keyword, format=f"{max(map(len, values), default=1)}A", array=values)
+            elif all(isinstance(value, bool) for value in values):
+                column = fits.Column(name=keyword, format="L", array=values)
+            else:
+                column = fits.Column(name=keyword, format="D",
+                                     array=[np.nan if value is None else value for value in values])
+            columns.append(column)
+        return fits.BinTableHDU.from_columns(columns, name="FRAMES")
+
+    def close(self) -> None:
+        if self.primary is None:
+            return
+        count = len(self.rows)
+        self.primary["NFRAMES"] = count
+        if self.mode == "cube":
+            self.primary["NAXIS3"] = count
+            end = self.data_offset + padded_size(count*self.frame_bytes)
+            if self.checksum and self._datasum is None:
+                with open(self.filename, "rb") as fits_file:
+                    self._datasum = ones_complement_sum(np.fromfile(fits_file, dtype=np.uint8, offset=self.data_offset,
+                                                                    count=count*self.frame_bytes))
+        else:
+            end = self.primary_size + count*self.stride
+        header_bytes = fill_checksum(self.primary, self._datasum if self.mode == "cube" else 0) \
+                       if self.checksum else self.primary.tostring().encode("ascii")
+        if len(header_bytes) != self.primary_size:
+            raise ValueError(f"Primary header of {self.filename} outgrew the {self.primary_size} bytes reserved for it")
+        with open(self.filename, "r+b") as fits_file:
+            fits_file.write(header_bytes)
+            fits_file.truncate(end) # drop space reserved for frames that were never captured
+        table = self.frame_table()
+        fits.append(self.filename, table.data, table.header, checksum=self.checksum)
+        self.primary = None
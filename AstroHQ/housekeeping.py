@@ -0,0 +1,86 @@
+import time
+import threading
+import numpy as np
+
+CPU_THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+
+def read_cpu_temp(path: str = CPU_THERMAL_ZONE) -> float:
+    with open(path, "r") as zone_file:
+        return int(zone_file.read())/1000 # millidegrees C
+
+def boottime_ns() -> int:
+    # same clock as libcamera's SensorTimestamp
+    return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+
+class HousekeepingSampler(threading.Thread):
+    # Samples CPU temperature (sysfs) and the latest sensor temperature (from capture metadata)
+    # at a fixed cadence into a ring buffer, so frame headers don't have to query anything.
+
+    dtype = np.dtype([("time", "i8"), ("cpu_temp", "f4"), ("sensor_temp", "f4")])
+
+    def __init__(self, interval: float = 1.0, size: int = 86400) -> None:
+        super().__init__(name="housekeeping", daemon=True)
+        self.interval = interval
+        self._buffer = np.zeros(size, dtype=self.dtype)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+        self.sensor_temp = np.nan
+
+    def __len__(self) -> int:
+        return min(self._count, self._buffer.size)
+
+    def record_metadata(self, meta: dict) -> None:
+        self.sensor_temp = meta.get("SensorTemperature", self.sensor_temp)
+
+    def sample(self) -> None:
+        try:
+            cpu_temp = read_cpu_temp()
+        except OSError:
+            cpu_temp = np.nan
+        with self._lock:
+            self._buffer[self._count % self._buffer.size] = (boottime_ns(), cpu_temp, self.sensor_temp)
+            self._count += 1
+
+    def run(self) -> None:
+        next_tick = time.monotonic()
+        while not self._halt.is_set():
+            self.sample()
+            next_tick += self.interval
+            self._halt.wait(max(0., next_tick-time.monotonic()))
+
+    def stop(self) -> None:
+        self._halt.set()
+        if self.is_alive():
+            self.join()
+
+    def history(self) -> np.ndarray:
+        # chronologically ordered copy of the buffered samples; "time" is ns since boot
+        with self._lock:
+            if self._count <= self._buffer.size:
+                return self._buffer[:self._count].copy()
+            start = self._count % self._buffer.size
+            return np.concatenate([self._buffer[start:], self._buffer[:start]])
+
+    def nearest(self, boottime: int) -> np.void:
+        with self._lock:
+            samples = self._buffer[:len(self)]
+            if samples.size == 0:
+                raise LookupError("no housekeeping samples recorded yet")
+            return samples[np.abs(samples["time"]-boottime).argmin()].copy()
+
+    def cpu_temp_at(self, boottime: int) -> "float|None":
+        # None if the temperature can't be read (e.g. no thermal zone), as FITS cards can't hold NaN
+        try:
+            cpu_temp = float(self.nearest(boottime)["cpu_temp"])
+        except LookupError:
+            try:
+                cpu_temp = read_cpu_temp()
+            except OSError:
+                return None
+        return None if np.isnan(cpu_temp) else cpu_temp
+
+    def save(self, filename: str) -> None:
+        samples = self.history()
+        np.savetxt(filename, np.column_stack([samples["time"]/1e9, samples["cpu_temp"], samples["sensor_temp"]]),
+                   fmt=["%.3f", "%.2f", "%.2f"], delimiter=",", header="uptime_s,cpu_temp_C,sensor_temp_C")
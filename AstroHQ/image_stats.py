@@ -2,38 +2,195 @@ import argparse
 import numpy as np
 from astropy.io import fits
 from scipy import optimize, stats
-import matplotlib.pyplot as plt
+from fits_writer import open_unscaled, read_image
+
+HIST_BINS = 65536
+QUANTILES = (0.25, 0.5, 0.75, 0.999)
+FIT_PARAMS = ("A1", "mu1", "sigma1", "A2", "mu2", "sigma2")
+FIT_OFFSET = 256 # pedestal subtracted before the bimodal fit
 
 parser = argparse.ArgumentParser()
 parser.add_argument("filename", type=str, help="FITS file to process")
+parser.add_argument("--hdu", metavar="<#>", type=int, default=None, help="HDU to analyse (default: the first one with an image)")
+parser.add_argument("--chunk-rows", metavar="<#>", type=int, default=256, help="rows read from the memory map at a time")
+parser.add_argument("--no-plot", action="store_true", help="skip the histogram plot")
 
 def bimodal_norm_pdf(x, A1, mu1, sigma1, A2, mu2, sigma2):
-    dist1 = stats.norm(mu1, sigma1)
-    dist2 = stats.norm(mu2, sigma2)
-    return A1*dist1.pdf(x) + A2*dist2.pdf(x)
+    # stats.norm.pdf directly: frozen distributions cost milliseconds per curve_fit evaluation
+    return A1*stats.norm.pdf(x, mu1, sigma1) + A2*stats.norm.pdf(x, mu2, sigma2)
+
+def bayer_channels(pattern: str) -> "list[str]":
+    # channel names in 2x2 cell order, e.g. "GBRG" -> ["G1", "B", "R", "G2"]
+    names = []
+    for colour in pattern:
+        names.append(colour + (str(1+names.count("G1")) if colour == "G" else ""))
+    return names
+
+def image_chunks(hdu: "fits.ImageHDU|fits.PrimaryHDU", chunk_rows: int = 256):
+    # decoded (native-endian) row chunks of every frame of an HDU from open_unscaled; chunks start on
+    # even rows, so each keeps the frame's Bayer phase
+    chunk_rows += chunk_rows % 2
+    shape = hdu.shape
+    for frame in np.ndindex(*shape[:-2]):
+        for start in range(0, shape[-2], chunk_rows):
+            yield read_image(hdu, frame + (slice(start, start+chunk_rows),))
+
+def cell_codes(chunk: np.ndarray, bins: int, offset: int = 0) -> np.ndarray:
+    # chunk + offset + bins * position in the 2x2 cell, so one bincount gives all four channel
+    # histograms; written straight into the index array bincount would otherwise convert to
+    codes = np.empty(chunk.shape, dtype=np.intp)
+    for cell, (row, column) in enumerate(np.ndindex(2, 2)):
+        np.add(chunk[row::2, column::2], offset + cell*bins, out=codes[row::2, column::2], dtype=np.intp,
+               casting="unsafe")
+    return codes
+
+class ChannelStatistics:
+    # Single chunked pass over a memory-mapped image, accumulating a histogram per 2x2 Bayer cell
+    # position. Integer data up to 16 bits gets one bin per value, so moments, min/max and quantiles
+    # are all exact without keeping or sorting any pixels. Other data takes a min/max pass first and
+    # gets HIST_BINS bins between them: mean and std stay exact, everything else is good to a bin width.
+
+    def __init__(self, hdu: "fits.ImageHDU|fits.PrimaryHDU", chunk_rows: int = 256, pattern: str = "RGGB") -> None:
+        self.channels = bayer_channels(pattern)
+        self.histograms = np.zeros((4, HIST_BINS), dtype=np.int64)
+        first = read_image(hdu, (0,)*(len(hdu.shape)-2) + (slice(0, 1),))
+        self.integer = first.dtype.kind in "ui" and first.dtype.itemsize <= 2
+        if self.integer:
+            self.low, self.width = (np.iinfo(first.dtype).min, 1.) # int16 data is shifted to start at bin 0
+            self.sums = None
+        else:
+            self.low, high = np.inf, -np.inf
+            for chunk in image_chunks(hdu, chunk_rows):
+                self.low, high = min(self.low, float(chunk.min())), max(high, float(chunk.max()))
+            self.width = max(high-self.low, np.finfo(np.float32).tiny)/(HIST_BINS-1)
+            self.sums = np.zeros((2, 4)) # sum, sum of squares per channel
+        for chunk in image_chunks(hdu, chunk_rows):
+            self.add(chunk)
+
+    def add(self, chunk: np.ndarray) -> None:
+        if self.integer:
+            codes = cell_codes(chunk, HIST_BINS, -int(self.low))
+        else:
+            bins = np.subtract(chunk, self.low, dtype=np.float64)
+            bins *= 1/self.width
+            codes = cell_codes(np.clip(np.rint(bins, out=bins), 0, HIST_BINS-1, out=bins), HIST_BINS)
+            for cell, (row, column) in enumerate(np.ndindex(2, 2)):
+                values = chunk[row::2, column::2].astype(np.float64)
+                self.sums[:, cell] += values.sum(), np.einsum("ij,ij->", values, values)
+        self.histograms += np.bincount(codes.ravel(), minlength=4*HIST_BINS).reshape(4, HIST_BINS)
+
+    @property
+    def values(self) -> np.ndarray:
+        # data value of each bin
+        return self.low + self.width*np.arange(HIST_BINS)
+
+    def summary(self, channel: "str|None" = None, quantiles=QUANTILES) -> dict:
+        # statistics of one channel, or of the whole image; same conventions as np.std (ddof=0),
+        # stats.describe (variance with ddof=1, biased skewness, Fisher kurtosis) and np.quantile
+        cells = slice(None) if channel is None else [self.channels.index(channel)]
+        hist = self.histograms[cells].sum(axis=0)
+        values = self.values
+        n = int(hist.sum())
+        occupied = np.flatnonzero(hist)
+        if self.sums is None:
+            mean = hist @ values / n
+        else:
+            mean = self.sums[0, cells].sum()/n
+        deviations = values - mean
+        m2 = hist @ deviations**2 / n
+        if self.sums is not None:
+            m2 = max(self.sums[1, cells].sum()/n - mean**2, 0.)
+        m3, m4 = hist @ deviations**3 / n, hist @ deviations**4 / n
+        cumulative = np.cumsum(hist)
+        order_stat = lambda k: values[np.searchsorted(cumulative, k, side="right")]
+        result = {"n": n, "min": values[occupied[0]], "max": values[occupied[-1]], "mean": mean, "std": np.sqrt(m2),
+                  "variance": m2*n/(n-1) if n > 1 else np.nan,
+                  "skewness": m3/m2**1.5 if m2 > 0 else np.nan, "kurtosis": m4/m2**2 - 3 if m2 > 0 else np.nan,
+                  "quantiles": {}}
+        for q in quantiles:
+            position = q*(n-1)
+            below = int(np.floor(position))
+            value = order_stat(below)
+            if below+1 < n:
+                value = value + (position-below)*(order_stat(below+1)-value)
+            result["quantiles"][q] = value
+        return result
+
+    def clipped_histogram(self, low: float, high: float, bins: int = 40) -> "tuple[np.ndarray, np.ndarray]":
+        # histogram of the whole image clipped to [low, high] (clipped values pile up in the end bins),
+        # rebinned into `bins` equal bins; returns (counts, bin edges)
+        hist = self.histograms.sum(axis=0)
+        values = np.clip(self.values, low, high)
+        return np.histogram(values, bins=bins, range=(low, high), weights=hist)
+
+def bimodal_fit(image: ChannelStatistics, summary: dict) -> "tuple[np.ndarray|None, np.ndarray, np.ndarray]":
+    # bimodal_norm_pdf fit to the histogram between the pedestal and the 99.9% quantile; returns the
+    # fit parameters (None if the fit did not converge), the histogram counts and bin edges
+    hist_vals, hist_edges = image.clipped_histogram(FIT_OFFSET, summary["quantiles"][0.999])
+    hist_bins = np.mean([hist_edges[1:], hist_edges[:-1]], axis=0) - FIT_OFFSET
+    try:
+        fit_params, cov = optimize.curve_fit(bimodal_norm_pdf, hist_bins, hist_vals, p0=[2e6, 16, 2, 1e6, 40, 10])
+    except (RuntimeError, ValueError): # no convergence, or too narrow a histogram
+        fit_params = None
+    return fit_params, hist_vals, hist_edges
+
+def open_statistics(filename: str, hdu: "int|None" = None, chunk_rows: int = 256) -> "tuple[ChannelStatistics, str]":
+    # ChannelStatistics of the given (or the first image) HDU of a file, and its Bayer pattern
+    with open_unscaled(filename) as hdul:
+        if hdu is None:
+            hdu = next((i for i, image_hdu in enumerate(hdul) if image_hdu.is_image and image_hdu.header.get("NAXIS", 0) >= 2), None)
+            if hdu is None:
+                raise ValueError(f"No image in {filename}")
+        pattern = hdul[hdu].header.get("BAYERPAT", hdul[0].header.get("BAYERPAT", "RGGB"))
+        return ChannelStatistics(hdul[hdu], chunk_rows, pattern), pattern
+
+def file_statistics(filename: str, hdu: "int|None" = None, chunk_rows: int = 256, fit: bool = True) -> dict:
+    # flat {column: value} summary of a file: whole-image statistics, mean/std/median per Bayer
+    # channel and (for integer data) the bimodal fit parameters, NaN where the fit did not converge
+    image, pattern = open_statistics(filename, hdu, chunk_rows)
+    summary = image.summary()
+    row = {key: summary[key] for key in ("n", "min", "max", "mean", "std", "skewness", "kurtosis")}
+    for q, value in summary["quantiles"].items():
+        row[f"q{q*100:g}"] = value
+    for channel in sorted(image.channels):
+        channel_summary = image.summary(channel, quantiles=(0.5,))
+        row[f"mean_{channel}"], row[f"std_{channel}"] = channel_summary["mean"], channel_summary["std"]
+        row[f"median_{channel}"] = channel_summary["quantiles"][0.5]
+    if fit:
+        fit_params = bimodal_fit(image, summary)[0] if image.integer else None
+        row.update(zip(FIT_PARAMS, np.full(len(FIT_PARAMS), np.nan) if fit_params is None else fit_params))
+    return row
+
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    data_array = fits.getdata(args.filename)
-    print(f"Average: {np.mean(data_array):.2f} ± {np.std(data_array):.2f}")
-    print(f"Summary: {stats.describe(data_array.ravel())}")
+    image, pattern = open_statistics(args.filename, args.hdu, args.chunk_rows)
+    summary = image.summary()
+    print(f"Average: {summary['mean']:.2f} ± {summary['std']:.2f}")
+    print(f"Summary: nobs={summary['n']}, minmax=({summary['min']}, {summary['max']}), mean={summary['mean']:.4f}, "
+          f"variance={summary['variance']:.4f}, skewness={summary['skewness']:.4f}, kurtosis={summary['kurtosis']:.4f}")
     print("Percentiles:")
-    for percentile, value in zip([0.25, 0.5, 0.75, 0.99],
-                                 np.quantile(data_array,
-                                             [0.25, 0.5, 0.75, 0.999])):
-        print(f"  {percentile:.0%}: {value}")
-    clipped = np.clip(data_array.ravel(), 256, np.quantile(data_array, 0.999))
-    clipped -= 256
-    hist_vals, hist_bins = np.histogram(clipped, 40)
-    hist_bins = np.mean([hist_bins[1:], hist_bins[:-1]], axis=0)
-    try:
-        fit_params, cov = optimize.curve_fit(bimodal_norm_pdf, hist_bins, hist_vals, p0=[2e6, 16, 2, 1e6, 40, 10])
-        print("Fit parameters:")
-        for kw, i in zip(["A1", "μ1", "σ1", "A2", "μ2", "σ2"], [1, 2, 4, 5]):
-            print(f"  {kw}: {fit_params[i]:6.3f}")
-    except RuntimeError:
-        print("Curve fit did not converge.")
-    plt.hist(clipped, 40)
-    plt.plot(np.linspace(0, clipped.max(), 100), bimodal_norm_pdf(np.linspace(0, clipped.max(), 100), *fit_params))
-    plt.ylim(0,)
-    plt.show()
+    for percentile, value in summary["quantiles"].items():
+        print(f"  {percentile:.1%}: {value}")
+    print(f"Per Bayer channel ({pattern}):")
+    print(f"  {'':>3} {'mean':>10} {'std':>9} {'min':>8} {'max':>8} " + " ".join(f"{q:>8.1%}" for q in QUANTILES))
+    for channel in image.channels:
+        row = image.summary(channel)
+        print(f"  {channel:>3} {row['mean']:10.2f} {row['std']:9.2f} {row['min']:8g} {row['max']:8g} "
+              + " ".join(f"{value:8g}" for value in row["quantiles"].values()))
+    if image.integer:
+        fit_params, hist_vals, hist_edges = bimodal_fit(image, summary)
+        if fit_params is None:
+            print("Curve fit did not converge.")
+        else:
+            print("Fit parameters:")
+            for kw, value in zip(["A1", "μ1", "σ1", "A2", "μ2", "σ2"], fit_params):
+                print(f"  {kw}: {value:6.3f}")
+        if not args.no_plot:
+            import matplotlib.pyplot as plt # only needed here; batch_stats.py workers never plot
+            plt.stairs(hist_vals, hist_edges-FIT_OFFSET)
+            if fit_params is not None:
+                x = np.linspace(0, hist_edges[-1]-FIT_OFFSET, 100)
+                plt.plot(x, bimodal_norm_pdf(x, *fit_params))
+            plt.ylim(0,)
+            plt.show()
@@ -0,0 +1,134 @@
+import os
+import glob
+import queue
+import argparse
+import threading
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+from fits_writer import BLOCK_SIZE, PENDING_CHECKSUM, padded_size, ones_complement_sum, fill_checksum
+
+parser = argparse.ArgumentParser(description="verify FITS checksums across directories in parallel, and fill in deferred ones")
+parser.add_argument("paths", nargs="+", type=str, help="FITS files or directories (searched for *.fits)")
+parser.add_argument("-w", "--workers", metavar="<#>", type=int, default=os.cpu_count(), help="worker processes")
+parser.add_argument("--fill", action="store_true", help="fill in pending (deferred) checksums instead of only reporting them")
+parser.add_argument("-q", "--quiet", action="store_true", help="only list files that are not OK")
+
+def read_hdu_layout(fits_file, offset: int) -> "tuple[fits.Header, int, int]":
+    # header at `offset`, its size in bytes and the size of its data unit (without padding)
+    blocks = []
+    while True:
+        block = fits_file.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise EOFError(f"Truncated header at byte {offset}")
+        blocks.append(block)
+        if any(block[i:i+8] == b"END     " for i in range(0, BLOCK_SIZE, 80)):
+            break
+    header = fits.Header.fromstring(b"".join(blocks).decode("ascii"))
+    naxis = [header.get(f"NAXIS{axis}", 0) for axis in range(1, header.get("NAXIS", 0)+1)]
+    data_size = abs(header["BITPIX"])//8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + int(np.prod(naxis))) \
+                if naxis else 0
+    return header, len(blocks)*BLOCK_SIZE, data_size
+
+def hdu_layouts(filename: str) -> "list[tuple[fits.Header, int, int, int]]":
+    # (header, header offset, header size, data size) for every HDU, from the headers alone
+    layouts = []
+    file_size = os.path.getsize(filename)
+    with open(filename, "rb") as fits_file:
+        offset = 0
+        while offset < file_size:
+            fits_file.seek(offset)
+            header, header_size, data_size = read_hdu_layout(fits_file, offset)
+            layouts.append((header, offset, header_size, data_size))
+            offset += header_size + padded_size(data_size)
+    return layouts
+
+def data_sum(filename: str, offset: int, size: int) -> int:
+    if size == 0:
+        return 0
+    return ones_complement_sum(np.memmap(filename, dtype=np.uint8, mode="r", offset=offset, shape=(size,)))
+
+def verify_file(filename: str, fill: bool = False) -> "list[str]":
+    # status of each HDU: "ok", "missing" (no CHECKSUM/DATASUM), "pending" (deferred, see
+    # PENDING_CHECKSUM; "filled" once fill=True has filled it in), "bad DATASUM" or "bad CHECKSUM"
+    statuses = []
+    for header, offset, header_size, data_size in hdu_layouts(filename):
+        if "CHECKSUM" not in header or "DATASUM" not in header:
+            statuses.append("missing")
+            continue
+        datasum = data_sum(filename, offset+header_size, data_size)
+        if header["CHECKSUM"] == PENDING_CHECKSUM:
+            if fill:
+                header_bytes = fill_checksum(header, datasum)
+                if len(header_bytes) != header_size:
+                    raise ValueError(f"Checksum cards in {filename} change its header size")
+                with open(filename, "r+b") as fits_file:
+                    fits_file.seek(offset)
+                    fits_file.write(header_bytes)
+            statuses.append("filled" if fill else "pending")
+        elif str(datasum) != str(header["DATASUM"]):
+            statuses.append("bad DATASUM")
+        else:
+            with open(filename, "rb") as fits_file:
+                fits_file.seek(offset)
+                header_bytes = fits_file.read(header_size)
+            statuses.append("ok" if ones_complement_sum(header_bytes, datasum) == 0xFFFFFFFF else "bad CHECKSUM")
+    return statuses
+
+def verify_paths(paths: "list[str]", workers: int = os.cpu_count(), fill: bool = False):
+    # yields (filename, statuses) as files complete, checked in parallel worker processes
+    filenames = []
+    for path in paths:
+        filenames.extend(sorted(glob.glob(os.path.join(path, "*.fits"))) if os.path.isdir(path) else [path])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {filename: pool.submit(verify_file, filename, fill) for filename in filenames}
+        for filename, future in futures.items():
+            try:
+                yield filename, future.result()
+            except (OSError, ValueError, KeyError, EOFError, fits.VerifyError) as err:
+                yield filename, [f"unreadable ({err})"]
+
+class ChecksumFiller(threading.Thread):
+    # Fills in the checksums of files written with pending ones (write_hdu_stream/write_uint16_image
+    # with pending=True) in the background, off the capture path.
+
+    def __init__(self) -> None:
+        super().__init__(name="checksum-filler", daemon=True)
+        self._queue = queue.Queue()
+        self.filled = 0
+        self.errors = []
+        self.start()
+
+    def submit(self, filename: str) -> None:
+        self._queue.put(filename)
+
+    def run(self) -> None:
+        while (filename := self._queue.get()) is not None:
+            try:
+                verify_file(filename, fill=True)
+                self.filled += 1
+            except (OSError, ValueError, KeyError, EOFError, fits.VerifyError) as err:
+                self.errors.append((filename, err))
+                print(f"Could not fill checksums of {filename}: {err}")
+            finally:
+                self._queue.task_done()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self) -> None:
+        # fills whatever is still queued first
+        self._queue.put(None)
+        self.join()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    counts = {}
+    for filename, statuses in verify_paths(args.paths, args.workers, args.fill):
+        status = "ok" if all(status == "ok" for status in statuses) else ", ".join(statuses)
+        counts[status] = counts.get(status, 0) + 1
+        if not (args.quiet and status == "ok"):
+            print(f"{filename}: {status}")
+    print(f"{sum(counts.values())} files: " + ", ".join(f"{count} {status}" for status, count in counts.items()))
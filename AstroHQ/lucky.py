@@ -0,0 +1,82 @@
+import heapq
+import numpy as np
+from fits_writer import FITSSequenceWriter
+
+LUCKY_METRICS = ("gradient", "focusfom")
+
+def gradient_sharpness(frame: np.ndarray) -> float:
+    # mean squared difference between same-colour neighbours (2 pixels apart, so the Bayer pattern
+    # itself doesn't count as detail), i.e. a Brenner focus measure on the raw mosaic
+    frame = frame.astype(np.float32)
+    dx = frame[:, 2:] - frame[:, :-2]
+    dy = frame[2:, :] - frame[:-2, :]
+    return float(np.einsum("ij,ij->", dx, dx)/dx.size + np.einsum("ij,ij->", dy, dy)/dy.size)
+
+class LuckySelector:
+    # Keeps the `keep` sharpest frames of an arbitrarily long run in keep+1 preallocated slots: each
+    # frame is copied into the spare slot and scored there, and if it beats the worst kept frame the
+    # two slots swap roles, so nothing is copied twice or allocated per frame. With "focusfom" the
+    # score comes from the metadata and rejected frames aren't copied at all.
+
+    def __init__(self, keep: int, metric: str = "gradient") -> None:
+        if metric not in LUCKY_METRICS:
+            raise ValueError(f"Unrecognized sharpness metric {metric!r}")
+        if keep < 1:
+            raise ValueError(f"Must keep at least 1 frame (got {keep})")
+        self.keep = keep
+        self.metric = metric
+        self.frames = None
+        self.count = 0
+        self._heap = [] # (score, frame number, slot), worst kept frame first
+        self._meta = [None]*(keep+1)
+        self._spare = 0
+
+    @property
+    def selected(self) -> "list[tuple[float, int, int]]":
+        # (score, frame number, slot) of the kept frames, sharpest first
+        return sorted(self._heap, reverse=True)
+
+    def offer(self, frame: np.ndarray, meta: dict) -> bool:
+        # `frame` may be a view of a request buffer; returns whether it was kept
+        if self.frames is None:
+            self.frames = np.empty((self.keep+1,)+frame.shape, dtype=np.uint16)
+        elif frame.shape != self.frames.shape[1:]: # e.g. ScalerCrop or the ROI changed mid-run
+            raise ValueError(f"Frame shape {frame.shape} does not match the selected frames' shape {self.frames.shape[1:]}")
+        number = self.count
+        self.count += 1
+        full = len(self._heap) == self.keep
+        score = meta.get("FocusFoM") if self.metric == "focusfom" else None
+        if full and score is not None and score <= self._heap[0][0]:
+            return False
+        np.copyto(self.frames[self._spare], frame, casting="unsafe")
+        if score is None:
+            score = gradient_sharpness(self.frames[self._spare])
+        if not full:
+            heapq.heappush(self._heap, (score, number, self._spare))
+        elif score > self._heap[0][0]:
+            slot = heapq.heapreplace(self._heap, (score, number, self._spare))[2]
+        else:
+            return False
+        self._meta[self._spare] = meta
+        self._spare = len(self._heap) if not full else slot
+        return True
+
+    def write(self, filename: str, frame_header, frame_keywords: "tuple[str, ...]" = ()) -> None:
+        # kept frames as a cube, sharpest first; `frame_header` builds a header from frame metadata
+        selected = self.selected
+        if not selected:
+            raise ValueError("No frames have been offered")
+        headers = []
+        for score, number, slot in selected:
+            header = frame_header(self._meta[slot])
+            header.set("SHARPNES", score, f"frame sharpness ({self.metric})")
+            header.set("FRAMENUM", number, "frame number in capture run")
+            headers.append(header)
+        header = headers[0].copy()
+        header.set("LUCKYMET", self.metric, "sharpness metric for frame selection")
+        header.set("NSCORED", self.count, "number of frames captured and scored")
+        header.set("NSELECT", len(selected), "number of sharpest frames kept")
+        keywords = tuple(frame_keywords) + ("SHARPNES", "FRAMENUM")
+        with FITSSequenceWriter(filename, len(selected), self.frames.shape[1:], header, frame_keywords=keywords) as writer:
+            for (score, number, slot), frame_cards in zip(selected, headers):
+                writer.write(self.frames[slot], frame_cards)
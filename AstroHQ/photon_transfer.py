@@ -0,0 +1,164 @@
+import os
+import time
+import argparse
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from fits_writer import open_unscaled
+from catalog import read_cards
+from image_stats import bayer_channels, image_chunks, cell_codes
+from batch_stats import TABLE_FORMATS, find_files, write_table
+
+DIFF_OFFSET = 1 << 16 # pair differences of 16-bit data are shifted into 0..2**17-1 for the histograms
+DIFF_BINS = 1 << 17
+CLIP_SIGMA = 5. # hot pixels and cosmic rays differ between the frames of a pair, so they are clipped
+EXPTIME_DIGITS = 4 # EXPTIME rounding when grouping frames into pairs
+
+parser = argparse.ArgumentParser(description="photon transfer curve per Bayer channel from an exposure sweep of flat frame pairs "
+                                             "(bracket.py --pairs): conversion gain, read noise, full well and linearity")
+parser.add_argument("paths", nargs="+", type=str, help="FITS files, directories (searched recursively for *.fits) or glob patterns")
+parser.add_argument("-w", "--workers", metavar="<#>", type=int, default=os.cpu_count(), help="worker processes (one frame pair each)")
+parser.add_argument("--chunk-rows", metavar="<#>", type=int, default=256, help="rows of each frame read from the memory map at a time")
+parser.add_argument("-o", "--output", metavar="<file>", type=str, default=None, help=f"also write the curve's points to a table ({', '.join(TABLE_FORMATS)})")
+parser.add_argument("--plot", action="store_true", help="plot the curves (requires matplotlib)")
+
+def sweep_pairs(filenames: "list[str]") -> "dict[tuple[float, float], list[tuple[str, str]]]":
+    # frame pairs by (gain, exposure) from the headers; frames are paired in capture order, and a
+    # frame left over at a setting or without GAIN/EXPTIME (e.g. a master) is ignored
+    settings = {}
+    for filename in filenames:
+        try:
+            cards = read_cards(filename)
+        except (OSError, ValueError, EOFError, UnicodeDecodeError) as err:
+            print(f"Skipping {filename}: {type(err).__name__}: {err}")
+            continue
+        if cards.get("GAIN") is None or cards.get("EXPTIME") is None:
+            continue
+        key = (cards["GAIN"], round(cards["EXPTIME"], EXPTIME_DIGITS))
+        settings.setdefault(key, []).append((cards.get("DATE-END") or "", filename))
+    pairs = {}
+    for key, frames in sorted(settings.items()):
+        frames = [filename for _, filename in sorted(frames)]
+        if len(frames) >= 2:
+            pairs[key] = list(zip(frames[0::2], frames[1::2]))
+    return pairs
+
+def clipped_variance(hist: np.ndarray, sigma: float = CLIP_SIGMA, iterations: int = 5) -> float:
+    # variance of the values behind a histogram with unit-width bins, iteratively clipped at `sigma`
+    # standard deviations from the mean
+    values = np.arange(len(hist), dtype=np.float64)
+    keep = hist > 0
+    for _ in range(iterations):
+        counts = np.where(keep, hist, 0)
+        n = counts.sum()
+        mean = counts @ values / n
+        variance = counts @ (values-mean)**2 / (n-1)
+        clipped = keep & (np.abs(values-mean) <= sigma*np.sqrt(variance))
+        if (clipped == keep).all():
+            break
+        keep = clipped
+    return variance
+
+def pair_statistics(pair: "tuple[str, str]", chunk_rows: int = 256) -> "tuple[np.ndarray, np.ndarray]":
+    # mean signal of both frames and half the clipped variance of their difference (i.e. the
+    # temporal noise of one frame, without fixed-pattern noise) per 2x2 cell position, in stored
+    # data units; both frames are streamed from their memory maps a few rows at a time
+    sums = np.zeros(4, dtype=np.int64)
+    hist = np.zeros(4*DIFF_BINS, dtype=np.int64)
+    with open_unscaled(pair[0]) as hdul_a, open_unscaled(pair[1]) as hdul_b:
+        hdu_a, hdu_b = (next(hdu for hdu in hdul if hdu.is_image and hdu.header.get("NAXIS", 0) >= 2) for hdul in (hdul_a, hdul_b))
+        if hdu_a.shape != hdu_b.shape:
+            raise ValueError(f"{pair[0]} and {pair[1]} differ in shape")
+        for chunk_a, chunk_b in zip(image_chunks(hdu_a, chunk_rows), image_chunks(hdu_b, chunk_rows)):
+            for chunk in (chunk_a, chunk_b):
+                for row in range(2): # column sums of contiguous rows first: much faster than strided sums
+                    columns = chunk[row::2].sum(axis=0, dtype=np.int64)
+                    sums[2*row:2*row+2] += columns[0::2].sum(), columns[1::2].sum()
+            hist += np.bincount(cell_codes(np.subtract(chunk_a, chunk_b, dtype=np.int32), DIFF_BINS, DIFF_OFFSET).ravel(),
+                                minlength=4*DIFF_BINS)
+    hist = hist.reshape(4, DIFF_BINS)
+    means = sums/(2*hist.sum(axis=1))
+    return means, np.array([clipped_variance(channel)/2 for channel in hist])
+
+def fit_ptc(signal: np.ndarray, variance: np.ndarray, exptime: np.ndarray) -> dict:
+    # conversion gain [e-/DN] and read noise from a weighted linear fit of variance to signal in the
+    # shot-noise regime, full well at the curve's turnover (NaN if the sweep never turned over) and
+    # non-linearity as the largest deviation from a linear signal-exposure fit, in % of the largest
+    # signal fitted; signals [DN above black] and variances [DN^2] in exposure order
+    order = np.argsort(exptime)
+    signal, variance, exptime = signal[order], variance[order], exptime[order]
+    if len(signal) == 0:
+        return {"points": 0, "gain_e_per_dn": np.nan, "read_noise_dn": np.nan, "read_noise_e": np.nan,
+                "full_well_e": np.nan, "max_signal_dn": np.nan, "nonlinearity_pct": np.nan}
+    peak = int(np.argmax(variance))
+    turned = peak < len(variance)-1 and variance[-1] < 0.9*variance[peak]
+    full_well = signal[peak] if turned else np.nan
+    linear = signal <= 0.9*full_well if turned else np.ones(len(signal), dtype=bool)
+    result = {"points": int(linear.sum()), "gain_e_per_dn": np.nan, "read_noise_dn": np.nan, "read_noise_e": np.nan,
+              "full_well_e": np.nan, "max_signal_dn": signal.max(), "nonlinearity_pct": np.nan}
+    if linear.sum() < 2:
+        return result
+    slope, intercept = np.polyfit(signal[linear], variance[linear], 1, w=1/variance[linear]) # variance errors scale with it
+    gain = 1/slope
+    result["gain_e_per_dn"] = gain
+    result["read_noise_dn"] = np.sqrt(intercept) if intercept > 0 else np.nan
+    result["read_noise_e"] = result["read_noise_dn"]*gain
+    result["full_well_e"] = full_well*gain
+    rate, offset = np.polyfit(exptime[linear], signal[linear], 1)
+    residuals = signal[linear] - (rate*exptime[linear] + offset)
+    result["nonlinearity_pct"] = 100*np.abs(residuals).max()/signal[linear].max()
+    return result
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.output and os.path.splitext(args.output)[1].lower() not in TABLE_FORMATS:
+        parser.error(f"unknown table format {args.output!r}: use one of {', '.join(TABLE_FORMATS)}")
+    start = time.monotonic()
+    pairs = sweep_pairs(find_files(args.paths))
+    jobs = [(key, pair) for key, key_pairs in pairs.items() for pair in key_pairs]
+    if not jobs:
+        parser.error("no frame pairs found (capture the sweep with bracket.py --pairs)")
+    first = read_cards(jobs[0][1][0])
+    channels = bayer_channels(first.get("BAYERPAT", "RGGB"))
+    scale = 2**(16-first.get("BITDEPTH", 16)) # stored data is left-aligned in 16 bits; results are in sensor DN
+    black = first.get("DATAMIN") or 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(functools.partial(pair_statistics, chunk_rows=args.chunk_rows), [pair for _, pair in jobs]))
+    points = {} # (gain, exposure) -> mean signal [DN above black] and variance [DN^2] per channel, over its pairs
+    for (key, pair), (means, variances) in zip(jobs, results):
+        if not variances.any():
+            print(f"Skipping {pair[0]} and {pair[1]}: identical frames")
+            continue
+        points.setdefault(key, []).append((means/scale - black, variances/scale**2))
+    rows = []
+    for (gain, exptime), values in points.items():
+        signal, variance = np.mean(values, axis=0)
+        rows.extend({"gain": gain, "exptime": exptime, "channel": channel, "pairs": len(values), "signal_dn": signal[i],
+                     "variance_dn2": variance[i]} for i, channel in enumerate(channels))
+    print(f"{len(jobs)} frame pair(s) at {len(points)} setting(s) in {time.monotonic()-start:.1f} s "
+          f"(DN at {first.get('BITDEPTH', 16)} bits, black level {black} DN)")
+    print(f"  {'gain':>5} {'':>3} {'e-/DN':>8} {'RN [DN]':>8} {'RN [e-]':>8} {'FW [e-]':>9} {'max [DN]':>9} {'nonlin':>7} {'points':>6}")
+    fits_by_curve = {}
+    for gain in sorted({gain for gain, _ in points}):
+        for channel in sorted(channels):
+            curve = [row for row in rows if row["gain"] == gain and row["channel"] == channel]
+            fit = fit_ptc(*(np.array([row[column] for row in curve]) for column in ("signal_dn", "variance_dn2", "exptime")))
+            fits_by_curve[gain, channel] = fit
+            print(f"  {gain:5g} {channel:>3} {fit['gain_e_per_dn']:8.3f} {fit['read_noise_dn']:8.2f} {fit['read_noise_e']:8.2f} "
+                  f"{fit['full_well_e']:9.0f} {fit['max_signal_dn']:9.1f} {fit['nonlinearity_pct']:6.2f}% {fit['points']:6d}")
+    if args.output:
+        write_table(rows, args.output)
+        print(f"Curve points written to {args.output}")
+    if args.plot:
+        import matplotlib.pyplot as plt
+        for (gain, channel), fit in fits_by_curve.items():
+            curve = [row for row in rows if row["gain"] == gain and row["channel"] == channel]
+            signal = np.array([row["signal_dn"] for row in curve])
+            line = plt.loglog(signal, [row["variance_dn2"] for row in curve], "o", label=f"{channel} gain {gain:g}")[0]
+            x = np.geomspace(max(signal.min(), 1e-1), signal.max(), 100)
+            plt.loglog(x, x/fit["gain_e_per_dn"] + fit["read_noise_dn"]**2, color=line.get_color())
+        plt.xlabel("signal [DN]")
+        plt.ylabel("variance [DN$^2$]")
+        plt.legend()
+        plt.show()
@@ -0,0 +1,157 @@
+import time
+import queue
+import threading
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fits_writer import write_compressed, write_hdu
+from timing import NO_TIMING
+
+class FITSWriterQueue:
+    # Bounded hand-off between the capture thread, which only grabs and releases requests,
+    # and a small pool of writer threads that build HDUs and write them to disk. With `compression`,
+    # each writer thread hands its frame to a process pool for tile compression, so compression
+    # uses all cores instead of contending for the GIL.
+
+    def __init__(self, build_hdu: Callable, workers: int = 2, max_frames: int = 8,
+                 max_mbytes: float = 256., block: bool = True, timeout: "float|None" = None,
+                 compression: "str|None" = None, write_hdu: Callable = write_hdu,
+                 file_written: "Callable|None" = None, checksum: bool = True) -> None:
+        self.build_hdu = build_hdu
+        self.write_hdu = write_hdu # (hdu, filename, timing) -> bytes written, for uncompressed frames
+        self.file_written = file_written # (filename) -> None, after each compressed frame (write_hdu's job otherwise)
+        self.compression = compression
+        self.checksum = checksum # for compressed frames, summed by the compression process as it writes
+        self._pool = ProcessPoolExecutor(max_workers=workers) if compression else None
+        self.max_bytes = int(max_mbytes*1024**2)
+        self.block = block # if False, frames that don't fit are dropped instead of stalling capture
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_frames)
+        self._budget = threading.Condition()
+        self._bytes_pending = 0
+        self._last_timestamp = None
+        self.submitted = 0
+        self.written = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped = 0 # frames discarded because the queue was full
+        self.skipped = 0 # frames the sensor produced that never reached capture_request()
+        self.delayed = 0 # frames whose hand-off had to wait on backpressure
+        self.max_wait = 0.
+        self.errors = []
+        self._workers = [threading.Thread(target=self._work, name=f"fits-writer-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self) -> "FITSWriterQueue":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _check_sequence(self, meta: dict) -> None:
+        timestamp, duration = meta.get("SensorTimestamp"), meta.get("FrameDuration")
+        if self._last_timestamp is not None and timestamp and duration:
+            frames_elapsed = round((timestamp-self._last_timestamp)/(duration*1e3))
+            if frames_elapsed > 1:
+                self.skipped += frames_elapsed-1
+        self._last_timestamp = timestamp
+
+    def _reserve(self, nbytes: int) -> bool:
+        deadline = None if self.timeout is None else time.monotonic()+self.timeout
+        with self._budget:
+            # a single frame larger than the whole budget is still admitted once the queue drains
+            has_room = lambda: self._bytes_pending == 0 or self._bytes_pending+nbytes <= self.max_bytes
+            if not has_room():
+                if not self.block:
+                    return False
+                remaining = None if deadline is None else deadline-time.monotonic()
+                if not self._budget.wait_for(has_room, timeout=remaining):
+                    return False
+            self._bytes_pending += nbytes
+        return True
+
+    def _release(self, nbytes: int) -> None:
+        with self._budget:
+            self._bytes_pending -= nbytes
+            self._budget.notify_all()
+
+    def submit(self, filename: str, array: np.ndarray, meta: dict, timing=NO_TIMING) -> bool:
+        self._check_sequence(meta)
+        self.submitted += 1
+        t0 = time.monotonic()
+        if not self._reserve(array.nbytes):
+            self.dropped += 1
+            print(f"Dropped {filename}: writer memory limit reached ({self.max_bytes/1024**2:.0f} MiB)")
+            return False
+        item = (filename, array, meta, timing, time.monotonic())
+        try:
+            if self.block:
+                remaining = None if self.timeout is None else max(0., self.timeout-(time.monotonic()-t0))
+                self._queue.put(item, timeout=remaining)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            self._release(array.nbytes)
+            self.dropped += 1
+            print(f"Dropped {filename}: writer queue full ({self._queue.maxsize} frames)")
+            return False
+        waited = time.monotonic()-t0
+        timing.add("submit", waited)
+        if waited > 1e-3:
+            self.delayed += 1
+            self.max_wait = max(self.max_wait, waited)
+        return True
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            filename, array, meta, timing, queued_at = item
+            timing.add("queue", time.monotonic()-queued_at)
+            try:
+                hdu = self.build_hdu(array, meta, timing=timing)
+                if self._pool is not None:
+                    with timing.stage("compress"):
+                        file_size = self._pool.submit(write_compressed, filename, hdu.data, hdu.header,
+                                                      self.compression, checksum=self.checksum).result()
+                    if self.file_written is not None:
+                        self.file_written(filename)
+                else:
+                    file_size = self.write_hdu(hdu, filename, timing)
+                with self._budget:
+                    self.written += 1
+                    self.bytes_in += hdu.data.nbytes
+                    self.bytes_out += file_size
+            except Exception as err:
+                self.errors.append((filename, err))
+                print(f"Failed to write {filename}: {err!r}")
+            finally:
+                timing.finish()
+                self._release(array.nbytes)
+                del item, array
+                self._queue.task_done()
+
+    def join(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def report(self) -> str:
+        ratio = f" (compression ratio {self.bytes_in/self.bytes_out:.2f})" if self.compression and self.bytes_out else ""
+        return (f"{self.written}/{self.submitted} frames written{ratio}, {self.dropped} dropped by writer, "
+                f"{self.skipped} skipped by sensor, {self.delayed} delayed (max wait {self.max_wait:.3f} s), "
+                f"{len(self.errors)} write errors")
@@ -0,0 +1,171 @@
+import os
+import glob
+import math
+import time
+import zlib
+import struct
+import argparse
+import threading
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+from fits_writer import open_unscaled, read_image
+
+PREVIEW_FORMATS = ("png", "jpeg")
+STRETCHES = ("asinh", "percentile")
+
+parser = argparse.ArgumentParser(description="make stretched colour quick-look previews (PNG/JPEG) of raw Bayer FITS frames in parallel")
+parser.add_argument("paths", nargs="+", type=str, help="FITS files or directories (searched for *.fits)")
+parser.add_argument("-w", "--workers", metavar="<#>", type=int, default=os.cpu_count(), help="worker processes")
+parser.add_argument("-f", "--format", choices=PREVIEW_FORMATS, default="png", help="preview image format (jpeg requires Pillow)")
+parser.add_argument("-s", "--stretch", choices=STRETCHES, default="asinh", help="tone curve between the black and white points")
+parser.add_argument("-p", "--percentiles", metavar=("<low>", "<high>"), type=float, nargs=2, default=(1., 99.9), help="black and white points, as percentiles of each colour channel")
+parser.add_argument("--beta", type=float, default=10., help="asinh softening: larger values brighten faint signal more")
+parser.add_argument("--max-width", metavar="<px>", type=int, default=1024, help="max. preview width; whole 2x2 Bayer superpixels are averaged to fit")
+parser.add_argument("--overwrite", action="store_true", help="remake previews that are already newer than their FITS file")
+
+def superpixel_rgb(frame: np.ndarray, pattern: str, factor: int = 1) -> np.ndarray:
+    # (height/2n, width/2n, 3) float32 RGB, each pixel the sum of n x n 2x2 Bayer cells (greens
+    # averaged); the cells are added slice by slice, which is much faster than a strided sum
+    height, width = (size - size % (2*factor) for size in frame.shape)
+    rows = frame[:height, :width].reshape(height//(2*factor), factor, 2, width)
+    summed = rows[:, 0].astype(np.float32)
+    for i in range(1, factor):
+        summed += rows[:, i]
+    columns = summed.reshape(height//(2*factor), 2, width//(2*factor), factor, 2)
+    cells = columns[..., 0, :].copy()
+    for i in range(1, factor):
+        cells += columns[..., i, :]
+    rgb = np.empty((cells.shape[0], cells.shape[2], 3), dtype=np.float32)
+    greens = [divmod(i, 2) for i, colour in enumerate(pattern) if colour == "G"]
+    for channel, colour in ((0, "R"), (2, "B")):
+        row, column = divmod(pattern.index(colour), 2)
+        rgb[..., channel] = cells[:, row, :, column]
+    np.add(cells[:, greens[0][0], :, greens[0][1]], cells[:, greens[1][0], :, greens[1][1]], out=rgb[..., 1])
+    rgb[..., 1] *= 0.5
+    return rgb
+
+def stretch_limits(rgb: np.ndarray, percentiles=(1., 99.9), samples: int = 1 << 16) -> "tuple[np.ndarray, np.ndarray]":
+    # per-channel black and white points, from a decimated sample of about `samples` pixels
+    step = max(1, int(math.sqrt(rgb.shape[0]*rgb.shape[1]/samples)))
+    low, high = np.percentile(rgb[::step, ::step].reshape(-1, 3), percentiles, axis=0)
+    return low, np.maximum(high, low+1e-6)
+
+def stretch_rgb(rgb: np.ndarray, low: np.ndarray, high: np.ndarray, stretch="asinh", beta=10.) -> np.ndarray:
+    # 8-bit image, computed in place in `rgb`
+    rgb -= low
+    rgb *= 1/(high-low)
+    np.clip(rgb, 0., 1., out=rgb)
+    if stretch == "asinh":
+        rgb *= beta
+        np.arcsinh(rgb, out=rgb)
+        rgb *= 1/np.arcsinh(beta)
+    rgb *= 255.
+    rgb += 0.5
+    return rgb.astype(np.uint8)
+
+def png_bytes(image: np.ndarray, level: int = 1) -> bytes:
+    # 8-bit greyscale or RGB PNG with the "Sub" filter on every row; only needs zlib
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    pixels = image.reshape(height, width*channels)
+    rows = np.empty((height, 1+width*channels), dtype=np.uint8)
+    rows[:, 0] = 1 # filter type: difference to the same channel of the previous pixel
+    rows[:, 1:1+channels] = pixels[:, :channels]
+    np.subtract(pixels[:, channels:], pixels[:, :-channels], out=rows[:, 1+channels:])
+    chunk = lambda tag, data: struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag+data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2 if channels == 3 else 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), level)) + chunk(b"IEND", b""))
+
+def save_image(image: np.ndarray, filename: str, quality: int = 85) -> None:
+    if filename.lower().endswith((".jpg", ".jpeg")):
+        from PIL import Image # JPEG encoding needs Pillow (a picamera2 dependency)
+        Image.fromarray(image).save(filename, quality=quality)
+    else:
+        with open(filename, "wb") as image_file:
+            image_file.write(png_bytes(image))
+
+def preview_filename(filename: str, fmt: str = "png") -> str:
+    return os.path.splitext(filename)[0] + "." + fmt
+
+def make_preview(filename: str, out_filename: "str|None" = None, fmt="png", stretch="asinh", percentiles=(1., 99.9),
+                 beta=10., max_width=1024) -> str:
+    # preview of the first image in `filename` (the first frame of a cube or sequence), shown top row
+    # first, i.e. flipped back from FITS orientation; returns the preview's file name
+    out_filename = out_filename or preview_filename(filename, fmt)
+    with open_unscaled(filename) as hdul:
+        hdu = next((hdu for hdu in hdul if hdu.header.get("NAXIS", 0) >= 2), None)
+        if hdu is None:
+            raise ValueError(f"No image in {filename}")
+        frame = read_image(hdu, (0,)*(hdu.header["NAXIS"]-2) or Ellipsis)
+        pattern = hdu.header.get("BAYERPAT", hdul[0].header.get("BAYERPAT", "RGGB"))
+    factor = max(1, math.ceil(frame.shape[1]/2/max_width))
+    rgb = superpixel_rgb(frame, pattern, factor)[::-1]
+    del frame
+    image = stretch_rgb(rgb, *stretch_limits(rgb, percentiles), stretch=stretch, beta=beta)
+    save_image(image, out_filename)
+    return out_filename
+
+class PreviewQueue:
+    # Makes previews of written FITS files in low-priority worker processes, off the capture path:
+    # submit() never blocks, and files that arrive while `max_pending` previews are still waiting to
+    # be made get none (see `skipped`).
+
+    def __init__(self, workers: int = 2, max_pending: int = 4, **options) -> None:
+        self.options = options # make_preview keyword arguments
+        self.max_pending = max_pending
+        self._pool = ProcessPoolExecutor(max_workers=workers, initializer=os.nice, initargs=(10,))
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.made = 0
+        self.skipped = 0
+        self.errors = []
+
+    def submit(self, filename: str) -> bool:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.skipped += 1
+                return False
+            self._pending += 1
+        future = self._pool.submit(make_preview, filename, **self.options)
+        future.add_done_callback(lambda future: self._done(filename, future))
+        return True
+
+    def _done(self, filename: str, future) -> None:
+        with self._lock:
+            self._pending -= 1
+            if future.exception() is None:
+                self.made += 1
+            else:
+                self.errors.append((filename, future.exception()))
+                print(f"Failed to make preview of {filename}: {future.exception()!r}")
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def report(self) -> str:
+        return f"{self.made} previews made, {self.skipped} skipped (workers busy), {len(self.errors)} errors"
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    filenames = []
+    for path in args.paths:
+        filenames.extend(sorted(glob.glob(os.path.join(path, "*.fits"))) if os.path.isdir(path) else [path])
+    if not args.overwrite:
+        is_current = lambda filename: os.path.exists(preview_filename(filename, args.format)) \
+                                      and os.path.getmtime(preview_filename(filename, args.format)) >= os.path.getmtime(filename)
+        filenames = [filename for filename in filenames if not is_current(filename)]
+    options = dict(fmt=args.format, stretch=args.stretch, percentiles=tuple(args.percentiles), beta=args.beta,
+                   max_width=args.max_width)
+    start, made = time.monotonic(), 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {filename: pool.submit(make_preview, filename, **options) for filename in filenames}
+        for filename, future in futures.items():
+            try:
+                print(f"{filename} -> {future.result()}")
+                made += 1
+            except (OSError, ValueError, KeyError, ImportError) as err:
+                print(f"{filename}: failed ({err!r})")
+    elapsed = time.monotonic()-start
+    print(f"{made}/{len(filenames)} previews in {elapsed:.1f} s ({elapsed/max(made, 1):.2f} s per frame with {args.workers} workers)")
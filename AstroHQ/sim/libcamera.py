@@ -0,0 +1,31 @@
+# Minimal stand-in for the libcamera Python bindings, enough for AstroHQ to run against the
+# simulated Picamera2 in this directory (see sim/picamera2.py).
+import enum
+
+class Transform:
+
+    def __init__(self, hflip=False, vflip=False, transpose=False) -> None:
+        self.hflip = bool(hflip)
+        self.vflip = bool(vflip)
+        self.transpose = bool(transpose)
+
+    def __repr__(self) -> str:
+        return f"<libcamera.Transform '{'h' if self.hflip else ''}{'v' if self.vflip else ''}identity'>"
+
+class _Draft:
+
+    class NoiseReductionModeEnum(enum.IntEnum):
+        Off = 0
+        Fast = 1
+        HighQuality = 2
+        Minimal = 3
+        ZSL = 4
+
+class controls:
+    draft = _Draft
+
+    class AeExposureModeEnum(enum.IntEnum):
+        Normal = 0
+        Short = 1
+        Long = 2
+        Custom = 3
@@ -0,0 +1,355 @@
+# Simulated stand-in for picamera2 with an IMX477 (Raspberry Pi HQ camera) attached, so that the
+# AstroHQ capture/header/write path can run and be profiled on an ordinary Linux machine. Put this
+# directory first on sys.path (bench_sim.py does this). Behaviour is tuned with environment vars:
+#   PICAMERA2_SIM_FPS         max. frame rate of the sensor mode (default 10)
+#   PICAMERA2_SIM_READOUT_MS  delay between end of exposure and request completion (default 50)
+#   PICAMERA2_SIM_TIME_SCALE  real seconds per simulated second, to speed up long exposures (default 1)
+#   PICAMERA2_SIM_PLATFORM    VC4 or PISP (default VC4)
+#   PICAMERA2_SIM_CONTROL_DELAY  frames before new controls take effect (default 2)
+#   PICAMERA2_SIM_START_MS    pipeline start-up time before the first exposure begins (default 300)
+import os
+import json
+import time
+import enum
+import threading
+import numpy as np
+
+SETTINGS = {"fps": float(os.environ.get("PICAMERA2_SIM_FPS", 10)),
+            "readout_ms": float(os.environ.get("PICAMERA2_SIM_READOUT_MS", 50)),
+            "time_scale": float(os.environ.get("PICAMERA2_SIM_TIME_SCALE", 1)),
+            "platform": os.environ.get("PICAMERA2_SIM_PLATFORM", "VC4"),
+            "control_delay": int(os.environ.get("PICAMERA2_SIM_CONTROL_DELAY", 2)),
+            "start_ms": float(os.environ.get("PICAMERA2_SIM_START_MS", 300))}
+
+BLACK_LEVEL = 4096 # in 16-bit units, i.e. 256 DN at 12 bits
+SENSOR_MODES = [{"format": "SRGGB10_CSI2P", "unpacked": "SRGGB10", "bit_depth": 10, "size": (1332, 990),
+                 "fps": 120.03, "crop_limits": (696, 528, 2664, 1980), "exposure_limits": (31, 667244877)},
+                {"format": "SRGGB12_CSI2P", "unpacked": "SRGGB12", "bit_depth": 12, "size": (2028, 1080),
+                 "fps": 50.03, "crop_limits": (0, 440, 4056, 2160), "exposure_limits": (60, 674181621)},
+                {"format": "SRGGB12_CSI2P", "unpacked": "SRGGB12", "bit_depth": 12, "size": (2028, 1520),
+                 "fps": 40.01, "crop_limits": (0, 0, 4056, 3040), "exposure_limits": (60, 674181621)},
+                {"format": "SRGGB12_CSI2P", "unpacked": "SRGGB12", "bit_depth": 12, "size": (4056, 3040),
+                 "fps": 10.0, "crop_limits": (0, 0, 4056, 3040), "exposure_limits": (114, 694422939)}]
+
+class Platform(enum.Enum):
+    VC4 = 0
+    PISP = 1
+
+_align = lambda value, alignment: -(-value//alignment)*alignment
+
+def _stride(fmt: str, width: int) -> int:
+    bits = int(fmt[5:7])
+    return _align(width*bits//8 if fmt.endswith("_CSI2P") else width*2, 32)
+
+def _pack_csi2(rows: np.ndarray, bits: int, stride: int) -> np.ndarray:
+    # MIPI CSI-2 packing: 10-bit packs 4 pixels into 5 bytes, 12-bit packs 2 pixels into 3 bytes
+    values = rows >> (16-bits)
+    height, width = values.shape
+    packed = np.zeros((height, stride), dtype=np.uint8)
+    if bits == 12:
+        pairs = values.reshape(height, width//2, 2)
+        groups = packed[:, :width*3//2].reshape(height, width//2, 3)
+        groups[..., 0] = pairs[..., 0] >> 4
+        groups[..., 1] = pairs[..., 1] >> 4
+        groups[..., 2] = (pairs[..., 0] & 0xF) | ((pairs[..., 1] & 0xF) << 4)
+    else:
+        quads = values.reshape(height, width//4, 4)
+        groups = packed[:, :width*5//4].reshape(height, width//4, 5)
+        groups[..., :4] = quads >> 2
+        groups[..., 4] = sum((quads[..., i] & 0x3) << (2*i) for i in range(4))
+    return packed
+
+def simulate_raw(size: tuple, exposure_s: float, gain: float, seed: int, binned: bool = False) -> np.ndarray:
+    # RGGB mosaic as 12-bit values left-aligned in 16 bits: bias + read noise, dark current with hot
+    # pixels, and a dim vignetted sky scaled by exposure and gain (shot noise approximated as Gaussian)
+    width, height = size
+    rng = np.random.default_rng(seed)
+    rows = np.arange(height, dtype=np.float32)[:, None]
+    cols = np.arange(width, dtype=np.float32)[None, :]
+    vignette = 1 - 0.3*(((rows-height/2)/height)**2 + ((cols-width/2)/width)**2)
+    cfa = np.tile(np.array([[0.6, 1.0], [1.0, 0.45]], dtype=np.float32), (height//2, width//2)) # R, G / G, B
+    electrons = cfa*vignette
+    electrons *= (5.0 + 0.05*(4 if binned else 1))*exposure_s # sky + dark current [e-/px]
+    hot = np.random.default_rng(0).integers(0, width*height, size=width*height//20000) # fixed pattern
+    electrons.flat[hot] += 40*exposure_s
+    noise = rng.standard_normal(size=electrons.shape, dtype=np.float32)
+    noise *= np.sqrt(electrons*gain**2 + 3**2) # shot + read noise [DN]
+    signal = electrons*gain + noise + BLACK_LEVEL/16
+    return np.clip(signal, 0, 4095).astype(np.uint16) << 4
+
+class CompletedRequest:
+
+    def __init__(self, camera: "Picamera2", buffer: np.ndarray, metadata: dict) -> None:
+        self._camera = camera
+        self._buffer = buffer
+        self._metadata = metadata
+        self._released = False
+
+    def make_buffer(self, name: str) -> np.ndarray:
+        return self._buffer.copy()
+
+    def make_array(self, name: str) -> np.ndarray:
+        if name != "raw":
+            raise NotImplementedError("the simulator only produces the raw stream")
+        config = self._camera.camera_config["raw"]
+        return self._buffer.reshape(config["size"][1], config["stride"]).copy()
+
+    def get_metadata(self) -> dict:
+        return dict(self._metadata)
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._camera._buffers.release()
+
+class MappedArray:
+
+    def __init__(self, request: CompletedRequest, stream: str, reshape=True, write=True) -> None:
+        self.request = request
+        self.stream = stream
+        self.reshape = reshape
+
+    def __enter__(self) -> "MappedArray":
+        buffer = self.request._buffer
+        if self.reshape:
+            config = self.request._camera.camera_config[self.stream]
+            buffer = buffer.reshape(config["size"][1], config["stride"])
+        self.array = buffer
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        del self.array
+
+class Controls:
+
+    def __init__(self, camera: "Picamera2") -> None:
+        object.__setattr__(self, "_camera", camera)
+
+    def __setattr__(self, name: str, value) -> None:
+        object.__setattr__(self, name, value)
+        self._camera.set_controls({name: value})
+
+class Picamera2:
+
+    def __init__(self, camera_num=0, tuning=None) -> None:
+        self.camera_num = camera_num
+        self.tuning = tuning
+        self.platform = Platform[SETTINGS["platform"]]
+        self.camera_properties = {"Model": "imx477", "UnitCellSize": (1550, 1550), "PixelArraySize": (4056, 3040),
+                                  "PixelArrayActiveAreas": [(8, 16, 4056, 3040)], "ColorFilterArrangement": 0,
+                                  "Location": 2, "Rotation": 180, "ScalerCropMaximum": (0, 0, 4056, 3040)}
+        self.sensor_modes = [dict(mode) for mode in SENSOR_MODES]
+        self.sensor_resolution = self.camera_properties["PixelArraySize"]
+        self.sensor_format = "SRGGB12_CSI2P"
+        self.camera_config = None
+        self.controls = Controls(self)
+        self.started = False
+        self._active = {"ExposureTime": 20000, "AnalogueGain": 1.0}
+        self._pending = [] # (frames to go, controls)
+        self._lock = threading.Condition()
+        self._latest = None
+        self._sequence = 0
+        self._thread = None
+        self._frames = {}
+        self._buffers = threading.BoundedSemaphore(1)
+        self._clock_origin = (time.monotonic_ns(), time.clock_gettime_ns(time.CLOCK_BOOTTIME))
+
+    @staticmethod
+    def load_tuning_file(tuning_file: str, dir=None) -> dict:
+        for directory in [dir] if dir is not None else []:
+            path = os.path.join(directory, tuning_file)
+            if os.path.isfile(path):
+                with open(path) as json_file:
+                    return json.load(json_file)
+        if os.path.basename(tuning_file).startswith("imx477"):
+            algorithms = ["rpi.black_level", "rpi.dpc", "rpi.lux", "rpi.noise", "rpi.geq", "rpi.sdn", "rpi.awb",
+                          "rpi.agc", "rpi.alsc", "rpi.contrast", "rpi.ccm", "rpi.sharpen"]
+            return {"version": 2.0, "target": "bcm2835",
+                    "algorithms": [{name: {"black_level": BLACK_LEVEL} if name == "rpi.black_level" else {}}
+                                   for name in algorithms]}
+        raise RuntimeError(f"Tuning file {tuning_file} not found")
+
+    @staticmethod
+    def find_tuning_algo(tuning: dict, name: str) -> dict:
+        if tuning.get("version", 1) == 1:
+            return tuning[name]
+        return next(algo[name] for algo in tuning["algorithms"] if name in algo)
+
+    def create_still_configuration(self, main={}, lores=None, raw={}, transform=None, colour_space=None,
+                                   buffer_count=1, controls={}, display=None, encode=None, sensor={}, queue=True) -> dict:
+        return {"use_case": "still", "transform": transform, "colour_space": colour_space,
+                "buffer_count": buffer_count, "queue": queue, "display": display, "encode": encode,
+                "main": {"format": "BGR888", "size": self.sensor_resolution, **main},
+                "lores": lores, "raw": {"format": "SRGGB12", "size": self.sensor_resolution, **(raw or {})},
+                "controls": {"NoiseReductionMode": 2, "FrameDurationLimits": (100, 1000000000), **controls},
+                "sensor": dict(sensor)}
+
+    create_preview_configuration = create_video_configuration = create_still_configuration
+
+    def _sensor_mode(self, config: dict) -> dict:
+        # smallest mode at least as large as the requested raw (or output) size, as libcamera does
+        size = config["sensor"].get("output_size") or config["raw"]["size"]
+        candidates = [mode for mode in self.sensor_modes if mode["size"][0] >= size[0] and mode["size"][1] >= size[1]]
+        return min(candidates or self.sensor_modes[-1:], key=lambda mode: mode["size"][0]*mode["size"][1])
+
+    def configure(self, config: dict) -> None:
+        if self.started:
+            raise RuntimeError("Camera must be stopped before configuring")
+        config = {key: (dict(value) if isinstance(value, dict) else value) for key, value in config.items()}
+        mode = self._sensor_mode(config)
+        raw = config["raw"]
+        raw["stride"] = _stride(raw["format"], raw["size"][0])
+        raw["framesize"] = raw["stride"]*raw["size"][1]
+        config["sensor"] = {"output_size": mode["size"], "bit_depth": mode["bit_depth"]}
+        self.camera_config = config
+        self._mode = mode
+        self.camera_properties["ScalerCropMaximum"] = mode["crop_limits"]
+        self._buffers = threading.BoundedSemaphore(config["buffer_count"])
+        self._frames = {}
+        self._active.update({key: value for key, value in config["controls"].items()})
+        self._active["ScalerCrop"] = mode["crop_limits"]
+
+    def camera_configuration(self) -> dict:
+        return self.camera_config
+
+    def set_controls(self, controls: dict) -> None:
+        controls = dict(controls)
+        if "ScalerCrop" in controls: # clipped to the sensor mode, as the ISP does
+            x, y, width, height = controls["ScalerCrop"]
+            mode_x, mode_y, mode_width, mode_height = self.camera_properties["ScalerCropMaximum"]
+            x, y = min(max(x, mode_x), mode_x+mode_width-64), min(max(y, mode_y), mode_y+mode_height-64)
+            controls["ScalerCrop"] = (x, y, max(64, min(width, mode_x+mode_width-x)), max(64, min(height, mode_y+mode_height-y)))
+        with self._lock:
+            if self.started:
+                self._pending.append([SETTINGS["control_delay"], controls])
+            else:
+                self._active.update(controls)
+
+    @property
+    def camera_controls(self) -> dict:
+        # (min, max, default) per control, as for the configured sensor mode
+        mode = self._mode if self.camera_config is not None else self.sensor_modes[-1]
+        return {"ExposureTime": (*mode["exposure_limits"], 20000), "AnalogueGain": (1.0, 22.26, 1.0),
+                "ScalerCrop": ((0, 0, 0, 0), mode["crop_limits"], mode["crop_limits"]),
+                "FrameDurationLimits": (round(1e6/mode["fps"]), 694434742, round(1e6/mode["fps"]))}
+
+    def _sensor_settings(self, exposure_us: float, gain: float) -> "tuple[int, float]":
+        # what the sensor actually does with the requested values: whole line times within the mode's
+        # limits, and gains from the IMX477's 10-bit code (gain = 1024/(1024-code))
+        line_us = 1e6/self._mode["fps"]/(self._mode["size"][1]*(2 if self._mode["size"][0] < 4056 else 1)+22)
+        low, high, _ = self.camera_controls["ExposureTime"]
+        exposure_us = int(np.clip(round(exposure_us/line_us)*line_us, low, high))
+        code = round(1024 - 1024/np.clip(gain, *self.camera_controls["AnalogueGain"][:2]))
+        return exposure_us, 1024/(1024-code)
+
+    def _now(self) -> int:
+        # simulated CLOCK_BOOTTIME, running 1/time_scale times as fast as the real clock
+        mono0, boot0 = self._clock_origin
+        return boot0 + int((time.monotonic_ns()-mono0)/SETTINGS["time_scale"])
+
+    def _sleep_until(self, sim_ns: int) -> None:
+        while not self._halt.is_set():
+            remaining = (sim_ns-self._now())/1e9*SETTINGS["time_scale"]
+            if remaining <= 0:
+                return
+            self._halt.wait(min(remaining, 0.1))
+
+    def _frame(self, exposure_us: int, gain: float) -> np.ndarray:
+        # a small pool of distinct noise realisations per exposure/gain, packed into buffer layout
+        key = (exposure_us, round(gain, 3))
+        if key not in self._frames:
+            if len(self._frames) > 4:
+                self._frames.clear()
+            raw = self.camera_config["raw"]
+            width, height = raw["size"]
+            binned = self._mode["size"][0] < self.sensor_resolution[0]
+            frames = []
+            base = simulate_raw((width, height), exposure_us/1e6, gain, len(self._frames), binned)
+            for pixels in (base, np.roll(base, 2, axis=0)): # second realisation without a second simulation
+                if raw["format"].endswith("_CSI2P"):
+                    rows = _pack_csi2(pixels, int(raw["format"][5:7]), raw["stride"])
+                else:
+                    rows = np.zeros((height, raw["stride"]//2), dtype="<u2")
+                    rows[:, :width] = pixels
+                frames.append(rows.view(np.uint8).reshape(-1))
+            self._frames[key] = frames
+        pool = self._frames[key]
+        return pool[self._sequence % len(pool)]
+
+    def _run(self) -> None:
+        frame_start = self._now() + int(SETTINGS["start_ms"]*1e6)
+        while not self._halt.is_set():
+            with self._lock:
+                for pending in self._pending:
+                    pending[0] -= 1
+                for frames_to_go, controls in [item for item in self._pending if item[0] <= 0]:
+                    self._active.update(controls)
+                self._pending = [item for item in self._pending if item[0] > 0]
+                exposure_us, gain = self._sensor_settings(self._active["ExposureTime"], self._active["AnalogueGain"])
+                scaler_crop = tuple(self._active["ScalerCrop"])
+            frame_duration = max(exposure_us, round(1e6/min(SETTINGS["fps"], self._mode["fps"])))
+            readout = frame_start + exposure_us*1000
+            self._sleep_until(readout + int(SETTINGS["readout_ms"]*1e6))
+            if self._halt.is_set():
+                return
+            self._sequence += 1
+            metadata = {"SensorTimestamp": readout, "FrameDuration": frame_duration, "ExposureTime": exposure_us,
+                        "AnalogueGain": gain, "DigitalGain": 1.0, "ColourGains": (1.0, 1.0),
+                        "SensorBlackLevels": (BLACK_LEVEL,)*4, "ScalerCrop": scaler_crop,
+                        "SensorTemperature": 38.0 + 4*float(np.tanh(self._sequence/50)), "Lux": 2.5*1e6/exposure_us,
+                        "ColourTemperature": 4000, "FocusFoM": int(900 + 100*np.sin(self._sequence)),
+                        "AeLocked": False, "FrameWallClock": time.time_ns(),
+                        "ColourCorrectionMatrix": (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)}
+            if self._buffers.acquire(blocking=False): # no free buffer means the frame is dropped
+                request = CompletedRequest(self, self._frame(exposure_us, gain), metadata)
+                with self._lock:
+                    self._latest = request
+                    self._lock.notify_all()
+            frame_start += frame_duration*1000
+
+    def start(self, config=None, show_preview=False) -> None:
+        if config is not None:
+            self.configure(config)
+        if self.started:
+            return
+        self._halt = threading.Event()
+        self._pending = []
+        self._latest = None
+        self.started = True
+        self._thread = threading.Thread(target=self._run, name="picamera2-sim", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self.started:
+            return
+        self._halt.set()
+        self._thread.join()
+        self.started = False
+        with self._lock:
+            if self._latest is not None:
+                self._latest.release()
+                self._latest = None
+            self._lock.notify_all()
+
+    def close(self) -> None:
+        self.stop()
+
+    def capture_request(self, flush=None, wait=None) -> CompletedRequest:
+        # the next request to complete after the call
+        with self._lock:
+            previous = self._latest
+            if previous is not None:
+                self._latest = None
+                previous.release() # stale frame nobody asked for
+            while self._latest is None:
+                if not self.started:
+                    raise RuntimeError("Camera is not running")
+                self._lock.wait(0.1)
+            request, self._latest = self._latest, None
+        return request
+
+    def capture_metadata(self, wait=None) -> dict:
+        request = self.capture_request()
+        metadata = request.get_metadata()
+        request.release()
+        return metadata
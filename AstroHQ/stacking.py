@@ -0,0 +1,163 @@
+import os
+import argparse
+import tempfile
+import datetime as dt
+import numpy as np
+from astropy.io import fits
+from fits_writer import open_unscaled, read_image
+
+parser = argparse.ArgumentParser(description="combine calibration frames into a master frame")
+parser.add_argument("files", nargs="+", type=str, help="FITS frames to stack")
+parser.add_argument("-o", "--out-file", metavar="<path>", type=str, default="master.fits", help="output master frame")
+parser.add_argument("-m", "--method", choices=["mean", "sigmaclip", "median"], default="mean", help="combination method")
+parser.add_argument("-s", "--sigma", metavar="<n>", type=float, default=3., help="clipping threshold for sigmaclip")
+parser.add_argument("-t", "--type", choices=["bias", "dark", "flat"], default=None, help="frame type to record as IMAGETYP")
+parser.add_argument("--memory-mb", metavar="<MiB>", type=float, default=64., help="memory budget for the sigmaclip/median pass")
+
+class FrameStacker:
+    # Running mean/variance (Welford) in float32 accumulators, so memory stays at a few frame-sized
+    # buffers no matter how many frames are added. "sigmaclip" and "median" need a second pass over
+    # the frames: FITS files are re-read in row chunks, frames added from memory are spooled to disk.
+
+    def __init__(self, method="mean", sigma=3.0, memory_mb=64., chunk_rows=128, spool_dir=None, frame_type=None) -> None:
+        if method not in ("mean", "sigmaclip", "median"):
+            raise ValueError(f"Unrecognized stacking method {method!r}")
+        self.method = method
+        self.sigma = sigma
+        self.memory_bytes = int(memory_mb*1024**2)
+        self.chunk_rows = chunk_rows
+        self.spool_dir = spool_dir
+        self.frame_type = frame_type
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.header = None
+        self.sources = [] # (file name, extension), or None for spooled frames, per frame
+        self._spool = None
+
+    @property
+    def shape(self) -> "tuple|None":
+        return None if self.mean is None else self.mean.shape
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2/max(self.count-1, 1)
+
+    def _accumulate(self, frame: np.ndarray) -> None:
+        if self.mean is None:
+            self.mean = np.zeros(frame.shape, dtype=np.float32)
+            self.m2 = np.zeros(frame.shape, dtype=np.float32)
+        elif frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match stack shape {self.shape}")
+        self.count += 1
+        for start in range(0, frame.shape[0], self.chunk_rows): # row chunks keep temporaries small
+            rows = slice(start, start+self.chunk_rows)
+            values = frame[rows].astype(np.float32)
+            delta = values - self.mean[rows]
+            self.mean[rows] += delta/self.count
+            values -= self.mean[rows]
+            self.m2[rows] += delta*values
+
+    def add(self, frame: np.ndarray, header: "fits.Header|None" = None, source: "tuple|None" = None) -> None:
+        # `frame` may be a view of a request buffer; it is not retained
+        self._accumulate(frame)
+        if self.header is None and header is not None:
+            self.header = header.copy()
+        if source is None and self.method != "mean":
+            if self._spool is None:
+                self._spool = tempfile.NamedTemporaryFile(prefix="stack_", suffix=".u16", dir=self.spool_dir)
+            np.ascontiguousarray(frame, dtype=np.uint16).tofile(self._spool)
+            self._spool.flush()
+        self.sources.append(source)
+
+    def add_file(self, filename: str, ext=0) -> None:
+        with open_unscaled(filename) as hdul:
+            self.add(read_image(hdul[ext]), hdul[ext].header, source=(filename, ext))
+
+    def _row_chunks(self, rows_per_chunk: int):
+        height, width = self.shape
+        spool = None
+        if self._spool is not None:
+            spool = np.memmap(self._spool.name, dtype=np.uint16, mode="r",
+                              shape=(self.sources.count(None), height, width))
+        handles = {filename: open_unscaled(filename) for filename, ext in set(filter(None, self.sources))}
+        try:
+            for start in range(0, height, rows_per_chunk):
+                rows = slice(start, min(start+rows_per_chunk, height))
+                chunk = np.empty((self.count, rows.stop-rows.start, width), dtype=np.float32)
+                spooled = 0
+                for i, source in enumerate(self.sources):
+                    if source is None:
+                        chunk[i] = spool[spooled, rows]
+                        spooled += 1
+                    else:
+                        filename, ext = source
+                        chunk[i] = read_image(handles[filename][ext], rows)
+                yield rows, chunk
+        finally:
+            for hdul in handles.values():
+                hdul.close()
+
+    def combine(self) -> np.ndarray:
+        if self.count == 0:
+            raise ValueError("No frames have been added")
+        if self.method == "mean":
+            return self.mean.copy()
+        master = np.empty(self.shape, dtype=np.float32)
+        # the chunk plus the median/clipping temporaries take about 3x the float32 chunk itself
+        rows_per_chunk = max(1, self.memory_bytes//(3*4*self.count*self.shape[1]))
+        for rows, chunk in self._row_chunks(rows_per_chunk):
+            center = np.median(chunk, axis=0)
+            if self.method == "median":
+                master[rows] = center
+                continue
+            deviation = np.abs(chunk-center)
+            spread = 1.4826*np.median(deviation, axis=0) # MAD-based sigma, robust to outliers
+            rejected = deviation > self.sigma*np.maximum(spread, np.finfo(np.float32).eps)
+            del deviation
+            kept = self.count - rejected.sum(axis=0)
+            chunk[rejected] = 0
+            master[rows] = np.where(kept > 0, chunk.sum(axis=0)/np.maximum(kept, 1), center)
+        return master
+
+    def master_hdu(self) -> fits.HDUList:
+        primary = fits.PrimaryHDU(data=self.combine())
+        if self.header is not None:
+            for card in self.header.cards:
+                if card.keyword not in primary.header and card.keyword not in ("BSCALE", "BZERO", "CHECKSUM", "DATASUM"):
+                    primary.header.append(card)
+        if self.frame_type is not None:
+            primary.header.set("IMAGETYP", f"MASTER {self.frame_type.upper()}", "type of calibration frame")
+        primary.header.set("PROV-SEP", "-"*26 + " STACK PROVENANCE " + "-"*26)
+        primary.header.set("NCOMBINE", self.count, "number of frames combined")
+        primary.header.set("COMBTYPE", self.method.upper(), "frame combination method")
+        if self.method == "sigmaclip":
+            primary.header.set("CLIPSIG", self.sigma, "clipping threshold [sigma]")
+        primary.header.set("STACKDAT", dt.datetime.utcnow().isoformat(), "[ISO UTC] time of stacking")
+        for i, source in enumerate(self.sources, start=1):
+            if source is not None and i < 1000:
+                primary.header.set(f"IMCMB{i:03d}", os.path.basename(source[0]), "combined frame")
+        if self.sources.count(None):
+            primary.header.add_history(f"{self.sources.count(None)} frame(s) stacked directly from capture")
+        stddev = fits.ImageHDU(data=np.sqrt(self.variance), name="STDDEV")
+        stddev.header.set("BUNIT", primary.header.get("BUNIT", "DN"), "per-pixel standard deviation across frames")
+        hdul = fits.HDUList([primary, stddev])
+        for hdu in hdul:
+            hdu.add_checksum()
+        return hdul
+
+    def close(self) -> None:
+        if self._spool is not None:
+            self._spool.close() # deletes the spool file
+            self._spool = None
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    stacker = FrameStacker(method=args.method, sigma=args.sigma, memory_mb=args.memory_mb, frame_type=args.type)
+    for filename in args.files:
+        stacker.add_file(filename)
+        print(f"Added {filename} ({stacker.count}/{len(args.files)})")
+    stacker.master_hdu().writeto(args.out_file, overwrite=True)
+    print(f"Wrote {args.method} of {stacker.count} frames to {args.out_file}")
+    stacker.close()
@@ -0,0 +1,261 @@
+import os
+import time
+import socket
+import struct
+import argparse
+import threading
+import numpy as np
+from astropy.io import fits
+
+# Wire format. A subscriber connects and sends one SUBSCRIBE message with the decimation it wants
+# (1 = full resolution); the server then sends FRAME messages: the fixed-size prefix, the frame's
+# FITS header cards (ASCII, no padding) and the pixels (row-major, dtype as given in the prefix).
+SUBSCRIBE = struct.Struct("<4sH") # magic, decimation
+FRAME_PREFIX = struct.Struct("<4sI4sHIII") # magic, frame number, dtype, decimation, height, width, header length
+SUBSCRIBE_MAGIC, FRAME_MAGIC = b"AHQS", b"AHQF"
+MAX_DECIMATION = 64
+
+parser = argparse.ArgumentParser(description="reference client for the quick-look frame stream of astro_hq.py --serve")
+parser.add_argument("address", type=str, help="host:port of a TCP stream, or the path of a Unix socket")
+parser.add_argument("-d", "--decimate", metavar="<n>", type=int, default=1, help="receive every n-th 2x2 Bayer cell in each direction (default=1, i.e. full resolution)")
+parser.add_argument("-n", "--number", metavar="<#>", type=int, default=0, help="stop after this many frames (default=0, i.e. until the server closes)")
+parser.add_argument("-o", "--out-file", metavar="<path>", type=str, default=None, help="save each frame as FITS, formatted with the frame number (e.g. quicklook_{:04d}.fits)")
+
+def parse_address(address: str) -> "tuple[int, str|tuple[str, int]]":
+    # "host:port" for TCP, anything else is a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "localhost", int(port))
+    return socket.AF_UNIX, address
+
+def decimate_bayer(frame: np.ndarray, factor: int) -> np.ndarray:
+    # contiguous little-endian copy of every factor-th 2x2 Bayer cell in each direction, so the result
+    # is still a mosaic with the same pattern; a single copy straight from `frame` (which may be a view
+    # of a request buffer) into the send buffer
+    dtype = frame.dtype.newbyteorder("<")
+    if factor == 1:
+        out = np.empty(frame.shape, dtype=dtype)
+        np.copyto(out, frame)
+        return out
+    height, width = (size - size % 2 for size in frame.shape)
+    cells = frame[:height, :width].reshape(height//2, 2, width//2, 2)[::factor, :, ::factor, :]
+    out = np.empty((cells.shape[0]*2, cells.shape[2]*2), dtype=dtype)
+    np.copyto(out.reshape(cells.shape), cells)
+    return out
+
+def frame_message(frame: np.ndarray, header_bytes: bytes, decimation: int, number: int) -> "tuple[bytes, bytes, np.ndarray]":
+    data = decimate_bayer(frame, decimation)
+    prefix = FRAME_PREFIX.pack(FRAME_MAGIC, number, data.dtype.str.encode("ascii"), decimation, *data.shape, len(header_bytes))
+    return prefix, header_bytes, data
+
+def send_message(connection: socket.socket, message: tuple) -> None:
+    # gathered sendmsg straight from the frame buffer (no serialization or joining), resumed after
+    # partial sends
+    buffers = [memoryview(part).cast("B") for part in message]
+    while buffers:
+        sent = connection.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+def recv_exact(connection: socket.socket, buffer: "memoryview|None" = None, size: int = 0) -> memoryview:
+    # fills `buffer` (or a new one of `size` bytes) in place; EOFError if the peer closes first
+    if buffer is None:
+        buffer = memoryview(bytearray(size))
+    view = buffer
+    while len(view):
+        received = connection.recv_into(view)
+        if received == 0:
+            raise EOFError("Connection closed")
+        view = view[received:]
+    return buffer
+
+class Subscriber(threading.Thread):
+    # Sends frames to one client from its own thread. Holds at most one frame waiting to be sent, so
+    # a slow client only ever gets the latest frames it can keep up with and never holds up capture.
+
+    def __init__(self, connection: socket.socket, decimation: int) -> None:
+        super().__init__(name=f"stream-subscriber-{connection.fileno()}", daemon=True)
+        self.connection = connection
+        self.decimation = decimation
+        self.sent = 0
+        self.dropped = 0
+        self._message = None
+        self._ready = threading.Condition()
+        self._closed = False
+        self.start()
+
+    @property
+    def waiting(self) -> bool:
+        # whether a new frame would be sent rather than dropped
+        return self._message is None and not self._closed
+
+    def offer(self, message: tuple) -> None:
+        with self._ready:
+            self._message = message
+            self._ready.notify()
+
+    def run(self) -> None:
+        try:
+            while True:
+                with self._ready:
+                    while self._message is None and not self._closed:
+                        self._ready.wait()
+                    if self._closed:
+                        break
+                    message = self._message
+                send_message(self.connection, message)
+                self.sent += 1
+                with self._ready:
+                    self._message = None
+        except OSError: # client went away
+            pass
+        finally:
+            self._closed = True
+            self.connection.close()
+
+    def close(self) -> None:
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR) # interrupts a send in progress
+        except OSError:
+            pass
+        self.join()
+
+class FrameServer(threading.Thread):
+    # Publishes captured frames and their headers to any number of subscribers on a local TCP or Unix
+    # socket, for remote quick-look. publish() is cheap when nobody is waiting for a frame; otherwise
+    # it makes one copy per requested decimation, shared by all subscribers that asked for it.
+
+    def __init__(self, address: str) -> None:
+        super().__init__(name="frame-server", daemon=True)
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr) # left over from an earlier run
+        self._listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(sockaddr)
+        self._listener.listen()
+        self._listener.settimeout(0.5) # to notice close()
+        self.address = self._listener.getsockname()
+        self.subscribers: "list[Subscriber]" = []
+        self.published = 0
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+        self.start()
+
+    def run(self) -> None:
+        while not self._halt.is_set():
+            try:
+                connection, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                connection.settimeout(5.)
+                magic, decimation = SUBSCRIBE.unpack(recv_exact(connection, size=SUBSCRIBE.size))
+                if magic != SUBSCRIBE_MAGIC or not 1 <= decimation <= MAX_DECIMATION:
+                    raise ValueError(f"Invalid subscription {magic!r}, decimation {decimation}")
+                connection.settimeout(None)
+            except (OSError, EOFError, ValueError) as err:
+                print(f"Rejected frame subscriber: {err}")
+                connection.close()
+                continue
+            if connection.family != socket.AF_UNIX:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self.subscribers.append(Subscriber(connection, decimation))
+            print(f"Frame subscriber connected ({decimation}x decimation, {len(self.subscribers)} total)")
+
+    def publish(self, frame: np.ndarray, header: fits.Header) -> int:
+        # thread-safe; returns the number of subscribers the frame goes to (the rest are still busy
+        # sending an earlier one and skip it). `frame` is only read before this returns.
+        with self._lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber.is_alive()]
+            waiting = [subscriber for subscriber in self.subscribers if subscriber.waiting]
+            for subscriber in self.subscribers:
+                subscriber.dropped += not subscriber.waiting
+            number = self.published
+            self.published += 1
+        if not waiting:
+            return 0
+        header_bytes = header.tostring(padding=False).encode("ascii")
+        messages = {}
+        for subscriber in waiting:
+            if subscriber.decimation not in messages:
+                messages[subscriber.decimation] = frame_message(frame, header_bytes, subscriber.decimation, number)
+            subscriber.offer(messages[subscriber.decimation])
+        return len(waiting)
+
+    def close(self) -> None:
+        self._halt.set()
+        self.join()
+        self._listener.close()
+        with self._lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+            print(f"Frame subscriber: {subscriber.sent} frame(s) sent, {subscriber.dropped} skipped")
+        if self._listener.family == socket.AF_UNIX and isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+class FrameClient:
+    # Receives (frame, header) pairs from a FrameServer; frames are received straight into their
+    # arrays. Iterate over it to receive until the server closes.
+
+    def __init__(self, address: str, decimation: int = 1, timeout: "float|None" = None) -> None:
+        family, sockaddr = parse_address(address)
+        self.connection = socket.socket(family, socket.SOCK_STREAM)
+        self.connection.settimeout(timeout)
+        self.connection.connect(sockaddr)
+        self.connection.sendall(SUBSCRIBE.pack(SUBSCRIBE_MAGIC, decimation))
+
+    def receive(self) -> "tuple[np.ndarray, fits.Header]":
+        magic, number, dtype, decimation, height, width, header_size = \
+            FRAME_PREFIX.unpack(recv_exact(self.connection, size=FRAME_PREFIX.size))
+        if magic != FRAME_MAGIC:
+            raise ValueError(f"Not a frame stream (magic {magic!r})")
+        header = fits.Header.fromstring(recv_exact(self.connection, size=header_size).tobytes().decode("ascii"))
+        header.set("FRAMENUM", number, "frame number in stream")
+        header.set("DECIMATE", decimation, "every n-th Bayer cell in each direction")
+        frame = np.empty((height, width), dtype=dtype.rstrip(b"\0").decode("ascii"))
+        recv_exact(self.connection, memoryview(frame).cast("B"))
+        return frame, header
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.receive()
+            except EOFError:
+                return
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "FrameClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    received, start = 0, time.monotonic()
+    with FrameClient(args.address, args.decimate) as client:
+        for frame, header in client:
+            received += 1
+            print(f"Frame {header['FRAMENUM']}: {frame.shape[1]}x{frame.shape[0]}, min/median/max "
+                  f"{frame.min()}/{np.median(frame):.0f}/{frame.max()}, EXPTIME={header.get('EXPTIME')}, "
+                  f"DATE-END={header.get('DATE-END')}")
+            if args.out_file:
+                fits.PrimaryHDU(data=frame, header=header).writeto(args.out_file.format(header["FRAMENUM"]), overwrite=True)
+            if received == args.number:
+                break
+    elapsed = time.monotonic()-start
+    print(f"Received {received} frame(s) in {elapsed:.1f} s ({received/elapsed:.2f} frames/s)")
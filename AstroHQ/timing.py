@@ -0,0 +1,111 @@
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+
+# log-spaced latency bins from 10 us to 1000 s, 20 per decade
+BIN_EDGES = np.logspace(-5, 3, 8*20+1)
+
+class FrameTiming:
+    # stage durations of one frame, measured with the monotonic clock; a frame may be handed from
+    # the capture thread to a writer thread, as long as only one thread times it at once
+
+    def __init__(self, timer: "StageTimer", label: str) -> None:
+        self.timer = timer
+        self.label = label
+        self.start = time.time()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        t0 = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            self.add(name, (time.monotonic_ns()-t0)/1e9)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.) + seconds
+
+    def finish(self) -> None:
+        self.timer.record(self)
+
+class NoTiming:
+    # stands in for FrameTiming when instrumentation is off
+
+    def stage(self, name: str) -> contextlib.nullcontext:
+        return contextlib.nullcontext()
+
+    def add(self, name: str, seconds: float) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+NO_TIMING = NoTiming()
+
+class StageTimer:
+    # Per-stage latency histograms across a sequence, with optional JSON lines export (one line per
+    # frame, plus a summary line from write_summary).
+
+    def __init__(self, jsonl_path: "str|None" = None, **context) -> None:
+        self.context = context # e.g. platform="PISP", recorded with the summary
+        self.histograms = {}
+        self.totals = {}
+        self.extremes = {}
+        self.frames = 0
+        self._lock = threading.Lock()
+        self._file = open(jsonl_path, "a") if jsonl_path else None
+
+    def frame(self, label: str) -> FrameTiming:
+        return FrameTiming(self, label)
+
+    def record(self, timing: FrameTiming) -> None:
+        with self._lock:
+            self.frames += 1
+            for name, seconds in timing.stages.items():
+                if name not in self.histograms:
+                    self.histograms[name] = np.zeros(BIN_EDGES.size+1, dtype=np.int64)
+                    self.totals[name] = 0.
+                    self.extremes[name] = (np.inf, 0.)
+                self.histograms[name][np.searchsorted(BIN_EDGES, seconds)] += 1
+                self.totals[name] += seconds
+                self.extremes[name] = (min(self.extremes[name][0], seconds), max(self.extremes[name][1], seconds))
+            if self._file is not None:
+                self._file.write(json.dumps({"frame": timing.label, "start": timing.start,
+                                             "total": sum(timing.stages.values()), "stages": timing.stages})+"\n")
+                self._file.flush()
+
+    def percentile(self, name: str, q: float) -> float:
+        # upper edge of the histogram bin holding the q-th percentile (within 12% of the true value),
+        # clipped to the observed range
+        counts = self.histograms[name]
+        index = np.searchsorted(np.cumsum(counts), q/100*counts.sum())
+        return float(np.clip(BIN_EDGES[min(index, BIN_EDGES.size-1)], *self.extremes[name]))
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: {"count": int(counts.sum()), "mean": self.totals[name]/counts.sum(),
+                           "min": self.extremes[name][0], "p50": self.percentile(name, 50),
+                           "p90": self.percentile(name, 90), "p99": self.percentile(name, 99),
+                           "max": self.extremes[name][1]}
+                    for name, counts in self.histograms.items()}
+
+    def report(self) -> str:
+        lines = [f"{'stage':>14} {'count':>6} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}  [ms]"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:>14} {stats['count']:6d} " + " ".join(f"{stats[key]*1e3:9.2f}"
+                                                                     for key in ("mean", "p50", "p90", "p99", "max")))
+        return "\n".join(lines)
+
+    def write_summary(self) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps({"summary": self.summary(), "frames": self.frames, **self.context})+"\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        self.write_summary()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,69 +1,146 @@
+import argparse
 import numpy as np
-from scipy.ndimage import convolve
 from astropy.io import fits
-from matplotlib import pyplot as plt
 
-def debayer(img_array: np.ndarray, bayer_pattern: str = "RGGB", how="mosaic") -> np.ndarray:
-    R_mask, Gr_mask, Gb_mask, B_mask = [np.zeros((img_array.shape[0], img_array.shape[1]), dtype=np.uint8) for c in bayer_pattern]
-    if bayer_pattern == "RGGB":
-        R_mask[0::2, 0::2] = 1
-        Gr_mask[0::2, 1::2] = 1
-        Gb_mask[1::2, 0::2] = 1
-        B_mask[1::2, 1::2] = 1
-    elif bayer_pattern == "BGGR":
-        B_mask[0::2, 0::2] = 1
-        Gb_mask[0::2, 1::2] = 1
-        Gr_mask[1::2, 0::2] = 1
-        R_mask[1::2, 1::2] = 1
-    elif bayer_pattern == "GRBG":
-        Gr_mask[0::2, 0::2] = 1
-        R_mask[0::2, 1::2] = 1
-        B_mask[1::2, 0::2] = 1
-        Gb_mask[1::2, 1::2] = 1
-    elif bayer_pattern == "GBRG":
-        Gb_mask[0::2, 0::2] = 1
-        B_mask[0::2, 1::2] = 1
-        R_mask[1::2, 0::2] = 1
-        Gr_mask[1::2, 1::2] = 1
-    else:
+BAYER_PATTERNS = ("RGGB", "BGGR", "GRBG", "GBRG")
+DEBAYER_METHODS = ("mosaic", "superpixel", "bilinear", "edge")
+CROSS = ((0, -1), (0, 1), (-1, 0), (1, 0))
+DIAGONALS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+def check_pattern(bayer_pattern: str) -> None:
+    if bayer_pattern not in BAYER_PATTERNS:
         raise ValueError(f"{bayer_pattern} is not a valid Bayer pattern")
-    G_mask = Gr_mask+Gb_mask
-    
-    rgb_array = np.zeros((img_array.shape[0], img_array.shape[1], 3), dtype=img_array.dtype)
-    rgb_array[np.where(R_mask)[0], np.where(R_mask)[1], 0] = img_array[np.where(R_mask)]
-    rgb_array[np.where(G_mask)[0], np.where(G_mask)[1], 1] = img_array[np.where(G_mask)]
-    rgb_array[np.where(B_mask)[0], np.where(B_mask)[1], 2] = img_array[np.where(B_mask)]
-    fig, axs = plt.subplots(2, 2)
-    axs[0, 0].imshow(img_array, cmap="binary_r")
-    axs[0, 1].imshow(img_array[np.where(R_mask)].reshape(3040//2, 4056//2), cmap="Reds_r")
-    axs[1, 0].imshow(img_array[np.where(G_mask)].reshape(3040, 4056//2), cmap="Greens_r")
-    axs[1, 1].imshow(img_array[np.where(B_mask)].reshape(3040//2, 4056//2), cmap="Blues_r")
-    plt.show(block=False)
-    if how=="mosaic":
-        pass
-    elif how=="bilinear":
-        kernel_G = np.array([[0.00, 0.25, 0.00],
-                             [0.25, 1.00, 0.25],
-                             [0.00, 0.25, 0.00]])
 
-        kernel_RB = np.array([[0.25, 0.50, 0.25],
-                              [0.50, 1.00, 0.50],
-                              [0.25, 0.50, 0.25]])
-        
-        rgb_array[:,:,0] = convolve(rgb_array[:,:,0], kernel_RB, mode="nearest")
-        rgb_array[:,:,1] = convolve(rgb_array[:,:,1], kernel_G, mode="nearest")
-        rgb_array[:,:,2] = convolve(rgb_array[:,:,2], kernel_RB, mode="nearest")
-    else:
-        raise ValueError
-    return rgb_array
+def phase_view(padded: np.ndarray, pad: int, shape: tuple, row: int, column: int, dy: int = 0, dx: int = 0) -> np.ndarray:
+    # samples at (row+dy, column+dx) + 2*(i, j) of the unpadded frame, for every pixel (i, j) of the
+    # 2x2 cell position (row, column); works for odd frame sizes too
+    height, width = (shape[0]-row+1)//2, (shape[1]-column+1)//2
+    top, left = pad+row+dy, pad+column+dx
+    return padded[top:top+2*height-1:2, left:left+2*width-1:2]
+
+def mean_into(target: np.ndarray, views: list) -> None:
+    # mean of same-shape views into `target`, summed in a contiguous scratch array: far faster than
+    # repeated passes over a strided slice of an (H, W, 3) image
+    acc = np.add(views[0], views[1], dtype=np.float32)
+    for view in views[2:]:
+        acc += view
+    acc *= 1/len(views)
+    store(target, acc)
+
+def store(target: np.ndarray, values: np.ndarray) -> None:
+    if target.dtype.kind in "ui":
+        info = np.iinfo(target.dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    np.copyto(target, values, casting="unsafe")
+
+def bilinear_channel(padded: np.ndarray, pad: int, shape: tuple, bayer_pattern: str, colour: str, target: np.ndarray) -> None:
+    # `colour` at every pixel of `target` (H x W) from its own sites in the (phase-preserving) padded
+    # mosaic: copied where it was sampled, else the mean of the nearest 2 or 4 sites of that colour
+    for row, column in np.ndindex(2, 2):
+        site = bayer_pattern[2*row+column]
+        at = lambda dy, dx: phase_view(padded, pad, shape, row, column, dy, dx)
+        if site == colour:
+            store(target[row::2, column::2], at(0, 0))
+            continue
+        if colour == "G":
+            offsets = CROSS
+        elif site != "G": # red at blue sites and vice versa
+            offsets = DIAGONALS
+        elif bayer_pattern[2*row+1-column] == colour: # green site in a row with this colour
+            offsets = CROSS[:2]
+        else:
+            offsets = CROSS[2:]
+        mean_into(target[row::2, column::2], [at(dy, dx) for dy, dx in offsets])
+
+def edge_green(padded: np.ndarray, pad: int, shape: tuple, bayer_pattern: str, green: np.ndarray) -> None:
+    # green at red/blue sites interpolated along the row or the column, whichever has the smaller
+    # gradient (including the site colour's own curvature, Hamilton-Adams style), both where equal
+    for row, column in np.ndindex(2, 2):
+        at = lambda dy, dx: phase_view(padded, pad, shape, row, column, dy, dx)
+        if bayer_pattern[2*row+column] == "G":
+            green[row::2, column::2] = at(0, 0)
+            continue
+        curvature_h = 2*at(0, 0) - at(0, -2) - at(0, 2)
+        curvature_v = 2*at(0, 0) - at(-2, 0) - at(2, 0)
+        gradient_h = np.abs(at(0, -1) - at(0, 1)) + np.abs(curvature_h)
+        gradient_v = np.abs(at(-1, 0) - at(1, 0)) + np.abs(curvature_v)
+        estimate_h = (at(0, -1) + at(0, 1))/2 + curvature_h/4
+        estimate_v = (at(-1, 0) + at(1, 0))/2 + curvature_v/4
+        green[row::2, column::2] = np.where(gradient_h < gradient_v, estimate_h,
+                                            np.where(gradient_v < gradient_h, estimate_v, (estimate_h+estimate_v)/2))
+
+def superpixel(img_array: np.ndarray, bayer_pattern: str = "RGGB", out: "np.ndarray|None" = None) -> np.ndarray:
+    # (H/2, W/2, 3) RGB, one pixel per 2x2 cell, greens averaged; float32 unless `out` is given
+    check_pattern(bayer_pattern)
+    height, width = img_array.shape[0]//2, img_array.shape[1]//2
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.float32)
+    sites = {colour: [] for colour in "RGB"}
+    for row, column in np.ndindex(2, 2):
+        sites[bayer_pattern[2*row+column]].append(img_array[row:2*height:2, column:2*width:2])
+    store(out[..., 0], sites["R"][0])
+    mean_into(out[..., 1], sites["G"])
+    store(out[..., 2], sites["B"][0])
+    return out
+
+def debayer(img_array: np.ndarray, bayer_pattern: str = "RGGB", how="mosaic", out: "np.ndarray|None" = None,
+            chunk_rows: int = 32) -> np.ndarray:
+    # (H, W, 3) RGB from a Bayer mosaic of any size, by strided slicing per 2x2 cell position:
+    #   mosaic: each colour only at its own sites, zero elsewhere (input dtype)
+    #   superpixel: half size, see superpixel() (float32)
+    #   bilinear: mean of the nearest sites of each missing colour (float32)
+    #   edge: edge-directed green, then bilinear red-green/blue-green differences (float32)
+    # `out` may be any (H, W, 3) array (e.g. reused between frames); integer ones are rounded and clipped.
+    # bayer_pattern must describe img_array as given: BAYERPAT for frames in FITS orientation.
+    # Interpolation runs over bands of `chunk_rows` rows, so its many passes stay in the CPU caches.
+    if how == "superpixel":
+        return superpixel(img_array, bayer_pattern, out)
+    check_pattern(bayer_pattern)
+    if how not in DEBAYER_METHODS:
+        raise ValueError(f"Unknown debayer method {how!r} (choose from {', '.join(DEBAYER_METHODS)})")
+    shape = img_array.shape
+    if out is None:
+        out = np.empty(shape + (3,), dtype=img_array.dtype if how == "mosaic" else np.float32)
+    if how == "mosaic":
+        out[...] = 0
+        for row, column in np.ndindex(2, 2):
+            out[row::2, column::2, "RGB".index(bayer_pattern[2*row+column])] = img_array[row::2, column::2]
+        return out
+    pad = 1 if how == "bilinear" else 2
+    # "reflect" padding mirrors about the edge pixels, which keeps the 2x2 phase of every site
+    padded = np.pad(img_array.astype(np.float32, copy=False), pad, mode="reflect")
+    chunk_rows += chunk_rows % 2 # bands start on even rows, keeping the pattern's phase
+    bands = [(slice(start, min(start+chunk_rows, shape[0])), slice(start, min(start+chunk_rows, shape[0])+2*pad))
+             for start in range(0, shape[0], chunk_rows)] # (rows of the frame, the same rows padded)
+    if how == "bilinear":
+        for rows, padded_rows in bands:
+            for channel, colour in enumerate("RGB"):
+                bilinear_channel(padded[padded_rows], pad, out[rows].shape[:2], bayer_pattern, colour, out[rows, :, channel])
+        return out
+    work = out if out.dtype == np.float32 else np.empty(shape + (3,), dtype=np.float32)
+    green = work[..., 1]
+    for rows, padded_rows in bands:
+        edge_green(padded[padded_rows], pad, green[rows].shape, bayer_pattern, green[rows])
+    padded_green = np.pad(green, pad, mode="reflect")
+    for rows, padded_rows in bands:
+        differences = padded[padded_rows] - padded_green[padded_rows] # used at red and blue sites only
+        for channel, colour in ((0, "R"), (2, "B")):
+            bilinear_channel(differences, pad, green[rows].shape, bayer_pattern, colour, work[rows, :, channel])
+            work[rows, :, channel] += green[rows]
+    if work is not out:
+        store(out, work)
+    return out
 
 if __name__ == "__main__":
-    test_array = np.arange(0, 16).reshape(4, 4)
-    test_array, header = fits.getdata("~/Downloads/img_2s.fits", header=True)
+    parser = argparse.ArgumentParser(description="show a debayered FITS frame")
+    parser.add_argument("filename", type=str, help="raw Bayer FITS frame")
+    parser.add_argument("--how", choices=DEBAYER_METHODS, default="bilinear", help="debayering method")
+    args = parser.parse_args()
+    test_array, header = fits.getdata(args.filename, header=True)
     values = test_array.ravel()
     threeSigmaUL = np.mean(values)+3*np.std(values)
-    array_clipped = np.clip(test_array[::-1, :], 0, threeSigmaUL)
-    rgb = debayer(test_array[::-1], header["BAYERPAT"], "mosaic")
+    rgb = debayer(test_array, header.get("BAYERPAT", "RGGB"), args.how)[::-1] # top row first for display
+    from matplotlib import pyplot as plt
     fig = plt.figure()
-    plt.imshow(rgb/(0.5*threeSigmaUL))
+    plt.imshow(np.clip(rgb/threeSigmaUL, 0, 1))
     plt.show()